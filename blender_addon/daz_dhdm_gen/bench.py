@@ -0,0 +1,533 @@
+# Benchmarks of the dll on synthetic meshes, with checks of its outputs against golden hashes
+# (no Blender needed, only the built library and numpy). Headless on Linux, from the repository's root:
+#
+#     cmake -S dll_source -B build -DCMAKE_BUILD_TYPE=Release && cmake --build build -j
+#     cd blender_addon
+#     python -m daz_dhdm_gen.bench --dll ../build/libdhdm_gen.so --levels 1-5 --report bench.json
+#     python -m daz_dhdm_gen.bench --dll ... --baseline-dll ../build_baseline/libdhdm_gen.so \
+#         --golden ../dll_source/golden-linux-x86_64.json --update-golden
+#     python -m daz_dhdm_gen.bench --dll ... --golden ../dll_source/golden-linux-x86_64.json
+#
+# Goldens are written from the library built from the baseline sources (dll_source before the
+# optimizations, whose outputs were checked against DAZ Studio), never from the build under test: with
+# --baseline-dll, every case also runs generate_hd_mesh() and generate_dhdm_file() of the baseline library
+# (its interface: .obj files in, legacy json matching files), its hashes must equal the ones of --dll, and
+# --update-golden writes them. The baseline sources build with the same dependencies, on Linux with an
+# empty windows.h in the include path and -D'__declspec(x)=__attribute__((visibility("default")))':
+#
+#     git archive 5fbd879 dll_source | tar -x -C ../baseline
+#     g++ -std=c++20 -O2 -fPIC -shared -DBUILD_DLL -DGLM_ENABLE_EXPERIMENTAL -I<shim> -I<deps>/include \
+#         ../baseline/dll_source/*.cc ../baseline/dll_source/tinyxml2.cpp -losdCPU -lfmt -lboost_iostreams -lz \
+#         -o ../build_baseline/libdhdm_gen.so
+#
+# A missing golden file, or a case or hash missing from it, is a failure unless --update-golden is given;
+# --update-golden only writes the file if every other check passed.
+#
+# Base meshes (--meshes), each at the sizes of --sizes:
+#     grid        open n x n quad grid (boundaries)
+#     sphere      uv sphere, triangles at the poles and quads elsewhere (n rings, 2n segments)
+#     figure      closed quad mesh shaped like a torso, from a cube with n x n quads per side
+#                 (valence 3 vertices at the corners)
+# For every mesh and level, the hd mesh is the base mesh subdivided by the dll and displaced along its
+# normals in a band of about a third of the mesh. Matching files are identities (the hd mesh has the
+# dll's vertex order).
+#
+# Timed stages (best of --repeat): generate_hd_mesh (.obj in and out), generate_hd_levels,
+# match_vertices, match_vertices_topology and generate_dhdm_file* along every path:
+#     full            whole mesh refined, all threads
+#     sparse          sparse refinement of the edited region
+#     threads_1       one thread
+#     low_memory      refined in tiles (low_memory_mb 1)
+#     session         second run with a session (cached topology, matrices and matching files)
+#     obj             generate_dhdm_file() reading .obj files
+# All the paths must write the same .dhdm file. The .dhdm and the hd .obj of generate_hd_mesh are
+# compared with the sha256 of the golden file (outputs depend on the compiler and the cpu, keep a golden
+# file per build platform). The exit status is 1 if any check fails.
+#
+# The streaming .dsf metadata scanner (core.scan_dsf_metadata()) is checked first against full parses of
+# small .dsf texts (arrays and objects before and around the fields it reads, missing fields, structures
+# it leaves to the full parse), without the dll.
+
+import os, io, sys, json, time, argparse, hashlib, shutil, tempfile, ctypes
+import numpy as np
+
+if __package__ in (None, ""):
+    # run as a script
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = os.path.basename(os.path.dirname(os.path.abspath(__file__)))
+    import importlib
+    importlib.import_module(__package__)
+
+from . import core
+from . import dll_wrapper
+
+
+GOLDEN_VERSION = 1
+mesh_kinds = ("grid", "sphere", "figure")
+dhdm_paths = ("full", "sparse", "threads_1", "low_memory", "session", "obj")
+unit_scale = 0.01
+
+
+# ---- synthetic meshes, as arrays (positions float32 (n, 3), face_vert_counts int32, face_vert_indices int32) ----
+
+def to_mesh_arrays(positions, faces):
+    return ( np.ascontiguousarray(positions, dtype=np.float32),
+             np.array([ len(f) for f in faces ], dtype=np.int32),
+             np.array([ vi for f in faces for vi in f ], dtype=np.int32) )
+
+def make_grid(n):
+    x, z = np.meshgrid( np.linspace(-1, 1, n + 1), np.linspace(-1, 1, n + 1) )
+    y = 0.1 * np.sin(np.pi * x) * np.cos(np.pi * z)
+    positions = np.stack( [ x.ravel(), y.ravel(), z.ravel() ], axis=1 )
+    w = n + 1
+    faces = [ (r*w + c, r*w + c + 1, (r+1)*w + c + 1, (r+1)*w + c) for r in range(n) for c in range(n) ]
+    return to_mesh_arrays(positions, faces)
+
+def make_sphere(n):
+    rings = max(n, 2)
+    segs = 2 * rings
+    theta = np.pi * np.arange(1, rings) / rings
+    phi = 2 * np.pi * np.arange(segs) / segs
+    t, p = np.meshgrid(theta, phi, indexing="ij")
+    positions = np.concatenate( [ [[0, 1, 0]],
+                                  np.stack([ np.sin(t) * np.cos(p), np.cos(t), np.sin(t) * np.sin(p) ], axis=2).reshape(-1, 3),
+                                  [[0, -1, 0]] ] )
+    south = len(positions) - 1
+    def v(i, j):
+        return 1 + (i - 1) * segs + (j % segs)
+    faces = [ (0, v(1, j + 1), v(1, j)) for j in range(segs) ]
+    faces += [ (v(i, j), v(i, j + 1), v(i + 1, j + 1), v(i + 1, j)) for i in range(1, rings - 1) for j in range(segs) ]
+    faces += [ (v(rings - 1, j), v(rings - 1, j + 1), south) for j in range(segs) ]
+    return to_mesh_arrays(positions, faces)
+
+def make_figure(n):
+    # sides of the cube [0, n]^3: the vertices are the lattice points on its surface, shared by the sides
+    vertex_ids = {}
+    lattice = []
+    def vid(p):
+        i = vertex_ids.get(p)
+        if i is None:
+            i = vertex_ids[p] = len(lattice)
+            lattice.append(p)
+        return i
+    faces = []
+    for a in range(3):
+        b, c = (a + 1) % 3, (a + 2) % 3
+        for side in (0, n):
+            for u in range(n):
+                for w in range(n):
+                    corners = []
+                    for du, dw in ((0, 0), (1, 0), (1, 1), (0, 1)):
+                        p = [0, 0, 0]
+                        p[a], p[b], p[c] = side, u + du, w + dw
+                        corners.append( vid(tuple(p)) )
+                    # e_b x e_c = e_a: outwards on the side n, reversed on the side 0
+                    faces.append( tuple(corners) if side == n else tuple(reversed(corners)) )
+
+    p = np.array(lattice, dtype=np.float64) * (2.0 / n) - 1
+    p /= np.linalg.norm(p, axis=1, keepdims=True)
+    # torso: taller than wide, flattened front to back, narrower at the waist
+    waist = 1 - 0.25 * np.exp( -(p[:, 1] / 0.4) ** 2 )
+    positions = np.stack( [ 0.35 * p[:, 0] * waist, 0.8 * p[:, 1], 0.2 * p[:, 2] * waist ], axis=1 )
+    return to_mesh_arrays(positions, faces)
+
+mesh_makers = { "grid": make_grid, "sphere": make_sphere, "figure": make_figure }
+
+
+def get_vertex_normals(positions, face_vert_indices):
+    # hd meshes only (all quads), area weighted
+    p = positions.astype(np.float64)
+    q = face_vert_indices.reshape(-1, 4)
+    fn = np.cross( p[q[:, 2]] - p[q[:, 0]], p[q[:, 3]] - p[q[:, 1]] )
+    normals = np.zeros_like(p)
+    for k in range(4):
+        for axis in range(3):
+            normals[:, axis] += np.bincount( q[:, k], weights=fn[:, axis], minlength=len(p) )
+    return normals / np.maximum( np.linalg.norm(normals, axis=1, keepdims=True), 1e-12 )
+
+def displace(hd_arrays, amplitude=0.01):
+    # the known hd edits: waves along the normals, in the band of the mesh between 55% and 90% of its width
+    positions, face_vert_counts, face_vert_indices = hd_arrays
+    p = positions.astype(np.float64)
+    lo, hi = p.min(axis=0), p.max(axis=0)
+    size = np.linalg.norm(hi - lo)
+    t = (p[:, 0] - lo[0]) / max(hi[0] - lo[0], 1e-12)
+    weight = np.clip( np.minimum(t - 0.55, 0.9 - t) / 0.05, 0, 1 )
+    wave = np.sin(p[:, 1] / size * 40) * np.cos(p[:, 2] / size * 40)
+    disp = amplitude * size * weight * wave
+    # vertices are moved clearly or not at all: the edited vertices don't depend on the tolerance of the
+    # library, or of core.get_edited_mask(), that finds them
+    disp[np.abs(disp) < 1e-4 * size] = 0
+    d = get_vertex_normals(positions, face_vert_indices) * disp[:, None]
+    return ( np.ascontiguousarray(p + d, dtype=np.float32), face_vert_counts, face_vert_indices )
+
+def write_obj(fp, mesh_arrays):
+    # positions as the exact decimal values of the float32s, so the dll reads the same values as from buffers
+    positions, face_vert_counts, face_vert_indices = mesh_arrays
+    with open(fp, "w", encoding="utf-8", newline="\n") as f:
+        np.savetxt( f, positions.astype(np.float64), fmt="v %.17g %.17g %.17g" )
+        if np.all(face_vert_counts == face_vert_counts[0]):
+            k = int(face_vert_counts[0])
+            np.savetxt( f, face_vert_indices.reshape(-1, k) + 1, fmt="f" + " %d" * k )
+        else:
+            starts = np.cumsum(face_vert_counts) - face_vert_counts
+            for s, k in zip(starts.tolist(), face_vert_counts.tolist()):
+                f.write( "f " + " ".join( str(vi + 1) for vi in face_vert_indices[s:s+k].tolist() ) + "\n" )
+
+
+def file_sha256(fp):
+    h = hashlib.sha256()
+    with open(fp, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+# ---- baseline library ----
+
+class BaselineMeshInfo(ctypes.Structure):
+    # MeshInfo of the library before the versioned interface (no get_abi_version())
+    _fields_ = [ ("gScale", ctypes.c_float),
+                 ("base_exportedf", ctypes.c_char_p),
+                 ("hd_level", ctypes.c_ushort),
+                 ("load_uv_layers", ctypes.c_short) ]
+
+def load_baseline_dll(fp):
+    # loaded directly, DHDM_DLL_Wrapper refuses it
+    dll = ctypes.CDLL(os.path.abspath(fp))
+    for name in ("generate_hd_mesh", "generate_dhdm_file"):
+        getattr(dll, name).restype = ctypes.c_int
+    return dll
+
+def run_baseline(case, dll, base_fp, hd_arrays, hd_edit_arrays, level_vertex_counts):
+    # Hashes of the outputs of the baseline library's own entry points for the case: .obj files (the hd
+    # mesh without edits included, the edited vertices are found by the library) and legacy .json
+    # matching files.
+    out_dir = os.path.join(case.dir, "baseline")
+    os.makedirs(out_dir, exist_ok=True)
+    hashes = {}
+    mesh_info = BaselineMeshInfo( 1.0, base_fp.encode("utf-8"), case.level, -1 )
+    if dll.generate_hd_mesh( ctypes.byref(mesh_info), out_dir.encode("utf-8"), b"hd_mesh" ) != 0:
+        raise RuntimeError("baseline generate_hd_mesh() failed")
+    hashes["hd_obj"] = file_sha256( os.path.join(out_dir, "hd_mesh.obj") )
+
+    write_obj(base_fp + "_hd_no_edit.obj", hd_arrays)
+    write_obj(base_fp + "_hd_edit.obj", hd_edit_arrays)
+    matching_fps = []
+    for lvl, n in enumerate(level_vertex_counts, 1):
+        fp = os.path.join(out_dir, "identity_div{0}.json".format(lvl))
+        core.j_to_json_file( fp, { str(i): i for i in range(n) }, with_gzip=True )
+        matching_fps.append(fp)
+    fps_info = dll_wrapper.FilepathsInfo(matching_fps)
+    mesh_info = BaselineMeshInfo( unit_scale, base_fp.encode("utf-8"), case.level, -1 )
+    if dll.generate_dhdm_file( ctypes.byref(mesh_info), ctypes.byref(fps_info),
+                               out_dir.encode("utf-8"), b"morph" ) != 0:
+        raise RuntimeError("baseline generate_dhdm_file() failed")
+    hashes["dhdm"] = file_sha256( os.path.join(out_dir, "morph.dhdm") )
+    return hashes
+
+
+def parse_int_list(text):
+    # "1-3,5" -> [1, 2, 3, 5]
+    values = []
+    for part in text.split(","):
+        if "-" in part:
+            a, b = part.split("-", 1)
+            values.extend( range(int(a), int(b) + 1) )
+        elif part.strip():
+            values.append( int(part) )
+    return values
+
+
+# ---- cases ----
+
+class Case:
+    # one base mesh at one level: its files, timings (best of the repeats) and checks
+
+    def __init__(self, kind, size, level, work_dir):
+        self.kind = kind
+        self.size = size
+        self.level = level
+        self.key = "{0}-{1}-L{2}".format(kind, size, level)
+        self.dir = os.path.join(work_dir, self.key)
+        self.seconds = {}
+        self.hashes = {}
+        self.baseline_hashes = None
+        self.dll_stats = None
+        self.info = {}
+        self.errors = []
+
+    def timed(self, stage, repeat, func, *args, **kwargs):
+        r = None
+        for _ in range(repeat):
+            t = time.perf_counter()
+            r = func(*args, **kwargs)
+            s = time.perf_counter() - t
+            self.seconds[stage] = min( s, self.seconds.get(stage, s) )
+        return r
+
+    def check(self, ok, message):
+        if not ok:
+            self.errors.append(message)
+
+    def as_dict(self):
+        return { "mesh": self.kind, "size": self.size, "level": self.level, "info": self.info,
+                 "seconds": { k: round(v, 4) for k, v in self.seconds.items() },
+                 "dll": self.dll_stats, "sha256": self.hashes, "baseline_sha256": self.baseline_hashes,
+                 "errors": self.errors }
+
+
+def run_case(case, w, base_arrays, paths, repeat, num_threads, baseline_dll=None):
+    os.makedirs(case.dir, exist_ok=True)
+    level = case.level
+    case.info.update( base_vertices=len(base_arrays[0]), base_faces=len(base_arrays[1]) )
+
+    # generate_hd_mesh(): .obj file of the base mesh subdivided without displacements
+    base_fp = os.path.join(case.dir, "base")
+    write_obj(base_fp + ".obj", base_arrays)
+    case.timed( "generate_hd_mesh", repeat, w.generate_hd_mesh, 1, base_fp, level, case.dir, "hd_mesh" )
+    case.hashes["hd_obj"] = file_sha256( os.path.join(case.dir, "hd_mesh.obj") )
+
+    hd_levels = case.timed( "generate_hd_levels", repeat, w.generate_hd_levels,
+                            base_arrays, level, with_faces=True )
+    hd_arrays = hd_levels[level]
+    hd_edit_arrays = displace(hd_arrays)
+    edited_mask = core.get_edited_mask(hd_arrays[0], hd_edit_arrays[0], unit_scale)
+    case.info.update( hd_vertices=len(hd_arrays[0]), edited_vertices=int(edited_mask.sum()) )
+
+    # matching: the hd meshes with and without edits, the topology matching must be the identity
+    indices, distances, stats = case.timed( "match_vertices", repeat, w.match_vertices,
+                                            hd_arrays[0], hd_edit_arrays[0], 1.0, num_threads )
+    indices = case.timed( "match_vertices_topology", repeat, w.match_vertices_topology,
+                          hd_arrays, hd_edit_arrays, 1.0 )[0]
+    case.check( np.array_equal(indices, np.arange(len(indices))), "match_vertices_topology() isn't the identity" )
+
+    fingerprint = core.get_mesh_fingerprint(len(base_arrays[0]), base_arrays[1], base_arrays[2])
+    topology_hash = core.get_topology_hash(len(base_arrays[0]), base_arrays[1], base_arrays[2])
+    matching_fps = []
+    level_vertex_counts = []
+    for lvl in range(1, level + 1):
+        n = len(hd_levels[lvl][0])
+        level_vertex_counts.append(n)
+        fp = os.path.join( case.dir, core.get_matching_filename(fingerprint, lvl, "mr", topology_hash=topology_hash) )
+        core.write_matching_file(fp, np.arange(n, dtype=np.uint32), fingerprint, lvl, "mr", topology_hash=topology_hash)
+        matching_fps.append(fp)
+    del hd_levels
+
+    if "obj" in paths:
+        write_obj(base_fp + "_hd_edit.obj", hd_edit_arrays)
+
+    session = None
+    try:
+        for path in paths:
+            out_dir = os.path.join(case.dir, path)
+            os.makedirs(out_dir, exist_ok=True)
+            stats = {}
+            kwargs = { "num_threads": 1 if path == "threads_1" else num_threads,
+                       "sparse_refine": path == "sparse",
+                       "low_memory_mb": 1 if path == "low_memory" else 0,
+                       "edited_mask": edited_mask, "stats": stats }
+            if path == "session":
+                session = w.create_session(1024)
+                kwargs["session"] = session
+                # first run fills the session
+                w.generate_dhdm_file_from_buffers( unit_scale, level, out_dir, "morph", matching_fps,
+                                                   base_arrays, None, hd_edit_arrays, **kwargs )
+            if path == "obj":
+                case.timed( "dhdm:" + path, repeat, w.generate_dhdm_file, unit_scale, base_fp, level,
+                            out_dir, "morph", matching_fps, **kwargs )
+            else:
+                case.timed( "dhdm:" + path, repeat, w.generate_dhdm_file_from_buffers, unit_scale, level,
+                            out_dir, "morph", matching_fps, base_arrays, None, hd_edit_arrays, **kwargs )
+            if case.dll_stats is None and stats:
+                case.dll_stats = stats
+            case.hashes["dhdm:" + path] = file_sha256( os.path.join(out_dir, "morph.dhdm") )
+    finally:
+        if session is not None:
+            w.destroy_session(session)
+
+    dhdm_hashes = { case.hashes["dhdm:" + p] for p in paths }
+    case.check( len(dhdm_hashes) == 1, "paths write different .dhdm files: {0}".format(
+                    ", ".join( "{0} {1}".format(p, case.hashes["dhdm:" + p][:12]) for p in paths )) )
+    if len(paths) > 0:
+        case.hashes["dhdm"] = case.hashes["dhdm:" + paths[0]]
+
+    if baseline_dll is not None:
+        case.baseline_hashes = run_baseline(case, baseline_dll, base_fp, hd_arrays, hd_edit_arrays, level_vertex_counts)
+        for k, h in case.baseline_hashes.items():
+            case.check( case.hashes.get(k, h) == h, "{0} differs from the baseline library's".format(k) )
+
+
+def check_golden(case, golden, update):
+    # goldens are written from the baseline library's hashes (see run_baseline())
+    if update:
+        expected = golden.setdefault(case.key, {})
+        for k in ("hd_obj", "dhdm"):
+            if k in case.baseline_hashes:
+                expected[k] = case.baseline_hashes[k]
+        return
+    expected = golden.get(case.key)
+    if expected is None:
+        case.errors.append("no golden hashes for this case")
+        return
+    for k in ("hd_obj", "dhdm"):
+        if k not in case.hashes:
+            continue
+        if k not in expected:
+            case.errors.append( "no golden hash of {0}".format(k) )
+        elif expected[k] != case.hashes[k]:
+            case.errors.append( "{0} differs from the golden file".format(k) )
+
+
+def read_golden(fp, update):
+    if fp is None:
+        return {}
+    if not os.path.isfile(fp):
+        if update:
+            return {}
+        raise ValueError("Golden file \"{0}\" not found (written with --update-golden).".format(fp))
+    with open(fp, "r", encoding="utf-8") as f:
+        j = json.load(f)
+    if j.get("version") != GOLDEN_VERSION:
+        raise ValueError("Golden file \"{0}\" has version {1}, not {2}.".format(fp, j.get("version"), GOLDEN_VERSION))
+    return j["cases"]
+
+def write_golden(fp, golden):
+    core.j_to_json_file( fp, { "version": GOLDEN_VERSION, "cases": dict(sorted(golden.items())) },
+                         with_gzip=False, indent=1 )
+
+
+# ---- .dsf metadata scanner ----
+
+dsf_scanner_texts = (
+    '{"a": [1,2], "modifier_library": [{"id": "x", "morph": {"vertex_count": 5, "hd_url": "/a/b.dhdm"}}]}',
+    '{"a": [], "b": {}, "modifier_library": [{"tags": [], "id": "x", "morph": {"vertex_count": 5, "hd_url": "/a/b.dhdm"}}]}',
+    '{"a": [[1,2],[3,[4]]], "b": {"c": [{"d": "]}"}, []]}, "modifier_library": [{"channel": {"e": [0.5]}, "id": "x",'
+    ' "morph": {"deltas": {"count": 2, "values": [[0,1e-3,2,3],[1,4,5,6]]}, "vertex_count": 5, "hd_url": "/a/b.dhdm"}}]}',
+    '{"modifier_library": [{"id": "x", "morph": {"vertex_count": 5}}], "scene": {"modifiers": [{"id": "x-0"}]}}',
+    '{"asset_info": {"id": "/a/x.dsf"}, "modifier_library": []}',
+    '{"asset_info": {"id": "/a/x.dsf"}, "geometry_library": [{"vertices": {"count": 1, "values": [[0,0,0]]}}]}',
+)
+# structures the scanner doesn't read: read_dsf_metadata_uncached() falls back to the full parse
+dsf_fallback_texts = (
+    '{"modifier_library": [{"id": "x", "morph": {"vertex_count": 5, "hd_url": {"a": "/a/b.dhdm"}}}]}',
+    '{"modifier_library": [{"id": "x", "morph": [5]}]}',
+    '{"modifier_library": {"id": "x"}}',
+)
+
+def check_dsf_scanner():
+    errors = []
+    with tempfile.TemporaryDirectory(prefix="dhdm_bench_dsf_") as tmp_dir:
+        dsf_fp = os.path.join(tmp_dir, "morph.dsf")
+        for text in dsf_scanner_texts + dsf_fallback_texts:
+            expected = core.dsf_metadata_from_json( json.loads(text) )
+            try:
+                meta = core.scan_dsf_metadata( io.StringIO(text) )
+            except ValueError as e:
+                meta = None if text in dsf_fallback_texts else str(e)
+            if text in dsf_scanner_texts and meta != expected:
+                errors.append( "scan_dsf_metadata() read {0}, not {1}, from {2}".format(meta, expected, text) )
+            elif text in dsf_fallback_texts and meta is not None:
+                errors.append( "scan_dsf_metadata() read {0} from {1} (ValueError expected)".format(meta, text) )
+            with open(dsf_fp, "w", encoding="utf-8") as f:
+                f.write(text)
+            meta = core.read_dsf_metadata_uncached(dsf_fp)
+            if meta != expected:
+                errors.append( "read_dsf_metadata_uncached() read {0}, not {1}, from {2}".format(meta, expected, text) )
+    return errors
+
+
+def print_case(case):
+    stages = "  ".join( "{0} {1:.3f}".format(k, v) for k, v in case.seconds.items() )
+    print("{0:<16} {1}".format(case.key, stages))
+    for e in case.errors:
+        print("  FAILED: {0}".format(e))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser( prog="daz_dhdm_gen.bench",
+                                      description="Benchmark the dll on synthetic meshes and check its outputs." )
+    parser.add_argument("--dll", help="path of the dhdm_gen library (default: DHDM_GEN_DLL_PATH or the bundled one)")
+    parser.add_argument("--meshes", default=",".join(mesh_kinds), help="base meshes (default: all of {0})".format(mesh_kinds))
+    parser.add_argument("--sizes", default="8,24", help="sizes of the base meshes (default: 8,24)")
+    parser.add_argument("--levels", default="1-3", help="subdivision levels, as 1-5 or 1,3 (default: 1-3)")
+    parser.add_argument("--paths", default=",".join(dhdm_paths),
+                        help=".dhdm generation paths compared (default: all of {0})".format(dhdm_paths))
+    parser.add_argument("--repeat", type=int, default=1, help="runs of every timed stage, the best is kept")
+    parser.add_argument("--threads", type=int, default=0, help="threads of the dll (0: all cores)")
+    parser.add_argument("--baseline-dll", help="library built from the baseline sources: its outputs are compared "
+                                                "with the ones of --dll, and written by --update-golden")
+    parser.add_argument("--golden", help="golden hashes (.json), checked, or written with --update-golden")
+    parser.add_argument("--update-golden", action="store_true",
+                        help="store the hashes of the --baseline-dll outputs of this run in --golden")
+    parser.add_argument("--report", help="write the timings, dll stats and checks to this .json file")
+    parser.add_argument("--work-dir", help="directory of the generated files, kept (default: a temporary one, deleted)")
+    args = parser.parse_args(argv)
+
+    if args.dll:
+        dll_wrapper.DHDM_DLL_Wrapper.dll_path = os.path.abspath(args.dll)
+    kinds = [ k for k in args.meshes.split(",") if k ]
+    paths = [ p for p in args.paths.split(",") if p ]
+    for k in kinds:
+        if k not in mesh_makers:
+            parser.error("unknown mesh \"{0}\"".format(k))
+    for p in paths:
+        if p not in dhdm_paths:
+            parser.error("unknown path \"{0}\"".format(p))
+    if args.update_golden and not (args.golden and args.baseline_dll):
+        parser.error("--update-golden needs --golden and --baseline-dll")
+
+    scanner_errors = check_dsf_scanner()
+    for e in scanner_errors:
+        print("FAILED: {0}".format(e))
+
+    try:
+        golden = read_golden(args.golden, args.update_golden)
+        w = dll_wrapper.DHDM_DLL_Wrapper()
+        baseline_dll = load_baseline_dll(args.baseline_dll) if args.baseline_dll else None
+    except (OSError, ValueError, RuntimeError, AttributeError) as e:
+        print(e)
+        return 2
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="dhdm_bench_")
+    t0 = time.perf_counter()
+    cases = []
+    try:
+        for kind in kinds:
+            for size in parse_int_list(args.sizes):
+                base_arrays = mesh_makers[kind](size)
+                for level in parse_int_list(args.levels):
+                    case = Case(kind, size, level, work_dir)
+                    try:
+                        run_case(case, w, base_arrays, paths, max(args.repeat, 1), args.threads, baseline_dll)
+                    except (OSError, RuntimeError) as e:
+                        case.errors.append(str(e))
+                    if args.golden:
+                        check_golden(case, golden, args.update_golden)
+                    cases.append(case)
+                    print_case(case)
+                    if not args.work_dir:
+                        shutil.rmtree(case.dir, ignore_errors=True)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    seconds = time.perf_counter() - t0
+    failed = [ c for c in cases if c.errors ]
+    print("\n{0} cases, {1} failed ({2:.1f} s).".format(len(cases), len(failed), seconds))
+    if args.update_golden:
+        if failed or scanner_errors:
+            print("Golden file \"{0}\" not updated (failed checks).".format(args.golden))
+        else:
+            write_golden(args.golden, golden)
+    if args.report:
+        core.j_to_json_file( args.report, { "dll": dll_wrapper.DHDM_DLL_Wrapper.dll_path,
+                                            "seconds": round(seconds, 3),
+                                            "failed": len(failed),
+                                            "scanner_errors": scanner_errors,
+                                            "cases": [ c.as_dict() for c in cases ] },
+                             with_gzip=False, indent=1 )
+    return 1 if (failed or scanner_errors) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+# On disk cache of intermediate meshes (e.g. the base mesh subdivided without hd edits), keyed by
+# core.get_mesh_hash() of what they are derived from. bpy-free.
+#
+# Entries are arrays in files "<key>.npz" in the cache directory. Reading an entry updates its modification
+# time, the least recently used entries are deleted when the directory grows over max_bytes.
+import os, uuid
+import numpy as np
+
+
+class ArtifactCache:
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_filepath(self, key, ext):
+        return os.path.join(self.cache_dir, "{0}.{1}".format(key, ext))
+
+    def get(self, key, ext):
+        fp = self.get_filepath(key, ext)
+        try:
+            os.utime(fp)
+        except OSError:
+            return None
+        return fp
+
+    def get_arrays(self, key):
+        fp = self.get(key, "npz")
+        if fp is None:
+            return None
+        try:
+            with np.load(fp) as f:
+                return tuple( f["arr_{0}".format(i)] for i in range(len(f.files)) )
+        except (OSError, ValueError, KeyError) as e:
+            print("Invalid cache entry \"{0}\" ({1}), ignored.".format(fp, e))
+            return None
+
+    def put_arrays(self, key, arrays):
+        # written to a temporary file first, so other processes never see partial entries
+        fp = self.get_filepath(key, "npz")
+        fp_tmp = "{0}.{1}.tmp".format(fp, uuid.uuid4().hex)
+        with open(fp_tmp, "wb") as f:
+            np.savez(f, *arrays)
+        os.replace(fp_tmp, fp)
+        self.evict()
+        return fp
+
+    def evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.cache_dir) as it:
+            for e in it:
+                if not e.is_file() or e.name.endswith(".tmp"):
+                    continue
+                st = e.stat()
+                entries.append( (st.st_mtime, st.st_size, e.path) )
+                total += st.st_size
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        # the most recently used entry is always kept
+        for mtime, size, fp in entries[:-1]:
+            try:
+                os.remove(fp)
+            except OSError:
+                # in use (Windows) or removed by another process
+                continue
+            print("Cache: evicted \"{0}\" ({1} MB).".format(os.path.basename(fp), size >> 20))
+            total -= size
+            if total <= self.max_bytes:
+                break
@@ -0,0 +1,324 @@
+# Batch generation of .dhdm (and .dsf) files from a manifest, without the UI.
+#
+# Pre-exported meshes (plain Python over the dll, no Blender needed):
+#     python -m daz_dhdm_gen.cli manifest.json
+# Meshes from .blend files (runs the addon's operators, the addon must be installed):
+#     blender -b scene.blend --python path/to/daz_dhdm_gen/cli.py -- manifest.json
+#
+# Manifest (.json, or .toml with Python 3.11+):
+#     {
+#       "defaults": { ... },                    keys used by every entry unless the entry overrides them
+#       "generate_matching": 3,                 blender only: generate missing matching files up to level 3 first
+#       "morphs": [ { "name": "MyMorph", ... }, ... ]
+#     }
+#
+# Entries with "base_mesh" use pre-exported .obj files (in the coordinates of the addon's .obj exports):
+#     base_mesh           base mesh with the base morphs applied (base level of the hd mesh)
+#     hd_base_mesh        base_mesh subdivided to the hd level without hd edits ("_hd_no_edit")
+#     hd_mesh             hd mesh with the edits ("_hd_edit")
+#     level               subdivision level of the hd meshes
+#     matching_files_dir
+#     output_dir ("new_morphs" next to the manifest)
+#     unit_scale (0.01), subdiv_method ("MULTIRES" | "MULTIRES_REC"), num_threads (0), sparse_refine (true),
+#     low_memory_mb (0: off, else the hd mesh is subdivided in pieces of about this many MB)
+#     output_type ("DHDM" | "DSF_TEMPLATE" | "DSF_BASIC"), for .dsf files also: original_base_mesh
+#     (base mesh without morphs), dsf_file_template, morph_daz_directory, parent_url, gzip_level (6)
+#
+# Other entries set the addon's scene properties (base_ob, hd_ob, matching_files_dir, working_dirpath,
+# output_type, ...; "name" sets morph_name) and can open another .blend file first with "blend_file".
+# The files are generated in the addon's "new_morphs" directory of the working directory.
+#
+# "memory_mb" (estimated memory of an entry) is only used by scheduler.py.
+
+import os, sys, json, time, argparse, traceback
+import concurrent.futures
+
+if __package__ in (None, ""):
+    # run as a script by blender --python
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = os.path.basename(os.path.dirname(os.path.abspath(__file__)))
+    import importlib
+    importlib.import_module(__package__)
+
+from . import core
+from . import dll_wrapper
+
+try:
+    import bpy
+except ImportError:
+    bpy = None
+
+
+class ManifestError(Exception):
+    pass
+
+
+def read_manifest(fp):
+    if core.has_extension(fp, "toml"):
+        try:
+            import tomllib
+        except ImportError:
+            raise ManifestError(".toml manifests need Python 3.11+, use .json.")
+        with open(fp, "rb") as f:
+            m = tomllib.load(f)
+    else:
+        with open(fp, "r", encoding="utf-8") as f:
+            m = json.load(f)
+
+    if not isinstance(m.get("morphs"), list):
+        raise ManifestError("Manifest has no \"morphs\" list.")
+    defaults = m.get("defaults", {})
+    entries = []
+    for i, e in enumerate(m["morphs"]):
+        entry = dict(defaults)
+        entry.update(e)
+        if not entry.get("name"):
+            raise ManifestError("Entry {0} has no \"name\".".format(i))
+        entries.append(entry)
+    return m, entries
+
+def entry_path(entry, key, manifest_dir):
+    if key not in entry:
+        raise ManifestError("Entry \"{0}\" has no \"{1}\".".format(entry["name"], key))
+    return os.path.abspath( os.path.join(manifest_dir, os.path.expanduser(entry[key])) )
+
+
+# ---- pre-exported meshes ----
+
+def generate_from_exported(entry, manifest_dir, trace, session):
+    name = entry["name"]
+    gScale = float(entry.get("unit_scale", 0.01))
+    level = int(entry["level"])
+    output_type = entry.get("output_type", 'DHDM')
+    if "output_dir" in entry:
+        output_dir = entry_path(entry, "output_dir", manifest_dir)
+    else:
+        output_dir = os.path.join(manifest_dir, "new_morphs")
+    os.makedirs(output_dir, exist_ok=True)
+
+    with trace.stage("read_obj"):
+        base_arrays = core.read_obj_arrays( entry_path(entry, "base_mesh", manifest_dir) )
+    with trace.stage("matching_lookup"):
+        fingerprint = core.get_mesh_fingerprint( len(base_arrays[0]), base_arrays[1], base_arrays[2] )
+        mfiles = core.MatchedFiles( fingerprint, entry_path(entry, "matching_files_dir", manifest_dir),
+                                    topology_hash=core.get_topology_hash(len(base_arrays[0]), base_arrays[1], base_arrays[2]) )
+        subdiv_method = entry.get("subdiv_method", 'MULTIRES')
+        missing_levels = mfiles.get_missing_levels(level, subdiv_method)
+        if len(missing_levels) > 0:
+            raise ManifestError( "Matching files for levels {0} missing (fingerprint {1}).".format(missing_levels, fingerprint) )
+        filepaths_list = mfiles.get_filepaths(level, subdiv_method)
+
+    outputs = []
+    if output_type != 'DHDM':
+        with trace.stage("dsf"):
+            original_arrays = core.read_obj_arrays( entry_path(entry, "original_base_mesh", manifest_dir) )
+            deltas = core.get_base_morph_deltas(original_arrays[0], base_arrays[0], gScale)
+            dsf_fp_templ = None
+            if output_type == 'DSF_TEMPLATE':
+                dsf_fp_templ = entry_path(entry, "dsf_file_template", manifest_dir)
+            dsf_fp, to_complete = core.write_morph_dsf( output_type, dsf_fp_templ, output_dir, name,
+                                                        len(base_arrays[0]), { "count": len(deltas), "values": deltas },
+                                                        morph_daz_directory=entry.get("morph_daz_directory"),
+                                                        parent_url=entry.get("parent_url"),
+                                                        gzip_level=int(entry.get("gzip_level", 6)),
+                                                        num_threads=int(entry.get("num_threads", 0)) )
+            print("Generated \"{0}\"{1}.".format(dsf_fp, " (to complete)" if to_complete else ""))
+            outputs.append(dsf_fp)
+            del original_arrays, deltas
+
+    with trace.stage("read_obj"):
+        hd_edit_arrays = core.read_obj_arrays( entry_path(entry, "hd_mesh", manifest_dir) )
+        hd_no_edit_positions = core.read_obj_arrays( entry_path(entry, "hd_base_mesh", manifest_dir) )[0]
+    with trace.stage("edited_mask"):
+        edited_mask = core.get_edited_mask( hd_no_edit_positions, hd_edit_arrays[0], gScale )
+    del hd_no_edit_positions
+    trace.count("edited_vertices", int(edited_mask.sum()))
+    dll_stats = {}
+    with trace.stage("dll:generate_dhdm_file_from_buffers"):
+        dll_wrapper.call_dll_function( "generate_dhdm_file_from_buffers",
+                                       gScale, level, output_dir, name, filepaths_list,
+                                       base_arrays, None, hd_edit_arrays,
+                                       int(entry.get("num_threads", 0)), bool(entry.get("sparse_refine", True)),
+                                       session, edited_mask=edited_mask,
+                                       low_memory_mb=int(entry.get("low_memory_mb", 0)), stats=dll_stats )
+    trace.add_dll_stats(dll_stats)
+    outputs.append( os.path.join(output_dir, name + ".dhdm") )
+    return outputs
+
+
+# ---- blender ----
+
+def ensure_addon(package):
+    if hasattr(bpy.types.Scene, "daz_dhdm_gen"):
+        return
+    import addon_utils
+    addon_utils.enable(package, default_set=True)
+    if not hasattr(bpy.types.Scene, "daz_dhdm_gen"):
+        raise ManifestError("Addon \"{0}\" couldn't be enabled.".format(package))
+
+def set_scene_props(entry, manifest_dir):
+    addon_props = bpy.context.scene.daz_dhdm_gen
+    for k, v in entry.items():
+        if k in ("name", "blend_file", "generate_matching", "memory_mb"):
+            continue
+        if not hasattr(addon_props, k):
+            raise ManifestError("Entry \"{0}\": unknown property \"{1}\".".format(entry["name"], k))
+        if k in ("working_dirpath", "matching_files_dir", "dsf_file_template"):
+            v = os.path.abspath( os.path.join(manifest_dir, os.path.expanduser(v)) )
+        setattr(addon_props, k, v)
+    addon_props.morph_name = entry["name"]
+
+def open_blend_file(entry, manifest_dir):
+    if "blend_file" not in entry:
+        return
+    fp = entry_path(entry, "blend_file", manifest_dir)
+    if os.path.normcase(fp) != os.path.normcase(os.path.abspath(bpy.data.filepath or "")):
+        bpy.ops.wm.open_mainfile(filepath=fp)
+
+def generate_in_blender(entry, manifest_dir, trace, max_matching_level):
+    # the operators write their own run reports (in the working directory)
+    with trace.stage("open_blend_file"):
+        open_blend_file(entry, manifest_dir)
+    set_scene_props(entry, manifest_dir)
+    if max_matching_level:
+        with trace.stage("generatematch"):
+            r = bpy.ops.dazdhdmgen.generatematch('EXEC_DEFAULT', hd_level_max=max_matching_level)
+        if 'FINISHED' not in r and 'CANCELLED' not in r:
+            raise RuntimeError("Matching files generation failed.")
+    with trace.stage("generatenewmorph"):
+        r = bpy.ops.dazdhdmgen.generatenewmorph('EXEC_DEFAULT')
+    if 'FINISHED' not in r:
+        raise RuntimeError("Operator failed (see output above).")
+
+    # same layout as GenerateNewMorphFiles: <working dir>/<base object>/new_morphs/<morph>.dsf|.dhdm
+    addon_props = bpy.context.scene.daz_dhdm_gen
+    output_dir = os.path.join( os.path.abspath(bpy.path.abspath(addon_props.working_dirpath)),
+                               core.makeValidFilename(addon_props.base_ob), "new_morphs" )
+    name = addon_props.morph_name.strip()
+    return [ fp for fp in (os.path.join(output_dir, name + ".dsf"), os.path.join(output_dir, name + ".dhdm"))
+             if os.path.isfile(fp) ]
+
+
+def get_peak_rss_mb():
+    # peak resident memory of this process (dll included) in MB, None where unknown (Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return (rss >> 20) if sys.platform == "darwin" else (rss >> 10)
+
+def write_summary(fp, manifest_fp, results, seconds):
+    summary = { "manifest": os.path.abspath(manifest_fp),
+                "seconds": round(seconds, 3),
+                "generated": sum(1 for r in results if r["status"] == "ok"),
+                "failed": sum(1 for r in results if r["status"] != "ok"),
+                "entries": results }
+    core.j_to_json_file(fp, summary, with_gzip=False, indent=1)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+        if "--" in sys.argv:
+            argv = sys.argv[sys.argv.index("--") + 1:]
+
+    parser = argparse.ArgumentParser( prog="daz_dhdm_gen.cli",
+                                      description="Generate .dhdm/.dsf files for the morphs listed in a manifest." )
+    parser.add_argument("manifest", help="manifest file (.json or .toml)")
+    parser.add_argument("--dll", help="path of the dhdm_gen library (default: DHDM_GEN_DLL_PATH or the bundled one)")
+    parser.add_argument("--jobs", type=int, default=1, help="pre-exported entries generated at the same time")
+    parser.add_argument("--session-cache-mb", type=int, default=1024,
+                        help="memory of the dll session shared by the entries (0: no session)")
+    parser.add_argument("--stop-on-error", action="store_true", help="stop at the first failed entry")
+    parser.add_argument("--base-dir", help="directory the relative paths of the manifest are relative to "
+                                           "(default: the manifest's directory)")
+    parser.add_argument("--summary", help="write the results (outputs, timings, errors) to this .json file")
+    args = parser.parse_args(argv)
+
+    if args.dll:
+        dll_wrapper.DHDM_DLL_Wrapper.dll_path = os.path.abspath(args.dll)
+    manifest_dir = os.path.abspath(args.base_dir or os.path.dirname(os.path.abspath(args.manifest)))
+    try:
+        manifest, entries = read_manifest(args.manifest)
+    except (OSError, ValueError, ManifestError) as e:
+        print("Invalid manifest \"{0}\": {1}".format(args.manifest, e))
+        return 2
+
+    exported = [ e for e in entries if "base_mesh" in e ]
+    in_blender = [ e for e in entries if "base_mesh" not in e ]
+    if len(in_blender) > 0 and bpy is None:
+        print("{0} entries need Blender (no \"base_mesh\"), run this with blender -b.".format(len(in_blender)))
+        return 2
+
+    t0 = time.perf_counter()
+    results = []
+
+    def run(entry, func, *func_args):
+        print("\n==== {0} ====".format(entry["name"]))
+        result = { "name": entry["name"], "status": "ok", "outputs": [], "error": None }
+        t_entry = time.perf_counter()
+        trace = core.RunTrace(entry["name"])
+        try:
+            result["outputs"] = func(entry, manifest_dir, trace, *func_args)
+        except Exception as e:
+            traceback.print_exc()
+            result["status"] = "failed"
+            result["error"] = str(e)
+        result["seconds"] = round(time.perf_counter() - t_entry, 3)
+        report = trace.as_dict(result["status"], result["error"])
+        for k in ("stages", "counters", "dll"):
+            result[k] = report[k]
+        # the process' peak so far, an upper bound of the entry's
+        result["peak_rss_mb"] = get_peak_rss_mb()
+        results.append(result)
+        return result["status"] == "ok"
+
+    def has_failed():
+        return any(r["status"] != "ok" for r in results)
+
+    if len(exported) > 0:
+        try:
+            session = dll_wrapper.get_session(args.session_cache_mb)
+        except (OSError, RuntimeError) as e:
+            print("Failed to load the dll: {0}".format(e))
+            return 2
+        try:
+            if args.jobs <= 1:
+                for e in exported:
+                    if not run(e, generate_from_exported, session) and args.stop_on_error:
+                        break
+            else:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+                    futures = [ executor.submit(run, e, generate_from_exported, session) for e in exported ]
+                    for f in concurrent.futures.as_completed(futures):
+                        if not f.result() and args.stop_on_error:
+                            # entries not started yet are dropped, the running ones finish
+                            n = sum( 1 for fut in futures if fut.cancel() )
+                            if n > 0:
+                                print("Stopping on error: {0} entries not generated.".format(n))
+                            break
+        finally:
+            dll_wrapper.close_session()
+
+    if len(in_blender) > 0 and not (has_failed() and args.stop_on_error):
+        ensure_addon(__package__)
+        max_matching_level = manifest.get("generate_matching")
+        for e in in_blender:
+            if not run(e, generate_in_blender, max_matching_level) and args.stop_on_error:
+                break
+
+    seconds = time.perf_counter() - t0
+    failed = [ r for r in results if r["status"] != "ok" ]
+    print("\n{0} generated, {1} failed ({2:.1f} s).".format(len(results) - len(failed), len(failed), seconds))
+    for r in failed:
+        print("  {0}: {1}".format(r["name"], r["error"]))
+    if args.summary:
+        write_summary(args.summary, args.manifest, results, seconds)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    r = main()
+    if bpy is None or bpy.app.background:
+        sys.exit(r)
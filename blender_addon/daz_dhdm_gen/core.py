@@ -0,0 +1,995 @@
+# bpy-free helpers (files, matching files, .dsf/.dhdm), usable outside Blender (see cli.py).
+import os, io, gzip, zlib, json, re, shutil, struct, hashlib, atexit, collections, time, contextlib, cProfile
+import concurrent.futures
+import numpy as np
+from urllib.parse import unquote, quote
+
+
+def has_extension(filepath, *exts):
+    assert(len(exts) > 0)
+    t = os.path.basename(filepath).rsplit(".", 1)
+    return (len(t) == 2 and t[1].lower() in exts)
+
+def get_extension(filepath):
+    t = os.path.basename(filepath).rsplit(".", 1)
+    if len(t) != 2:
+        return None
+    return t[1].lower()
+
+def remove_extension(filename):
+    t = filename.rsplit(".", 1)
+    return t[0].strip()
+
+def makeValidFilename(name):
+    name = name.strip().lower()
+    return "".join( c for c in name if (c.isalnum() or c in "._- ") )
+
+def read_dhdm_level(dhdm_fp):
+    if not os.path.isfile(dhdm_fp):
+        raise ValueError("File \"{}\" not found.".format(dhdm_fp))
+    with open(dhdm_fp, "rb") as f:
+        h = f.read(8)
+    return int.from_bytes(h[4:], byteorder='little', signed=False)
+
+def is_gzip_file(fp):
+    with open(fp, "rb") as f:
+        return f.read(2) == b'\x1f\x8b'
+
+def get_dsf_json(dsf_fp):
+    j = None
+    if is_gzip_file(dsf_fp):
+        with gzip.open(dsf_fp, "rt", encoding="utf-8") as f:
+            j = json.loads(f.read())
+    else:
+        with open(dsf_fp, "r", encoding="utf-8") as f:
+            j = json.loads(f.read())
+    return j
+
+class JsonScanner:
+    # Forward-only scanner of a JSON text read in blocks from a text file object: values are read
+    # one at a time and the ones that aren't needed are skipped without being decoded (numbers and
+    # nested arrays are skipped by the regular expressions, so large arrays like a morph's deltas
+    # cost little).
+    block_size = 1 << 18
+
+    re_separators = re.compile(r'[\s,:]*')
+    re_string = re.compile(r'"(?:[^"\\]|\\.)*"', re.S)
+    re_scalar = re.compile(r'[^\s,:\]}]*')
+    # up to the next string or brace, arrays of numbers included (only used inside the skipped value,
+    # so these nested arrays are always balanced by it)
+    re_skip = re.compile(r'[^"\[\]{}]*(?:\[[^"\[\]{}]*\][^"\[\]{}]*)*')
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self):
+        if self.eof:
+            return False
+        data = self.f.read(self.block_size)
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        # next significant character, "" at the end
+        while True:
+            self.pos = self.re_separators.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.read_more():
+                return ""
+
+    def match_string(self):
+        while True:
+            m = self.re_string.match(self.buf, self.pos)
+            if m is not None:
+                self.pos = m.end()
+                return m
+            if not self.read_more():
+                raise ValueError("Invalid JSON: unterminated string.")
+
+    def match_scalar(self):
+        while True:
+            m = self.re_scalar.match(self.buf, self.pos)
+            if m.end() < len(self.buf) or not self.read_more():
+                break
+        self.pos = m.end()
+        return m
+
+    def value(self):
+        # strings and scalars are decoded, objects and arrays are skipped (None)
+        c = self.peek()
+        if c == '"':
+            return json.loads(self.match_string().group(0))
+        if c in ("{", "["):
+            self.skip()
+            return None
+        if c == "":
+            raise ValueError("Invalid JSON: unexpected end.")
+        return json.loads(self.match_scalar().group(0))
+
+    def skip(self):
+        c = self.peek()
+        if c == '"':
+            self.match_string()
+            return
+        if c not in ("{", "["):
+            self.match_scalar()
+            return
+        self.pos += 1
+        depth = 1
+        while True:
+            self.pos = self.re_skip.match(self.buf, self.pos).end()
+            if self.pos >= len(self.buf):
+                if not self.read_more():
+                    raise ValueError("Invalid JSON: unexpected end.")
+                continue
+            c = self.buf[self.pos]
+            if c == '"':
+                self.match_string()
+                continue
+            self.pos += 1
+            depth += 1 if c in ("{", "[") else -1
+            if depth == 0:
+                return
+
+    def keys(self):
+        # generator of the keys of the object at the current position, each key's value must be
+        # read or skipped before the next one
+        if self.peek() != "{":
+            raise ValueError("Invalid JSON: object expected.")
+        self.pos += 1
+        while True:
+            c = self.peek()
+            if c == "}":
+                self.pos += 1
+                return
+            if c != '"':
+                raise ValueError("Invalid JSON: key expected.")
+            yield json.loads(self.match_string().group(0))
+
+    def items(self):
+        # generator of the indices of the array at the current position, like keys()
+        if self.peek() != "[":
+            raise ValueError("Invalid JSON: array expected.")
+        self.pos += 1
+        i = 0
+        while True:
+            c = self.peek()
+            if c == "]":
+                self.pos += 1
+                return
+            if c == "":
+                raise ValueError("Invalid JSON: unexpected end.")
+            yield i
+            i += 1
+
+def scan_dsf_metadata(f):
+    # id, morph's vertex_count and hd_url of modifier_library[0] (None if missing), the scan stops there.
+    # ValueError if the text is invalid or ends before, or if the structure isn't the expected one (the
+    # metadata of dsf_metadata_from_json() may differ then).
+    meta = { "id": None, "vertex_count": None, "hd_url": None }
+    sc = JsonScanner(f)
+
+    def field_value():
+        if sc.peek() in ("{", "["):
+            raise ValueError("Unexpected .dsf structure: object or array as metadata value.")
+        return sc.value()
+
+    for key in sc.keys():
+        if key != "modifier_library":
+            sc.skip()
+            continue
+        for i in sc.items():
+            for k in sc.keys():
+                if k == "id":
+                    meta["id"] = field_value()
+                elif k == "morph":
+                    for mk in sc.keys():
+                        if mk in ("vertex_count", "hd_url"):
+                            meta[mk] = field_value()
+                        else:
+                            sc.skip()
+                else:
+                    sc.skip()
+            break
+        break
+    return meta
+
+def dsf_metadata_from_json(dsf_j):
+    # same as scan_dsf_metadata(), from the parsed file
+    meta = { "id": None, "vertex_count": None, "hd_url": None }
+    try:
+        modif = dsf_j["modifier_library"][0]
+    except (KeyError, IndexError, TypeError):
+        return meta
+    if not isinstance(modif, dict):
+        return meta
+    meta["id"] = modif.get("id")
+    morph = modif.get("morph")
+    if isinstance(morph, dict):
+        meta["vertex_count"] = morph.get("vertex_count")
+        meta["hd_url"] = morph.get("hd_url")
+    return meta
+
+def read_dsf_metadata_uncached(dsf_fp):
+    # missing fields (e.g. .dsf files without hd morph) are trusted once the scan has read
+    # modifier_library[0] (or the whole file without it), only the files it can't read are parsed
+    try:
+        if is_gzip_file(dsf_fp):
+            with gzip.open(dsf_fp, "rt", encoding="utf-8") as f:
+                return scan_dsf_metadata(f)
+        with open(dsf_fp, "r", encoding="utf-8") as f:
+            return scan_dsf_metadata(f)
+    except (ValueError, EOFError):
+        return dsf_metadata_from_json( get_dsf_json(dsf_fp) )
+
+
+class DsfMetadataCache:
+    # Metadata of .dsf files (see scan_dsf_metadata()) by absolute path, valid while the file's size
+    # and modification time don't change. Kept in memory (the max_entries least recently used) and,
+    # once set_index_file() is called, in a json index file saved every save_every new entries and
+    # at exit. Index files of another version (older scanners) are ignored.
+    save_every = 256
+    version = 2
+
+    def __init__(self, max_entries=65536):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.index_fp = None
+        self.unsaved_n = 0
+
+    def set_index_file(self, index_fp):
+        if index_fp == self.index_fp:
+            return
+        if self.index_fp is None:
+            atexit.register(self.save)
+        else:
+            self.save()
+        self.index_fp = index_fp
+        try:
+            with open(index_fp, "r", encoding="utf-8") as f:
+                j = json.load(f)
+            if j.get("version") != self.version:
+                j = { "entries": {} }
+            for fp, e in j["entries"].items():
+                if fp not in self.entries:
+                    self.entries[fp] = ( e["size"], e["mtime_ns"], e["meta"] )
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print("Invalid .dsf index \"{0}\" ({1}), ignored.".format(index_fp, e))
+        self.trim()
+
+    def get(self, dsf_fp):
+        fp = os.path.abspath(dsf_fp)
+        st = os.stat(fp)
+        e = self.entries.get(fp)
+        if e is not None and e[0] == st.st_size and e[1] == st.st_mtime_ns:
+            self.entries.move_to_end(fp)
+            return e[2]
+        meta = read_dsf_metadata_uncached(fp)
+        self.entries[fp] = ( st.st_size, st.st_mtime_ns, meta )
+        self.entries.move_to_end(fp)
+        self.trim()
+        self.unsaved_n += 1
+        if self.unsaved_n >= self.save_every:
+            self.save()
+        return meta
+
+    def trim(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        if self.index_fp is None or self.unsaved_n == 0:
+            return
+        j = { "version": self.version,
+              "entries": { fp: { "size": e[0], "mtime_ns": e[1], "meta": e[2] }
+                           for fp, e in self.entries.items() } }
+        fp_tmp = "{0}.{1}.tmp".format(self.index_fp, os.getpid())
+        try:
+            with open(fp_tmp, "w", encoding="utf-8") as f:
+                json.dump(j, f)
+            os.replace(fp_tmp, self.index_fp)
+            self.unsaved_n = 0
+        except OSError as e:
+            print("Can't save .dsf index \"{0}\" ({1}).".format(self.index_fp, e))
+
+dsf_metadata_cache = DsfMetadataCache()
+
+def read_dsf_metadata(dsf_fp):
+    return dsf_metadata_cache.get(dsf_fp)
+
+def read_dsf_level(dsf_fp):
+    dhdm = read_dsf_metadata(dsf_fp)["hd_url"]
+    if dhdm is None:
+        return 0
+    dhdm_fp = os.path.join( os.path.dirname(dsf_fp), os.path.basename(dhdm) )
+    dhdm_fp = unquote(dhdm_fp)
+    return read_dhdm_level(dhdm_fp)
+
+def read_dsf_id(dsf_fp, only_with_dhdm=False):
+    meta = read_dsf_metadata(dsf_fp)
+    if only_with_dhdm and meta["hd_url"] is None:
+        return None
+    return meta["id"]
+
+def dsf_vcount(dsf_fp):
+    return read_dsf_metadata(dsf_fp)["vertex_count"]
+
+def get_file_id(filepath):
+    filename = os.path.basename(filepath).rsplit(".",1)[0]
+
+    if has_extension(filepath, "dhdm"):
+        dsf_fp = os.path.join(os.path.dirname(filepath), filename + ".dsf")
+        if not os.path.isfile(dsf_fp):
+            return filename
+        filepath = dsf_fp
+    elif not has_extension(filepath, "dsf"):
+        raise ValueError("File \"{0}\" is not .dsf or .dhdm file.".format(filepath))
+
+    dsf_id = read_dsf_id(filepath)
+    if dsf_id is not None:
+        return dsf_id
+    return filename
+
+def get_info_from_filename(filename):
+    # the topology hash suffix only keeps files of meshes with the same fingerprint apart,
+    # the hash in the header is the one checked
+    r = re.search(r'^f(\d+-\d+-\d+)_div(\d)_(mr|mrr)(?:_[0-9a-f]{16})?\.(json|bin)$', filename)
+    if r is None:
+        return None, None, None, None
+    return r.group(1), int(r.group(2)), r.group(3), r.group(4)
+
+def get_matching_filename(fingerprint, level, mrm, ext="bin", topology_hash=0):
+    if topology_hash:
+        return "f{0}_div{1}_{2}_{3:016x}.{4}".format(fingerprint, level, mrm, topology_hash, ext)
+    return "f{0}_div{1}_{2}.{3}".format(fingerprint, level, mrm, ext)
+
+
+# Binary matching files (little-endian): header followed by "count" uint32 indices.
+# Version 1 header: 32 bytes, version 2 adds the uint64 topology hash of the base mesh (0: unknown).
+# Must match VertexMatching in the dll (matching.hh).
+MATCHING_MAGIC = b"DHMF"
+MATCHING_VERSION = 2
+matching_header_struct = struct.Struct("<4s7IQ")
+matching_header_struct_v1 = struct.Struct("<4s7I")
+matching_methods = ("mr", "mrr")
+
+def write_matching_file(fp, indices, fingerprint, level, mrm, topology_hash=0):
+    indices = np.ascontiguousarray(indices, dtype="<u4")
+    fp_vertices, fp_edges, fp_faces = ( int(n) for n in fingerprint.split("-") )
+    header = matching_header_struct.pack( MATCHING_MAGIC, MATCHING_VERSION, level,
+                                          matching_methods.index(mrm),
+                                          fp_vertices, fp_edges, fp_faces, len(indices),
+                                          topology_hash )
+    fp_tmp = fp + ".tmp"
+    with open(fp_tmp, "wb") as f:
+        f.write(header)
+        f.write(indices.tobytes())
+    os.replace(fp_tmp, fp)
+
+def is_binary_matching_file(fp):
+    with open(fp, "rb") as f:
+        return f.read(4) == MATCHING_MAGIC
+
+def read_matching_file_header(fp):
+    with open(fp, "rb") as f:
+        data = f.read(matching_header_struct.size)
+    if len(data) < matching_header_struct_v1.size:
+        raise ValueError("File \"{0}\" is not a valid matching file.".format(fp))
+    magic, version, level, method, fp_v, fp_e, fp_f, count = matching_header_struct_v1.unpack_from(data)
+    if magic != MATCHING_MAGIC or version not in (1, MATCHING_VERSION) or method >= len(matching_methods):
+        raise ValueError("File \"{0}\" is not a valid matching file.".format(fp))
+    topology_hash = 0
+    header_size = matching_header_struct_v1.size
+    if version >= 2:
+        if len(data) < matching_header_struct.size:
+            raise ValueError("File \"{0}\" is not a valid matching file.".format(fp))
+        topology_hash = matching_header_struct.unpack(data)[-1]
+        header_size = matching_header_struct.size
+    return { "level": level, "mrm": matching_methods[method],
+             "fingerprint": "{0}-{1}-{2}".format(fp_v, fp_e, fp_f), "count": count,
+             "topology_hash": topology_hash, "header_size": header_size }
+
+def read_matching_file(fp):
+    if not is_binary_matching_file(fp):
+        return read_legacy_matching_file(fp)
+    h = read_matching_file_header(fp)
+    indices = np.fromfile(fp, dtype="<u4", count=h["count"], offset=h["header_size"])
+    if len(indices) != h["count"]:
+        raise ValueError("File \"{0}\" is truncated.".format(fp))
+    return indices
+
+def read_legacy_matching_file(fp):
+    d_vn = get_dsf_json(fp)
+    indices = np.full(len(d_vn), -1, dtype=np.int64)
+    for k, v in d_vn.items():
+        indices[int(k)] = v
+    if (indices < 0).any():
+        raise ValueError("File \"{0}\" is not a valid matching file.".format(fp))
+    return indices.astype("<u4")
+
+def convert_legacy_matching_file(fp):
+    fingerprint, level, mrm, ext = get_info_from_filename(os.path.basename(fp))
+    if ext != "json":
+        raise ValueError("File \"{0}\" is not a legacy matching file.".format(fp))
+    fp_bin = os.path.join( os.path.dirname(fp), get_matching_filename(fingerprint, level, mrm) )
+    write_matching_file(fp_bin, read_legacy_matching_file(fp), fingerprint, level, mrm)
+    return fp_bin
+
+def copy_file(fp, target_dir, target_filename=None):
+    if not os.path.isdir(target_dir):
+        raise ValueError("Directory \"{0}\" not found.".format(target_dir))
+    if not os.path.isfile(fp):
+        raise ValueError("File \"{0}\" not found.".format(fp))
+
+    if target_filename is None:
+        target_fp = os.path.join(target_dir, os.path.basename(fp))
+    else:
+        ext = get_extension(fp)
+        target_fp = os.path.join(target_dir, "{0}.{1}".format(target_filename, ext))
+
+    new_fp = shutil.copyfile( fp, target_fp )
+    return new_fp
+
+def text_to_json_file(fp, text, with_gzip=True, indent=None, gzip_level=6, num_threads=0):
+    j = json.loads(text)
+    j_to_json_file(fp, j, with_gzip=with_gzip, indent=indent, gzip_level=gzip_level, num_threads=num_threads)
+
+def j_to_json_file(fp, j, with_gzip=True, indent=None, gzip_level=6, num_threads=0):
+    # encoded at once (json.dump() to a file encodes in small pieces, in Python)
+    text = json.dumps(j, indent=indent)
+    with open_text_output(fp, with_gzip=with_gzip, gzip_level=gzip_level, num_threads=num_threads) as f:
+        f.write(text)
+
+
+class ParallelGzipWriter(io.BufferedIOBase):
+    # Binary file object writing a gzip file, deflating block_size blocks of the data on a thread pool
+    # (zlib releases the GIL). As in pigz, each block is primed with the last 32 KiB of the previous one and
+    # ends with a sync flush, so the blocks form a single deflate stream: the file is a regular one-member
+    # gzip file (readable by gzip.open(), boost's gzip_decompressor and DAZ Studio).
+    # num_threads 0: all cores.
+    block_size = 1 << 20
+    window_size = 1 << 15
+
+    def __init__(self, fp, level=6, num_threads=0):
+        super().__init__()
+        self.level = level
+        num_threads = num_threads if num_threads > 0 else (os.cpu_count() or 1)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_threads)
+        self.max_pending = 2 * num_threads
+        self.pending = collections.deque()
+        self.buf = bytearray()
+        self.prev_tail = b""
+        self.crc = 0
+        self.size = 0
+        self.f = open(fp, 'wb')
+        xfl = 2 if level == 9 else (4 if level == 1 else 0)
+        self.f.write( struct.pack("<BBBBIBB", 0x1f, 0x8b, 8, 0, int(time.time()), xfl, 255) )
+
+    @staticmethod
+    def deflate_block(data, zdict, level, last):
+        if len(zdict) > 0:
+            c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+        else:
+            c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return c.compress(data) + c.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    def submit_block(self, data, last=False):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.pending.append( self.executor.submit(self.deflate_block, data, self.prev_tail, self.level, last) )
+        self.prev_tail = data[-self.window_size:]
+        while len(self.pending) > self.max_pending:
+            self.f.write( self.pending.popleft().result() )
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self.closed:
+            raise ValueError("write to closed file")
+        n = len(b)
+        mv = memoryview(b)
+        if len(self.buf) > 0:
+            k = self.block_size - len(self.buf)
+            self.buf += mv[:k]
+            mv = mv[k:]
+            if len(self.buf) < self.block_size:
+                return n
+            self.submit_block( bytes(self.buf) )
+            self.buf = bytearray()
+        while len(mv) >= self.block_size:
+            self.submit_block( bytes(mv[:self.block_size]) )
+            mv = mv[self.block_size:]
+        self.buf += mv
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.submit_block( bytes(self.buf), last=True )
+            self.buf = bytearray()
+            while len(self.pending) > 0:
+                self.f.write( self.pending.popleft().result() )
+            self.f.write( struct.pack("<II", self.crc & 0xffffffff, self.size & 0xffffffff) )
+        finally:
+            for fut in self.pending:
+                fut.cancel()
+            self.executor.shutdown()
+            self.f.close()
+            super().close()
+
+def open_text_output(fp, with_gzip=True, gzip_level=6, num_threads=0):
+    # Text file object writing fp (utf-8), gzipped in parallel with with_gzip.
+    if with_gzip:
+        return io.TextIOWrapper( ParallelGzipWriter(fp, level=gzip_level, num_threads=num_threads), encoding="utf-8" )
+    return open(fp, 'w', encoding="utf-8")
+
+
+class JsonBlocks:
+    # Large list in a structure written by write_json(), encoded block_items items at a time
+    # instead of as a single text.
+    block_items = 8192
+
+    def __init__(self, items):
+        self.items = items
+        self.token = "@json-blocks-{0}@".format(id(self))
+
+    def iter_text(self):
+        yield "["
+        for i in range(0, len(self.items), self.block_items):
+            if i > 0:
+                yield ","
+            yield json.dumps(self.items[i:i+self.block_items], separators=(",", ":"))[1:-1]
+        yield "]"
+
+def write_json(fp, j, with_gzip=True, gzip_level=6, num_threads=0):
+    # Compact json, encoded once by the C encoder (json.dump() to a file isn't), with the JsonBlocks
+    # in j streamed to the file in blocks.
+    blocks = {}
+    def encode_blocks(o):
+        if isinstance(o, JsonBlocks):
+            blocks[o.token] = o
+            return o.token
+        raise TypeError("Object of type {0} is not JSON serializable".format(type(o).__name__))
+    text = json.dumps(j, separators=(",", ":"), default=encode_blocks)
+
+    with open_text_output(fp, with_gzip=with_gzip, gzip_level=gzip_level, num_threads=num_threads) as f:
+        pos = 0
+        for m in re.finditer(r'"(@json-blocks-\d+@)"', text):
+            b = blocks.get(m.group(1))
+            if b is None:
+                continue
+            f.write(text[pos:m.start()])
+            for t in b.iter_text():
+                f.write(t)
+            pos = m.end()
+        f.write(text[pos:])
+
+def replace_json_ids(j, ids, new_id):
+    # Replaces the ids (as whole words) in the string values of j, in place.
+    # Other values (numbers, JsonBlocks) are not visited.
+    ids = sorted( { i for i in ids if i }, key=len, reverse=True )
+    if len(ids) == 0:
+        return
+    exp = re.compile( r"(?<!\w)(?:{0})(?!\w)".format( "|".join(re.escape(i) for i in ids) ) )
+    def walk(o):
+        items = o.items() if isinstance(o, dict) else enumerate(o)
+        for k, v in items:
+            if isinstance(v, str):
+                new_v = exp.sub(lambda m: new_id, v)
+                if new_v != v:
+                    o[k] = new_v
+            elif isinstance(v, (dict, list)):
+                walk(v)
+    walk(j)
+
+
+def get_fingerprint_from_counts(vertices_n, edges_n, faces_n):
+    return "{0}-{1}-{2}".format(vertices_n, edges_n, faces_n)
+
+def get_topology_hash(vertices_n, face_vert_counts, face_vert_indices):
+    # 64 bits hash of the faces (unlike the fingerprint, tells apart meshes with the same counts), never 0
+    h = hashlib.blake2b(digest_size=8)
+    h.update( struct.pack("<Q", vertices_n) )
+    h.update( np.ascontiguousarray(face_vert_counts, dtype="<i4").tobytes() )
+    h.update( np.ascontiguousarray(face_vert_indices, dtype="<i4").tobytes() )
+    return int.from_bytes(h.digest(), "little") or 1
+
+def get_mesh_hash(positions, face_vert_counts, face_vert_indices, *settings):
+    # content hash (hex) of a mesh given as arrays and the settings of what is derived from it
+    h = hashlib.blake2b(digest_size=16)
+    h.update( np.ascontiguousarray(positions, dtype="<f4").tobytes() )
+    h.update( struct.pack("<Q", get_topology_hash(len(positions), face_vert_counts, face_vert_indices)) )
+    h.update( repr(settings).encode("utf-8") )
+    return h.hexdigest()
+
+def get_edited_mask(no_edit_positions, edit_positions, gScale, min_len=1e-6, decimals=6):
+    # bool array, True for the hd mesh vertices moved by the hd edits: by more than min_len (in daz's units)
+    # and than half the resolution of the .obj files (decimals) the dll compared before, so differences of
+    # a few float32 steps between the two subdivisions aren't edits.
+    if len(no_edit_positions) != len(edit_positions):
+        raise ValueError( "Vertex count mismatch between the hd meshes with and without edits: {0}, {1}.".format(
+                            len(no_edit_positions), len(edit_positions)) )
+    d = np.asarray(edit_positions, dtype=np.float64) - np.asarray(no_edit_positions, dtype=np.float64)
+    tolerance = max( min_len * gScale, 0.5 * 10.0 ** -decimals )
+    return np.einsum("ij,ij->i", d, d) > tolerance ** 2
+
+def get_mesh_fingerprint(vertices_n, face_vert_counts, face_vert_indices):
+    # same as utils.get_fingerprint() for a mesh given as arrays (edges are counted from the faces)
+    face_vert_counts = np.asarray(face_vert_counts, dtype=np.int64)
+    face_vert_indices = np.asarray(face_vert_indices, dtype=np.int64)
+    starts = np.repeat( np.cumsum(face_vert_counts) - face_vert_counts, face_vert_counts )
+    pos = np.arange(len(face_vert_indices)) - starts
+    nxt = starts + (pos + 1) % np.repeat(face_vert_counts, face_vert_counts)
+    a = face_vert_indices
+    b = face_vert_indices[nxt]
+    edges = np.unique( np.minimum(a, b) * (vertices_n + 1) + np.maximum(a, b) )
+    return get_fingerprint_from_counts(vertices_n, len(edges), len(face_vert_counts))
+
+def read_obj_arrays(fp):
+    # Positions and faces of an .obj file as arrays (like utils.get_mesh_arrays()):
+    # (positions float32 (n, 3), face_vert_counts int32, face_vert_indices int32).
+    positions = []
+    face_vert_counts = []
+    face_vert_indices = []
+    with open(fp, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("v "):
+                positions.append( line.split()[1:4] )
+            elif line.startswith("f "):
+                face = [ int(t.split("/", 1)[0]) for t in line.split()[1:] ]
+                face_vert_counts.append(len(face))
+                face_vert_indices.extend(face)
+    positions = np.array(positions, dtype=np.float32).reshape(-1, 3)
+    face_vert_indices = np.array(face_vert_indices, dtype=np.int64)
+    # .obj indices are 1-based, negative ones are relative to the end
+    face_vert_indices = np.where( face_vert_indices < 0, face_vert_indices + len(positions), face_vert_indices - 1 )
+    return ( np.ascontiguousarray(positions),
+             np.array(face_vert_counts, dtype=np.int32),
+             np.ascontiguousarray(face_vert_indices, dtype=np.int32) )
+
+def get_base_morph_deltas(base_positions, morphed_positions, gScale, min_len=1e-3):
+    # [[vi, dx, dy, dz], ...] in daz's units, positions in daz's axes (as exported to .obj files)
+    deltas = (np.asarray(morphed_positions, dtype=np.float64) - np.asarray(base_positions, dtype=np.float64)) / gScale
+    vis = np.flatnonzero( np.einsum("ij,ij->i", deltas, deltas) > min_len * min_len )
+    return [ [ i, *d ] for i, d in zip( vis.tolist(), deltas[vis].tolist() ) ]
+
+
+basic_dsf_template = os.path.join(os.path.dirname(__file__), "other_files", "dhdmGenHDMorph.dsf")
+
+def write_morph_dsf( output_type, dsf_fp_templ, output_dir, morph_name, base_vcount, base_morph_info,
+                     morph_daz_directory=None, parent_url=None, gzip_level=6, num_threads=0 ):
+    # Writes "<output_dir>/<morph_name>.dsf" linked to the .dhdm file with the same name, from the
+    # template .dsf file (output_type 'DSF_TEMPLATE') or the basic template ('DSF_BASIC').
+    # base_morph_info: {"count": n, "values": [[vi, dx, dy, dz], ...]}.
+    # Complete files are gzipped at gzip_level (1-9) with num_threads threads (0: all cores).
+    # Returns (dsf_fp, to_complete), raises ValueError with a message for the user on invalid input.
+    dsf_new_id = morph_name
+    to_complete = False
+
+    if (output_type == 'DSF_TEMPLATE'):
+        if not has_extension( dsf_fp_templ, "dsf" ):
+            raise ValueError("Invalid Template .dsf file.")
+        if not os.path.isfile(dsf_fp_templ):
+            raise ValueError("Template .dsf file not found.")
+    else:   # output_type == 'DSF_BASIC'
+        dsf_fp_templ = basic_dsf_template
+        if not os.path.isfile(dsf_fp_templ):
+            raise ValueError("Basic template .dsf file not found.")
+    dsf_fp = os.path.join( output_dir, "{0}.{1}".format(dsf_new_id, get_extension(dsf_fp_templ)) )
+
+    dsf_j = get_dsf_json(dsf_fp_templ)
+    try:
+        dsf_orig_asset_id = os.path.basename(dsf_j["asset_info"]["id"]).rsplit(".", 1)[0]
+        dsf_orig_id = dsf_j["modifier_library"][0]["id"]
+        dsf_morph = dsf_j["modifier_library"][0]["morph"]
+
+        if (output_type == 'DSF_BASIC'):
+            dsf_morph["vertex_count"] = base_vcount
+            dz_dir = (morph_daz_directory or "").strip().replace("\\","/")
+            if not dz_dir:
+                raise ValueError("No morph daz directory given.")
+            if not dz_dir.startswith('/'):
+                raise ValueError("Morph daz directory given is invalid (must start with '/').")
+            dz_dir = quote(dz_dir, safe="/#")
+            dsf_j["asset_info"]["id"] = os.path.join(dz_dir, dsf_orig_id + ".dsf").replace("\\","/")
+            dsf_morph["hd_url"] = dsf_j["asset_info"]["id"].rsplit(".", 1)[0] + ".dhdm"
+            parent_url = (parent_url or "").strip()
+            if len(parent_url) > 0:
+                parent_url = quote(parent_url.replace("\\","/"), safe="/#")
+                dsf_j["modifier_library"][0]["parent"] = parent_url
+            else:
+                to_complete = True
+        else:  # output_type == 'DSF_TEMPLATE'
+            vcount = dsf_morph["vertex_count"]
+            if (vcount != -1) and (vcount != base_vcount):
+                raise ValueError("Template .dsf file given is not valid for specified base mesh.")
+            dsf_morph["hd_url"] = dsf_j["asset_info"]["id"].rsplit(".", 1)[0] + ".dhdm"
+
+        dsf_morph["deltas"]["count"] = base_morph_info["count"]
+        dsf_morph["deltas"]["values"] = JsonBlocks(base_morph_info["values"])
+
+    except KeyError as e:
+        raise ValueError(".dsf file has invalid structure.")
+
+    if ("scene" in dsf_j) and ("modifiers" in dsf_j["scene"]):
+        dsf_modif = dsf_j["scene"]["modifiers"]
+        n = 0
+        for e in dsf_modif:
+            if (e["id"] == dsf_orig_id) or (e["id"] == dsf_orig_asset_id):
+                e["id"] = "{}-{}".format(e["id"], n)
+                n += 1
+        del n, dsf_modif
+
+    if ("modifier_library" in dsf_j):
+        dsf_modif_lib = dsf_j["modifier_library"]
+        for e in dsf_modif_lib:
+            if ("channel" not in e) or ("label" not in e["channel"]):
+                continue
+            if (e["id"] == dsf_orig_id) or (e["id"] == dsf_orig_asset_id):
+                e["channel"]["label"] = dsf_new_id
+        del dsf_modif_lib
+
+    # ids, urls and labels referring to the template's morph refer to the new one (the deltas aren't visited)
+    replace_json_ids(dsf_j, [dsf_orig_id, dsf_orig_asset_id], dsf_new_id)
+
+    write_json(dsf_fp, dsf_j, with_gzip=(not to_complete), gzip_level=gzip_level, num_threads=num_threads)
+    return dsf_fp, to_complete
+
+
+class MatchingFilesIndex:
+    # Index of the matching files of a directory, kept in it (index_filename): fingerprint, level,
+    # method, topology hash (binary files, 0 if unknown), size and modification time of each file.
+    # The directory is listed when the index is loaded and again when its modification time changes,
+    # only new or changed files are read then. Invalid files (e.g. truncated) are indexed with
+    # "valid": false. The index is only saved when its files change, replaced by a rename (several
+    # processes may save it at the same time, none sees it partially written).
+    index_filename = "_matching_index.json"
+    version = 2
+    mtime_resolution_ns = 2 * 10**9
+
+    def __init__(self, files_dir):
+        self.files_dir = files_dir
+        self.index_fp = os.path.join(files_dir, self.index_filename)
+        self.dir_mtime_ns = None
+        self.files = {}
+        self.by_fingerprint = {}
+        self.load()
+        self.refresh()
+
+    def load(self):
+        try:
+            with open(self.index_fp, "r", encoding="utf-8") as f:
+                j = json.load(f)
+            if j["version"] != self.version:
+                return
+            self.files = j["files"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print("Invalid matching files index \"{0}\" ({1}), rebuilding it.".format(self.index_fp, e))
+            self.files = {}
+        self.group_files()
+
+    def group_files(self):
+        self.by_fingerprint = {}
+        for fn, info in self.files.items():
+            self.by_fingerprint.setdefault(info["fingerprint"], {})[fn] = info
+
+    def get_files(self, fingerprint):
+        # {filename: info} of the valid files of the fingerprint
+        return { fn: info for fn, info in self.by_fingerprint.get(fingerprint, {}).items() if info["valid"] }
+
+    def refresh(self):
+        # the modification time of the directory is only kept in memory: saving the index changes it
+        dir_mtime_ns = os.stat(self.files_dir).st_mtime_ns
+        if dir_mtime_ns == self.dir_mtime_ns:
+            return
+        files = {}
+        with os.scandir(self.files_dir) as it:
+            for e in it:
+                if get_info_from_filename(e.name)[0] is None or not e.is_file():
+                    continue
+                try:
+                    st = e.stat()
+                except FileNotFoundError:
+                    # deleted by another process since the listing
+                    continue
+                info = self.files.get(e.name)
+                if info is None or info["size"] != st.st_size or info["mtime_ns"] != st.st_mtime_ns:
+                    info = self.read_file_info(e.path, st)
+                files[e.name] = info
+        # a file added right after the listing may not change a coarse (e.g. network share) timestamp,
+        # a recent one is checked again next time
+        recent = (time.time_ns() - dir_mtime_ns) < self.mtime_resolution_ns
+        self.dir_mtime_ns = None if recent else dir_mtime_ns
+        if files != self.files:
+            self.files = files
+            self.group_files()
+            self.save()
+
+    @staticmethod
+    def read_file_info(fp, st):
+        fingerprint, level, mrm, ext = get_info_from_filename(os.path.basename(fp))
+        info = { "fingerprint": fingerprint, "level": level, "mrm": mrm, "ext": ext, "topology_hash": 0,
+                 "size": st.st_size, "mtime_ns": st.st_mtime_ns, "valid": True }
+        if ext == "bin":
+            try:
+                # the header must describe the file
+                h = read_matching_file_header(fp)
+                info["topology_hash"] = h["topology_hash"]
+                if ( h["fingerprint"] != fingerprint or h["level"] != level or h["mrm"] != mrm or
+                     h["header_size"] + 4 * h["count"] != st.st_size ):
+                    info["valid"] = False
+            except (OSError, ValueError):
+                info["valid"] = False
+        return info
+
+    def save(self):
+        # the rename changes the directory's modification time: the next refresh() lists it again, but
+        # reads no file and doesn't save if nothing else changed
+        fp_tmp = "{0}.{1}.tmp".format(self.index_fp, os.getpid())
+        try:
+            with open(fp_tmp, "w", encoding="utf-8") as f:
+                json.dump({ "version": self.version, "files": self.files }, f)
+            os.replace(fp_tmp, self.index_fp)
+        except OSError as e:
+            print("Matching files index \"{0}\" couldn't be saved ({1}).".format(self.index_fp, e))
+
+
+class MatchedFiles:
+    # topology_hash (get_topology_hash()): files of another mesh with the same fingerprint are ignored.
+    # Files without hash (version 1 and legacy .json files) can't be checked and are still used.
+    def __init__(self, fingerprint, files_dir, topology_hash=0):
+        if not os.path.isdir(files_dir):
+            raise ValueError("Directory {0} doesn't exist.".format(files_dir))
+        self.fingerprint = fingerprint
+        self.topology_hash = topology_hash
+        self.index = MatchingFilesIndex(files_dir)
+        self.match_files()
+
+    def match_files(self):
+        self.matched = {}
+        matched_rank = {}
+        for fn, info in sorted(self.index.get_files(self.fingerprint).items()):
+            fn_levels, fn_mrm = info["level"], info["mrm"]
+            # checked binary files take precedence over unchecked ones, then legacy .json files
+            rank = 0
+            if info["ext"] == "bin":
+                rank = 1
+                fn_hash = info["topology_hash"]
+                if self.topology_hash and fn_hash:
+                    if fn_hash != self.topology_hash:
+                        continue
+                    rank = 2
+            if matched_rank.get((fn_mrm, fn_levels), -1) >= rank:
+                continue
+            matched_rank[(fn_mrm, fn_levels)] = rank
+            if fn_mrm not in self.matched:
+                self.matched[fn_mrm] = {}
+            self.matched[fn_mrm][fn_levels] = os.path.join(self.index.files_dir, fn)
+
+    def update(self):
+        # after matching files are written to the directory
+        self.index.refresh()
+        self.match_files()
+
+    def get_suffix(self, base_subdiv_method):
+        assert(base_subdiv_method in ('MULTIRES', 'MULTIRES_REC'))
+        if base_subdiv_method == 'MULTIRES_REC':
+            return "mrr"
+        return "mr"
+
+    def get_filepaths(self, max_level, base_subdiv_method):
+        mrm = self.get_suffix(base_subdiv_method)
+        filepaths = []
+        if mrm not in self.matched:
+            raise RuntimeError("get_filepaths(): missing matching files")
+        for level in range(1, max_level+1):
+            fp = self.matched[mrm].get(level)
+            if fp is None:
+                raise RuntimeError("get_filepaths(): missing matching files")
+            if has_extension(fp, "json"):
+                fp = self.convert_legacy_file(fp, mrm, level)
+            filepaths.append(fp)
+        return filepaths
+
+    def convert_legacy_file(self, fp, mrm, level):
+        try:
+            fp_bin = convert_legacy_matching_file(fp)
+        except OSError as e:
+            print("Legacy matching file \"{0}\" couldn't be converted ({1}), using it as is.".format(fp, e))
+            return fp
+        print("Converted legacy matching file \"{0}\" to \"{1}\".".format(fp, fp_bin))
+        self.matched[mrm][level] = fp_bin
+        self.index.refresh()
+        return fp_bin
+
+    def get_missing_levels(self, max_level, base_subdiv_method):
+        mrm = self.get_suffix(base_subdiv_method)
+        missing_levels = []
+        for level in range(1, max_level+1):
+            if (mrm not in self.matched) or (level not in self.matched[mrm]):
+                missing_levels.append(level)
+        return missing_levels
+
+
+class RunTrace:
+    # Timings of the stages of a run (summed by stage name), counters and the dll's RunStats,
+    # written as one .json report. With profile=True, the code run inside profiled() is also
+    # profiled with cProfile, the stats are dumped next to the report (.prof, see pstats).
+
+    def __init__(self, name, profile=False):
+        self.name = name
+        self.started = time.time()
+        self.t0 = time.perf_counter()
+        self.stages = collections.OrderedDict()     # name -> { "seconds", "calls" }
+        self.counters = collections.OrderedDict()
+        self.dll_stats = []
+        self.info = {}
+        self.profiler = cProfile.Profile() if profile else None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # wall time, including the yields of generators run inside it
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            s = self.stages.setdefault(name, { "seconds": 0.0, "calls": 0 })
+            s["seconds"] += time.perf_counter() - t
+            s["calls"] += 1
+
+    @contextlib.contextmanager
+    def profiled(self):
+        if self.profiler is None:
+            yield
+            return
+        self.profiler.enable()
+        try:
+            yield
+        finally:
+            self.profiler.disable()
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_dll_stats(self, stats):
+        # dict of dll_wrapper.RunStats.as_dict() (empty with an older dll)
+        if stats:
+            self.dll_stats.append(stats)
+
+    def as_dict(self, status, error=None):
+        return { "name": self.name,
+                 "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+                 "seconds": round(time.perf_counter() - self.t0, 3),
+                 "status": status,
+                 "error": error,
+                 "info": self.info,
+                 "stages": { k: { "seconds": round(v["seconds"], 3), "calls": v["calls"] }
+                             for k, v in self.stages.items() },
+                 "counters": self.counters,
+                 "dll": self.dll_stats }
+
+    def write(self, reports_dir, status, error=None):
+        # <reports_dir>/<name>_<start time>.json, returns its path
+        os.makedirs(reports_dir, exist_ok=True)
+        fp_base = os.path.join( reports_dir, "{0}_{1}".format(
+                                    makeValidFilename(self.name),
+                                    time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started)) ) )
+        fp = fp_base + ".json"
+        j_to_json_file(fp, self.as_dict(status, error), with_gzip=False, indent=1)
+        if self.profiler is not None:
+            self.profiler.dump_stats(fp_base + ".prof")
+        return fp
@@ -1,5 +1,5 @@
-import os, ctypes, concurrent.futures
-from . import utils
+import os, sys, ctypes, threading, concurrent.futures
+import numpy as np
 
 
 def str_2_char_p(string):
@@ -24,30 +24,180 @@ class FilepathsInfo(ctypes.Structure):
         self.fps_count = ctypes.c_ushort( fps_count )
         self.filepaths = ctypes.cast( filepaths, ctypes.POINTER(ctypes.c_char_p) )
 
+class ProgressInfo(ctypes.Structure):
+    _fields_ = [ ("level", ctypes.c_uint),
+                 ("nr_levels", ctypes.c_uint),
+                 ("faces_done", ctypes.c_uint),
+                 ("faces_total", ctypes.c_uint),
+                 ("nr_displacements", ctypes.c_uint) ]
+
+    def as_dict(self):
+        return { name: getattr(self, name) for name, t in self._fields_ }
+
+ProgressCallback = ctypes.CFUNCTYPE( ctypes.c_int, ctypes.POINTER(ProgressInfo), ctypes.c_void_p )
+
+HdLevelCallback = ctypes.CFUNCTYPE( ctypes.c_int, ctypes.c_uint, ctypes.POINTER(ctypes.c_float), ctypes.c_uint,
+                                    ctypes.POINTER(ctypes.c_int), ctypes.c_uint, ctypes.c_void_p )
+
+RUN_STATS_MAX_LEVELS = 8
+
+class RunStats(ctypes.Structure):
+    _fields_ = [ ("parse_s", ctypes.c_double),
+                 ("matching_s", ctypes.c_double),
+                 ("refine_s", ctypes.c_double),
+                 ("compute_s", ctypes.c_double),
+                 ("write_s", ctypes.c_double),
+                 ("total_s", ctypes.c_double),
+                 ("nr_levels", ctypes.c_uint),
+                 ("level_compute_s", ctypes.c_double * RUN_STATS_MAX_LEVELS),
+                 ("level_displacements", ctypes.c_uint * RUN_STATS_MAX_LEVELS),
+                 ("bytes_written", ctypes.c_ulonglong),
+                 ("peak_rss", ctypes.c_ulonglong) ]
+
+    def as_dict(self):
+        # per level values as lists of nr_levels items
+        d = { name: getattr(self, name) for name, _ in self._fields_ }
+        n = min(self.nr_levels, RUN_STATS_MAX_LEVELS)
+        d["level_compute_s"] = list(self.level_compute_s[:n])
+        d["level_displacements"] = list(self.level_displacements[:n])
+        return d
+
 class MeshInfo(ctypes.Structure):
     _fields_ = [ ("gScale", ctypes.c_float ),
                  ("base_exportedf", ctypes.c_char_p),
                  ("hd_level", ctypes.c_ushort),
-                 ("load_uv_layers", ctypes.c_short) ]
+                 ("load_uv_layers", ctypes.c_short),
+                 ("num_threads", ctypes.c_ushort),
+                 ("sparse_refine", ctypes.c_ushort),
+                 ("progress_callback", ProgressCallback),
+                 ("progress_user_data", ctypes.c_void_p),
+                 ("edited_mask", ctypes.POINTER(ctypes.c_ubyte)),
+                 ("edited_mask_size", ctypes.c_uint),
+                 ("low_memory_mb", ctypes.c_uint),
+                 ("stats", ctypes.POINTER(RunStats)) ]
 
-    def __init__( self, gScale, base_exportedf, load_uv_layers=-1, hd_level=0 ):
+    def __init__( self, gScale, base_exportedf, load_uv_layers=-1, hd_level=0, num_threads=0, sparse_refine=False,
+                  progress_callback=None, edited_mask=None, low_memory_mb=0, with_stats=False ):
         self.gScale = ctypes.c_float(gScale)
         self.base_exportedf = str_2_char_p(base_exportedf)
         self.hd_level = ctypes.c_ushort(hd_level)
         self.load_uv_layers = ctypes.c_short(load_uv_layers)
+        self.num_threads = ctypes.c_ushort(num_threads)
+        self.sparse_refine = ctypes.c_ushort(1 if sparse_refine else 0)
+        # > 0: the mesh is refined in tiles of base faces using about low_memory_mb each
+        self.low_memory_mb = ctypes.c_uint(low_memory_mb)
+
+        # progress_callback(progress dict) is called from the dll's worker threads,
+        # returning True cancels the job. Keep the ctypes function alive as long as the structure.
+        self.c_progress_callback = None
+        if progress_callback is not None:
+            def c_progress_callback(progress_p, user_data):
+                return 1 if progress_callback( progress_p.contents.as_dict() ) else 0
+            self.c_progress_callback = ProgressCallback(c_progress_callback)
+            self.progress_callback = self.c_progress_callback
+
+        # edited_mask: bool array, True for the edited vertices of the hd mesh (see core.get_edited_mask()).
+        # Passed packed 8 vertices per byte, the packed array is kept alive with the structure.
+        self.packed_edited_mask = None
+        if edited_mask is not None:
+            self.packed_edited_mask = np.packbits( np.asarray(edited_mask, dtype=bool), bitorder="little" )
+            self.edited_mask = self.packed_edited_mask.ctypes.data_as( ctypes.POINTER(ctypes.c_ubyte) )
+            self.edited_mask_size = ctypes.c_uint( len(edited_mask) )
+
+        # with_stats: the dll fills run_stats (timings and counters of the job)
+        self.run_stats = None
+        if with_stats:
+            self.run_stats = RunStats()
+            self.stats = ctypes.pointer(self.run_stats)
+
+    def get_stats(self):
+        # None without with_stats or if the dll didn't fill them (older dll)
+        if self.run_stats is None or self.run_stats.total_s == 0:
+            return None
+        return self.run_stats.as_dict()
+
+class MeshBuffers(ctypes.Structure):
+    _fields_ = [ ("positions", ctypes.POINTER(ctypes.c_float)),
+                 ("vert_count", ctypes.c_uint),
+                 ("face_vert_counts", ctypes.POINTER(ctypes.c_int)),
+                 ("face_vert_indices", ctypes.POINTER(ctypes.c_int)),
+                 ("face_count", ctypes.c_uint) ]
+
+    def __init__(self, mesh_arrays):
+        # mesh_arrays: (positions, face_vert_counts, face_vert_indices) from utils.get_mesh_arrays().
+        # The arrays are passed by pointer (no copy), so keep them alive as long as the structure.
+        positions, face_vert_counts, face_vert_indices = mesh_arrays
+        if not (positions.flags.c_contiguous and face_vert_counts.flags.c_contiguous
+                and face_vert_indices.flags.c_contiguous):
+            raise ValueError("Mesh arrays must be contiguous.")
+        self.arrays = mesh_arrays
+
+        self.positions = positions.ctypes.data_as( ctypes.POINTER(ctypes.c_float) )
+        self.vert_count = ctypes.c_uint( len(positions) )
+        self.face_vert_counts = face_vert_counts.ctypes.data_as( ctypes.POINTER(ctypes.c_int) )
+        self.face_vert_indices = face_vert_indices.ctypes.data_as( ctypes.POINTER(ctypes.c_int) )
+        self.face_count = ctypes.c_uint( len(face_vert_counts) )
+
+
+class MatchStats(ctypes.Structure):
+    _fields_ = [ ("max_dist", ctypes.c_float),
+                 ("mean_dist", ctypes.c_float),
+                 ("non_optimal_n", ctypes.c_uint) ]
+
+    def as_dict(self):
+        return { name: getattr(self, name) for name, _ in self._fields_ }
+
+
+# return value of the dll's functions when canceled by the progress callback
+DLL_CANCELED = -2
+
+# DHDM_GEN_ABI_VERSION (shared.hh) of the dll these wrappers are written for
+DLL_ABI_VERSION = 1
+
+class JobCanceled(Exception):
+    pass
+
+
+# name of the bundled library (dll_dir) on this platform, as built by dll_source/CMakeLists.txt
+bundled_dll_name = { "win32": "dhdm_gen_dll.dll", "darwin": "libdhdm_gen.dylib" }.get(sys.platform, "libdhdm_gen.so")
 
 
 class DHDM_DLL_Wrapper:
-    dll_path = os.path.join(os.path.dirname(__file__), "dll_dir", "dhdm_gen_dll.dll")
+    # DHDM_GEN_DLL_PATH overrides the bundled library
+    dll_path = os.environ.get( "DHDM_GEN_DLL_PATH",
+                               os.path.join(os.path.dirname(__file__), "dll_dir", bundled_dll_name) )
+
+    # The library is loaded once per process and shared by all wrappers.
+    # It is loaded as a CDLL (not PyDLL), so ctypes releases the GIL for the whole
+    # duration of every call and several jobs can run at the same time.
+    loaded_dll = None
+    load_lock = threading.Lock()
 
     def __init__(self):
-        if not os.path.isfile(self.dll_path):
-            raise RuntimeError("File \"{0}\" not found.".format(self.dll_path))
+        with DHDM_DLL_Wrapper.load_lock:
+            if DHDM_DLL_Wrapper.loaded_dll is None:
+                DHDM_DLL_Wrapper.loaded_dll = self.load_dll()
+        self.dll = DHDM_DLL_Wrapper.loaded_dll
+
+    @classmethod
+    def load_dll(cls):
+        if not os.path.isfile(cls.dll_path):
+            raise RuntimeError("File \"{0}\" not found.".format(cls.dll_path))
         try:
-            self.dll = ctypes.cdll.LoadLibrary(self.dll_path)
+            dll = ctypes.CDLL(cls.dll_path)
         except OSError as e:
-            print("Failed to load \"{0}\".".format(self.dll_path))
+            print("Failed to load \"{0}\".".format(cls.dll_path))
             raise e
+        # builds older than the versioned interface have no get_abi_version() (version 0)
+        abi_version = 0
+        if hasattr(dll, "get_abi_version"):
+            dll.get_abi_version.restype = ctypes.c_uint
+            dll.get_abi_version.argtypes = []
+            abi_version = dll.get_abi_version()
+        if abi_version != DLL_ABI_VERSION:
+            raise RuntimeError( "\"{0}\" has interface version {1}, the addon needs version {2}: "
+                                "build the library from dll_source.".format(cls.dll_path, abi_version, DLL_ABI_VERSION) )
+        return dll
 
     def generate_hd_mesh( self, gScale, base_exportedf,
                                 hd_level, outputDirpath,
@@ -64,40 +214,269 @@ class DHDM_DLL_Wrapper:
         return r
 
 
+    def generate_hd_levels( self, base_arrays, max_level, levels=None, cancel_check=None, with_faces=False ):
+        # Vertex positions (float32 (n, 3)) of base_arrays subdivided to each level in levels
+        # (default: 1..max_level), refined once: { level: positions }.
+        # with_faces: { level: (positions, face_vert_counts, face_vert_indices) } (as utils.get_mesh_arrays()).
+        # cancel_check() returning True cancels the job between levels.
+        mesh_info = MeshInfo( 1, None, hd_level=max_level )
+        base_buffers = MeshBuffers( base_arrays )
+        level_positions = {}
+
+        def on_level(level, positions_p, vert_count, face_vert_indices_p, face_count, user_data):
+            if levels is None or level in levels:
+                positions = np.ctypeslib.as_array(positions_p, shape=(vert_count, 3)).copy()
+                if with_faces:
+                    face_vert_indices = np.ctypeslib.as_array(face_vert_indices_p, shape=(face_count * 4,)).copy()
+                    level_positions[level] = ( positions, np.full(face_count, 4, dtype=np.int32), face_vert_indices )
+                else:
+                    level_positions[level] = positions
+            return 1 if (cancel_check is not None and cancel_check()) else 0
+        c_on_level = HdLevelCallback(on_level)
+
+        r = self.dll.generate_hd_levels( ctypes.byref(mesh_info),
+                                         ctypes.byref(base_buffers),
+                                         c_on_level, None )
+
+        if r == DLL_CANCELED:
+            raise JobCanceled("generate_hd_levels() canceled.")
+        if r is None or r != 0:
+            raise RuntimeError("Function \"{0}\" in \"{1}\" failed.".format("generate_hd_levels()", self.dll_path))
+        return level_positions
+
+
+    def match_vertices( self, ref_positions, query_positions, max_dist, num_threads=0 ):
+        # Nearest ref vertex of every query vertex ((n, 3) arrays in the same space):
+        # (indices uint32 (n_query,), distances float32 (n_query,), stats dict).
+        ref_positions = np.ascontiguousarray(ref_positions, dtype=np.float32)
+        query_positions = np.ascontiguousarray(query_positions, dtype=np.float32)
+        query_count = len(query_positions)
+        indices = np.empty(query_count, dtype=np.uint32)
+        distances = np.empty(query_count, dtype=np.float32)
+        stats = MatchStats()
+
+        self.dll.match_vertices.restype = ctypes.c_int
+        r = self.dll.match_vertices( ref_positions.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
+                                     ctypes.c_uint(len(ref_positions)),
+                                     query_positions.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
+                                     ctypes.c_uint(query_count),
+                                     ctypes.c_float(max_dist),
+                                     ctypes.c_uint(num_threads),
+                                     indices.ctypes.data_as(ctypes.POINTER(ctypes.c_uint)),
+                                     distances.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
+                                     ctypes.byref(stats) )
+
+        if r is None or r != 0:
+            raise RuntimeError("Function \"{0}\" in \"{1}\" failed.".format("match_vertices()", self.dll_path))
+        return indices, distances, stats.as_dict()
+
+
+    def match_vertices_topology( self, ref_arrays, query_arrays, max_dist ):
+        # Exact correspondence of two meshes with the same topology (mesh arrays as utils.get_mesh_arrays()):
+        # (indices uint32 (n_query,), stats dict). RuntimeError if the topologies don't match.
+        query_count = len(query_arrays[0])
+        indices = np.empty(query_count, dtype=np.uint32)
+        stats = MatchStats()
+        ref_buffers = MeshBuffers( ref_arrays )
+        query_buffers = MeshBuffers( query_arrays )
+
+        self.dll.match_vertices_topology.restype = ctypes.c_int
+        r = self.dll.match_vertices_topology( ctypes.byref(ref_buffers),
+                                              ctypes.byref(query_buffers),
+                                              ctypes.c_float(max_dist),
+                                              indices.ctypes.data_as(ctypes.POINTER(ctypes.c_uint)),
+                                              ctypes.byref(stats) )
+
+        if r is None or r != 0:
+            raise RuntimeError("Function \"{0}\" in \"{1}\" failed.".format("match_vertices_topology()", self.dll_path))
+        return indices, stats.as_dict()
+
+
     def generate_dhdm_file( self,
                             gScale, base_exportedf, hd_level,
                             outputDirpath, outputFilename,
-                            filepaths_list ):
+                            filepaths_list, num_threads=0, sparse_refine=False,
+                            session=None, progress_callback=None, edited_mask=None, low_memory_mb=0,
+                            stats=None ):
 
-        mesh_info = MeshInfo( gScale, base_exportedf, hd_level=hd_level )
+        # with edited_mask, "<base_exportedf>_hd_no_edit.obj" isn't needed.
+        # stats: dict updated with the dll's timings and counters (RunStats.as_dict()) when the job succeeds.
+        mesh_info = MeshInfo( gScale, base_exportedf, hd_level=hd_level,
+                              num_threads=num_threads, sparse_refine=sparse_refine,
+                              progress_callback=progress_callback, edited_mask=edited_mask,
+                              low_memory_mb=low_memory_mb, with_stats=(stats is not None) )
         fps_info = FilepathsInfo( filepaths_list )
 
-        r = self.dll.generate_dhdm_file( ctypes.byref(mesh_info),
-                                         ctypes.byref(fps_info),
-                                         str_2_char_p(outputDirpath),
-                                         str_2_char_p(outputFilename) )
+        if session is not None:
+            r = self.dll.session_generate_dhdm_file( ctypes.c_void_p(session),
+                                                     ctypes.byref(mesh_info),
+                                                     ctypes.byref(fps_info),
+                                                     str_2_char_p(outputDirpath),
+                                                     str_2_char_p(outputFilename) )
+        else:
+            r = self.dll.generate_dhdm_file( ctypes.byref(mesh_info),
+                                             ctypes.byref(fps_info),
+                                             str_2_char_p(outputDirpath),
+                                             str_2_char_p(outputFilename) )
 
+        if r == DLL_CANCELED:
+            raise JobCanceled("generate_dhdm_file() canceled.")
         if r is None or r != 0:
             raise RuntimeError("Function \"{0}\" in \"{1}\" failed.".format("generate_dhdm_file()", self.dll_path))
+        if stats is not None:
+            stats.update( mesh_info.get_stats() or {} )
         return r
 
 
-def call_dll_function(func_name, *args ):
+    def generate_dhdm_file_from_buffers( self,
+                                         gScale, hd_level,
+                                         outputDirpath, outputFilename,
+                                         filepaths_list,
+                                         base_arrays, hd_no_edit_arrays, hd_edit_arrays,
+                                         num_threads=0, sparse_refine=False,
+                                         session=None, progress_callback=None, edited_mask=None,
+                                         low_memory_mb=0, stats=None ):
+
+        # with edited_mask, hd_no_edit_arrays can be None. stats: as in generate_dhdm_file()
+        mesh_info = MeshInfo( gScale, None, hd_level=hd_level,
+                              num_threads=num_threads, sparse_refine=sparse_refine,
+                              progress_callback=progress_callback, edited_mask=edited_mask,
+                              low_memory_mb=low_memory_mb, with_stats=(stats is not None) )
+        fps_info = FilepathsInfo( filepaths_list )
+        base_buffers = MeshBuffers( base_arrays )
+        hd_no_edit_buffers = None
+        if hd_no_edit_arrays is not None:
+            hd_no_edit_buffers = ctypes.byref( MeshBuffers( hd_no_edit_arrays ) )
+        hd_edit_buffers = MeshBuffers( hd_edit_arrays )
+
+        if session is not None:
+            r = self.dll.session_generate_dhdm_file_from_buffers( ctypes.c_void_p(session),
+                                                                  ctypes.byref(mesh_info),
+                                                                  ctypes.byref(fps_info),
+                                                                  ctypes.byref(base_buffers),
+                                                                  hd_no_edit_buffers,
+                                                                  ctypes.byref(hd_edit_buffers),
+                                                                  str_2_char_p(outputDirpath),
+                                                                  str_2_char_p(outputFilename) )
+        else:
+            r = self.dll.generate_dhdm_file_from_buffers( ctypes.byref(mesh_info),
+                                                          ctypes.byref(fps_info),
+                                                          ctypes.byref(base_buffers),
+                                                          hd_no_edit_buffers,
+                                                          ctypes.byref(hd_edit_buffers),
+                                                          str_2_char_p(outputDirpath),
+                                                          str_2_char_p(outputFilename) )
+
+        if r == DLL_CANCELED:
+            raise JobCanceled("generate_dhdm_file_from_buffers() canceled.")
+        if r is None or r != 0:
+            raise RuntimeError("Function \"{0}\" in \"{1}\" failed.".format("generate_dhdm_file_from_buffers()", self.dll_path))
+        if stats is not None:
+            stats.update( mesh_info.get_stats() or {} )
+        return r
+
+
+    def create_session(self, memory_cap_mb):
+        self.dll.create_session.restype = ctypes.c_void_p
+        self.dll.create_session.argtypes = [ ctypes.c_size_t ]
+        session = self.dll.create_session( ctypes.c_size_t(memory_cap_mb * 1024 * 1024) )
+        if session is None:
+            raise RuntimeError("Function \"{0}\" in \"{1}\" failed.".format("create_session()", self.dll_path))
+        return session
+
+    def destroy_session(self, session):
+        self.dll.destroy_session.restype = None
+        self.dll.destroy_session.argtypes = [ ctypes.c_void_p ]
+        self.dll.destroy_session( ctypes.c_void_p(session) )
+
+
+# The dll stays loaded by the process, so the session (cached base mesh topology,
+# matrices and matching files) persists between operator calls.
+session = None
+session_memory_cap_mb = None
+
+def get_session(memory_cap_mb):
+    global session, session_memory_cap_mb
+    if memory_cap_mb <= 0:
+        close_session()
+        return None
+    if session is not None and session_memory_cap_mb == memory_cap_mb:
+        return session
+    close_session()
+    w = DHDM_DLL_Wrapper()
+    session = w.create_session(memory_cap_mb)
+    session_memory_cap_mb = memory_cap_mb
+    del w
+    return session
+
+def close_session():
+    global session, session_memory_cap_mb
+    if session is None:
+        return
+    w = DHDM_DLL_Wrapper()
+    w.destroy_session(session)
+    del w
+    session = None
+    session_memory_cap_mb = None
+
+def call_dll_function(func_name, *args, **kwargs ):
     w = DHDM_DLL_Wrapper()
     func = getattr(w, func_name)
     print("\n---- Start of DLL ----\n")
     try:
-        r = func(*args)
+        r = func(*args, **kwargs)
         del w
         print("\n---- End of DLL ----\n")
         return r
+    except JobCanceled as e:
+        del w
+        print("\n---- DLL job canceled.\n")
+        raise e
     except Exception as e:
         del w
         print("\n---- ERROR in DLL (read console output).\n")
         raise e
 
+def execute_concurrently( jobs, max_workers=None ):
+    # jobs: [ (func_name, args), ... ]. Jobs share no state in the dll, so they run in parallel.
+    # Returns the results in the jobs' order, the first failed job's exception is raised
+    # after all jobs have finished.
+    if len(jobs) == 0:
+        return []
+    if max_workers is None or max_workers <= 0:
+        max_workers = len(jobs)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as executor:
+        futures = [ executor.submit( call_dll_function, func_name, *args ) for func_name, args in jobs ]
+        concurrent.futures.wait(futures)
+    return [ f.result() for f in futures ]
+
 def execute_in_new_thread( func_name, *args ):
-    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-        future = executor.submit( call_dll_function, func_name, *args )
-        r = future.result()
-    return r
+    return execute_concurrently( [ (func_name, args) ] )[0]
+
+
+class DllJob:
+    # Function running on a background thread, polled by modal operators (see dhdmGenBaseOperator).
+    # With with_progress=True it gets a progress_callback keyword argument (for the dll's
+    # generate_dhdm_file* functions), which stores the last progress and requests cancellation.
+
+    def __init__(self, target, *args, with_progress=False, **kwargs):
+        self.progress = None
+        self.canceled = False
+        if with_progress:
+            kwargs["progress_callback"] = self.on_progress
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.future = self.executor.submit(target, *args, **kwargs)
+
+    def on_progress(self, progress):
+        self.progress = progress
+        return self.canceled
+
+    def cancel(self):
+        self.canceled = True
+
+    def done(self):
+        return self.future.done()
+
+    def result(self):
+        self.executor.shutdown(wait=True)
+        return self.future.result()
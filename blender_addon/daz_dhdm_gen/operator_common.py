@@ -1,48 +1,13 @@
-import bpy, os, re
+import bpy, os, re, time
 from mathutils import Vector
 from . import utils
+from . import core
+from . import dll_wrapper
+from .cache import ArtifactCache
 
-class MatchedFiles:
+class MatchedFiles(core.MatchedFiles):
     def __init__(self, ob, files_dir):
-        if not os.path.isdir(files_dir):
-            raise ValueError("Directory {0} doesn't exist.".format(files_dir))
-
-        self.fingerprint = utils.get_fingerprint(ob)
-        self.matched = {}
-        for root, dirs, files in os.walk(files_dir):
-            for fn in files:
-                fn_fingerprint, fn_levels, fn_mrm = utils.get_info_from_filename(fn)
-                if (fn_fingerprint is not None) and (fn_fingerprint == self.fingerprint):
-                    if fn_mrm not in self.matched:
-                        self.matched[fn_mrm] = {}
-                    self.matched[fn_mrm][fn_levels] = os.path.join(root, fn)
-            break
-
-    def get_suffix(self, base_subdiv_method):
-        assert(base_subdiv_method in ('MULTIRES', 'MULTIRES_REC'))
-        if base_subdiv_method == 'MULTIRES_REC':
-            return "mrr"
-        return "mr"
-
-    def get_filepaths(self, max_level, base_subdiv_method):
-        mrm = self.get_suffix(base_subdiv_method)
-        filepaths = []
-        if mrm not in self.matched:
-            raise RuntimeError("get_filepaths(): missing matching files")
-        for level in range(1, max_level+1):
-            fp = self.matched[mrm].get(level)
-            if fp is None:
-                raise RuntimeError("get_filepaths(): missing matching files")
-            filepaths.append(fp)
-        return filepaths
-
-    def get_missing_levels(self, max_level, base_subdiv_method):
-        mrm = self.get_suffix(base_subdiv_method)
-        missing_levels = []
-        for level in range(1, max_level+1):
-            if (mrm not in self.matched) or (level not in self.matched[mrm]):
-                missing_levels.append(level)
-        return missing_levels
+        super().__init__(utils.get_fingerprint(ob), files_dir, topology_hash=utils.get_ob_topology_hash(ob))
 
 
 class dhdmGenBaseOperator(bpy.types.Operator):
@@ -54,8 +19,18 @@ class dhdmGenBaseOperator(bpy.types.Operator):
 
     temporary_subdirname = "_temporary"
     new_morphs_subdirname = "new_morphs"
+    mesh_cache_subdirname = "_mesh_cache"
+    dsf_index_filename = "_dsf_index.json"
+    reports_subdirname = "_reports"
     base_ob_copy = None
     cleanup_files = None
+    use_mesh_buffers = None
+    num_threads = None
+    sparse_refine = None
+    low_memory_mb = None
+    session_cache_mb = None
+    mesh_cache_mb = None
+    gzip_level = None
     saved_settings = None
 
     hd_ob = None
@@ -63,6 +38,19 @@ class dhdmGenBaseOperator(bpy.types.Operator):
     morphed_base_ob = None
     morph_name = None
 
+    # modal execution: subclasses implement run_steps(context), a generator that yields
+    # while waiting (so the UI stays responsive) and returns the operator's result.
+    steps = None
+    timer = None
+    job = None
+    cancel_requested = None
+    t0 = None
+    status = None
+    timer_interval = 0.1
+
+    # stage timings, counters and dll stats of the run, written to the working directory when it ends
+    trace = None
+
     @classmethod
     def poll(cls, context):
         return context.mode == 'OBJECT'
@@ -70,10 +58,156 @@ class dhdmGenBaseOperator(bpy.types.Operator):
     def invoke(self, context, event):
         return self.execute(context)
 
+    def execute(self, context):
+        self.t0 = time.perf_counter()
+        addon_prefs = context.preferences.addons[__package__].preferences
+        self.trace = core.RunTrace( self.bl_idname.split(".")[-1], profile=addon_prefs.profile_runs )
+        self.job = None
+        self.cancel_requested = False
+        self.status = None
+        self.steps = self.run_steps(context)
+        if bpy.app.background or context.window is None:
+            return self.run_steps_blocking(context)
+        wm = context.window_manager
+        self.timer = wm.event_timer_add(self.timer_interval, window=context.window)
+        wm.modal_handler_add(self)
+        self.set_status(context, "Starting...")
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC' and event.value == 'PRESS':
+            self.request_cancel(context)
+            return {'RUNNING_MODAL'}
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        if self.job is not None and not self.job.done():
+            self.update_job_status(context)
+            return {'RUNNING_MODAL'}
+        try:
+            with self.trace.profiled():
+                next(self.steps)
+        except StopIteration as e:
+            return self.finish_modal(context, e.value)
+        except dll_wrapper.JobCanceled:
+            self.report({'WARNING'}, "Operator canceled.")
+            return self.finish_modal(context, {'CANCELLED'}, status="canceled")
+        except Exception as e:
+            self.finish_modal(context, {'CANCELLED'}, status="failed", error=str(e))
+            raise e
+        return {'RUNNING_MODAL'}
+
+    def finish_modal(self, context, result, status=None, error=None):
+        wm = context.window_manager
+        if self.timer is not None:
+            wm.event_timer_remove(self.timer)
+            self.timer = None
+        context.workspace.status_text_set(None)
+        self.steps = None
+        self.job = None
+        return self.end_run(result, status, error)
+
+    def run_steps_blocking(self, context):
+        # no window (background mode or scripts without one): run the steps in place
+        status = None
+        try:
+            while True:
+                with self.trace.profiled():
+                    next(self.steps)
+                if self.job is not None:
+                    while not self.job.done():
+                        time.sleep(self.timer_interval)
+        except StopIteration as e:
+            result = e.value
+        except dll_wrapper.JobCanceled:
+            result = {'CANCELLED'}
+            status = "canceled"
+        except Exception as e:
+            self.steps = None
+            self.job = None
+            self.end_run({'CANCELLED'}, "failed", str(e))
+            raise e
+        self.steps = None
+        self.job = None
+        return self.end_run(result, status)
+
+    def end_run(self, result, status=None, error=None):
+        if result is None:
+            result = {'CANCELLED'}
+        if 'FINISHED' in result:
+            print("Elapsed: {}".format(time.perf_counter() - self.t0))
+        if status is None:
+            status = "finished" if 'FINISHED' in result else "canceled"
+        self.write_report(status, error)
+        return result
+
+    def write_report(self, status, error=None):
+        # only once the working directory is known (not when the input is invalid)
+        if self.trace is None or self.working_dirpath is None:
+            return
+        try:
+            fp = self.trace.write( os.path.join(self.working_dirpath, self.reports_subdirname), status, error )
+            print("Run report: \"{0}\".".format(fp))
+        except OSError as e:
+            print("Can't write the run report ({0}).".format(e))
+        self.trace = None
+
+    def request_cancel(self, context):
+        self.cancel_requested = True
+        if self.job is not None:
+            self.job.cancel()
+        self.set_status(context, "Canceling...")
+
+    def check_canceled(self):
+        # raises JobCanceled at a step boundary if ESC was pressed
+        if self.cancel_requested:
+            raise dll_wrapper.JobCanceled()
+
+    def set_status(self, context, status):
+        self.status = status
+        if self.timer is not None:
+            context.workspace.status_text_set(self.status_text())
+
+    def status_text(self):
+        return "{0}: {1}  (Esc to cancel)".format(self.bl_label, self.status)
+
+    def update_job_status(self, context):
+        p = self.job.progress
+        if p is None or self.cancel_requested:
+            return
+        self.set_status( context,
+                         "level {0}/{1}, base faces {2}/{3}, displacements {4}".format(
+                            p["level"], p["nr_levels"], p["faces_done"], p["faces_total"], p["nr_displacements"] ) )
+
+    def run_dll_job(self, target, *args, with_progress=False, **kwargs):
+        # generator: runs target on a background thread, yields until it ends and returns its result
+        self.check_canceled()
+        if target is dll_wrapper.call_dll_function:
+            stage = "dll:" + args[0]
+        else:
+            stage = "dll:" + target.__name__
+        with self.trace.stage(stage):
+            self.job = dll_wrapper.DllJob(target, *args, with_progress=with_progress, **kwargs)
+            while not self.job.done():
+                yield
+            job = self.job
+            self.job = None
+            if self.cancel_requested and not with_progress:
+                job.result()
+                raise dll_wrapper.JobCanceled()
+            return job.result()
+
     def check_input(self, context, check_hd, check_morph_name):
         scn = context.scene
         addon_props = scn.daz_dhdm_gen
 
+        # missing or outdated dll (see DHDM_DLL_Wrapper.load_dll())
+        try:
+            dll_wrapper.DHDM_DLL_Wrapper()
+        except (OSError, RuntimeError) as e:
+            self.report({'ERROR'}, str(e))
+            return False
+
         if addon_props.base_ob not in scn.objects:
             self.report({'ERROR'}, "Base mesh not found in the scene.")
             return False
@@ -120,10 +254,20 @@ class dhdmGenBaseOperator(bpy.types.Operator):
         if not os.path.isdir(working_dirpath):
             self.report({'ERROR'}, "Working directory not found.")
             return False
+        # .dsf metadata (ids, vertex counts, hd files) read by the library scans is kept for all objects
+        core.dsf_metadata_cache.set_index_file( os.path.join(working_dirpath, self.dsf_index_filename) )
         self.working_dirpath = os.path.join(working_dirpath, utils.makeValidFilename(self.base_ob.name))
         if not os.path.isdir(self.working_dirpath):
             os.mkdir(self.working_dirpath)
-        self.cleanup_files = context.preferences.addons[__package__].preferences.delete_temporary_files
+        addon_prefs = context.preferences.addons[__package__].preferences
+        self.cleanup_files = addon_prefs.delete_temporary_files
+        self.use_mesh_buffers = addon_prefs.use_mesh_buffers
+        self.num_threads = addon_prefs.num_threads
+        self.sparse_refine = addon_prefs.sparse_refine
+        self.low_memory_mb = addon_prefs.low_memory_mb
+        self.session_cache_mb = addon_prefs.session_cache_mb
+        self.mesh_cache_mb = addon_prefs.mesh_cache_mb
+        self.gzip_level = addon_prefs.gzip_level
 
         mfiles_dir = addon_props.matching_files_dir.strip()
         if (not mfiles_dir):
@@ -134,7 +278,8 @@ class dhdmGenBaseOperator(bpy.types.Operator):
             self.report({'ERROR'}, "Invalid matching files directory.")
             return False
         self.matching_files_dir = mfiles_dir
-        self.mfiles = MatchedFiles(self.base_ob, self.matching_files_dir)
+        with self.trace.stage("matching_lookup"):
+            self.mfiles = MatchedFiles(self.base_ob, self.matching_files_dir)
 
         self.morph_name = None
         if check_morph_name:
@@ -148,7 +293,8 @@ class dhdmGenBaseOperator(bpy.types.Operator):
         return True
 
     def check_all_matching_files(self, hd_level):
-        missing_levels = self.mfiles.get_missing_levels(hd_level, self.base_subdiv_method)
+        with self.trace.stage("matching_lookup"):
+            missing_levels = self.mfiles.get_missing_levels(hd_level, self.base_subdiv_method)
         if len(missing_levels) > 0:
             self.report({'ERROR'}, "Matching files for levels {0} missing. Try generating them.".format(missing_levels))
             return False
@@ -185,24 +331,38 @@ class dhdmGenBaseOperator(bpy.types.Operator):
     def create_new_morphs_subdir(self):
         return self.create_subdir(self.get_new_mophs_subdir())
 
+    def get_mesh_cache(self):
+        if self.mesh_cache_mb <= 0:
+            return None
+        return ArtifactCache( os.path.join(self.working_dirpath, self.mesh_cache_subdirname),
+                              self.mesh_cache_mb << 20 )
+
     def export_ob_obj( self, ob, name, apply_modifiers ):
-        tmp_dir = self.create_temporary_subdir()
-        fp_base = os.path.join(tmp_dir, name)
-        fp = fp_base + ".obj"
+        with self.trace.stage("export_ob_obj"):
+            tmp_dir = self.create_temporary_subdir()
+            fp_base = os.path.join(tmp_dir, name)
+            fp = fp_base + ".obj"
 
-        ob_mw_trans_prev = Vector(ob.matrix_world.translation)
-        ob.matrix_world.translation = (0, 0, 0)
-        utils.make_single_active(ob)
-        bpy.ops.wm.obj_export( filepath=fp, check_existing=False,
-                               export_animation=False, apply_modifiers=apply_modifiers,
-                               export_eval_mode='DAG_EVAL_VIEWPORT',
-                               export_selected_objects=True, export_uv=False,
-                               export_normals=False, export_colors=False,
-                               export_materials=False, export_pbr_extensions=False,
-                               export_triangulated_mesh=False, export_material_groups=False,
-                               export_vertex_groups=False, export_smooth_groups=False )
-        ob.matrix_world.translation = ob_mw_trans_prev
-        return fp_base
+            ob_mw_trans_prev = Vector(ob.matrix_world.translation)
+            ob.matrix_world.translation = (0, 0, 0)
+            utils.make_single_active(ob)
+            bpy.ops.wm.obj_export( filepath=fp, check_existing=False,
+                                   export_animation=False, apply_modifiers=apply_modifiers,
+                                   export_eval_mode='DAG_EVAL_VIEWPORT',
+                                   export_selected_objects=True, export_uv=False,
+                                   export_normals=False, export_colors=False,
+                                   export_materials=False, export_pbr_extensions=False,
+                                   export_triangulated_mesh=False, export_material_groups=False,
+                                   export_vertex_groups=False, export_smooth_groups=False )
+            ob.matrix_world.translation = ob_mw_trans_prev
+            return fp_base
+
+    def export_ob_mesh( self, ob, name, apply_modifiers ):
+        # .obj file path base, or mesh arrays when passing meshes to the dll in memory
+        if self.use_mesh_buffers:
+            with self.trace.stage("get_mesh_arrays"):
+                return utils.get_mesh_arrays( ob, apply_modifiers )
+        return self.export_ob_obj( ob, name, apply_modifiers )
 
     def export_ob_dae( self, ob, name, apply_modifiers, with_obj ):
         tmp_dir = self.create_temporary_subdir()
@@ -249,7 +409,8 @@ class dhdmGenBaseOperator(bpy.types.Operator):
             ob_to_export = self.base_ob
             apply_modifiers = False
         else:
-            self.base_ob_copy = utils.copy_object(self.base_ob)
+            with self.trace.stage("copy_object"):
+                self.base_ob_copy = utils.copy_object(self.base_ob)
             ob_to_export = self.base_ob_copy
             apply_modifiers = True
             if base_modifiers == 'SK':
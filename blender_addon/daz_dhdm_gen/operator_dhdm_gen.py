@@ -1,9 +1,10 @@
-import os, time, json, re, bpy
+import os, bpy
+import numpy as np
 from . import dll_wrapper
 from . import utils
+from . import core
 from .operator_common import dhdmGenBaseOperator
-from mathutils import Vector, Matrix
-from urllib.parse import quote
+from mathutils import Matrix
 
 
 class GenerateNewMorphFiles(dhdmGenBaseOperator):
@@ -19,9 +20,10 @@ class GenerateNewMorphFiles(dhdmGenBaseOperator):
     blend_to_dz_mat = Matrix([ (1, 0,  0),
                                (0, 0,  1),
                                (0, -1, 0) ])
+    # base morph deltas shorter than this (in daz's units) are left out of the .dsf file
+    delta_dz_min_len = 1e-3
 
-    def execute(self, context):
-        t0 = time.perf_counter()
+    def run_steps(self, context):
         if not self.check_input(context, check_hd=True, check_morph_name=True):
             return {'CANCELLED'}
         if not self.get_hd_level():
@@ -32,15 +34,20 @@ class GenerateNewMorphFiles(dhdmGenBaseOperator):
         self.to_complete = False
         addon_props = context.scene.daz_dhdm_gen
 
-        r = self.generate_dsf_file(context)
-        if not r:
+        try:
+            self.set_status(context, "generating .dsf file...")
+            yield
+            with self.trace.stage("dsf"):
+                r = self.generate_dsf_file(context)
+            if not r:
+                return {'CANCELLED'}
+
+            self.check_canceled()
+            r = yield from self.generate_dhdm_file(context)
+            if not r:
+                return {'CANCELLED'}
+        finally:
             self.cleanup(context)
-            return {'CANCELLED'}
-
-        r = self.generate_dhdm_file(context)
-        self.cleanup(context)
-        if not r:
-            return {'CANCELLED'}
 
         if (addon_props.output_type == 'DHDM'):
             self.report({'INFO'}, ".dhdm file generated.")
@@ -51,8 +58,6 @@ class GenerateNewMorphFiles(dhdmGenBaseOperator):
                 self.report({'INFO'}, ".dsf and .dhdm files generated.")
         else:
             self.report({'INFO'}, ".dsf and .dhdm files generated.")
-
-        print("Elapsed: {}".format(time.perf_counter() - t0))
         return {'FINISHED'}
 
     def get_subdiv_modifier_info(self, ob):
@@ -87,39 +92,18 @@ class GenerateNewMorphFiles(dhdmGenBaseOperator):
         return True
 
     def get_base_morph_info(self, context):
-        ob_base_copy = utils.copy_object(self.base_ob)
-        ob_base_copy.modifiers.clear()
-        ob_base_copy.vertex_groups.clear()
-        ob_base_copy.data.materials.clear()
-        utils.remove_shape_keys(ob_base_copy)
-        utils.delete_uv_layers(ob_base_copy)
-        ob_base_copy.parent = None
-        ob_base_copy.matrix_world.translation = (0, 0, 0)
-
-        ob_base_morphed_copy = None
+        # base morph deltas from the coordinates of the base mesh and the morphed one (shape keys mixed,
+        # or the hd mesh's base level), both without modifiers, read without copying the objects
+        base_positions = utils.get_basis_positions(self.base_ob)
         if self.morphed_base_ob is not None:
-            ob_base_morphed_copy = utils.copy_object(self.morphed_base_ob)
-            utils.apply_shape_keys(ob_base_morphed_copy)
+            morphed_positions = utils.get_shape_keys_mix(self.morphed_base_ob)
         else:
-            ob_base_morphed_copy = utils.copy_object(self.hd_ob)
-            utils.remove_shape_keys(ob_base_morphed_copy)
-        ob_base_morphed_copy.modifiers.clear()
-        ob_base_morphed_copy.vertex_groups.clear()
-        ob_base_morphed_copy.data.materials.clear()
-        utils.delete_uv_layers(ob_base_morphed_copy)
-        ob_base_morphed_copy.parent = None
-        ob_base_morphed_copy.matrix_world.translation = (0, 0, 0)
+            morphed_positions = utils.get_basis_positions(self.hd_ob)
+        assert( len(morphed_positions) == len(base_positions) )
 
-        assert( len(ob_base_morphed_copy.data.vertices) == len(ob_base_copy.data.vertices) )
-        delta_dz_min_len = 1e-3
-        deltas_values = []
-        for i, v in enumerate(ob_base_copy.data.vertices):
-            delta_blend = Vector( ob_base_morphed_copy.data.vertices[i].co - v.co )
-            delta_dz = (1.0 / self.gScale) * (self.blend_to_dz_mat @ delta_blend)
-            if delta_dz.length > delta_dz_min_len:
-                deltas_values.append( [i, delta_dz[0], delta_dz[1], delta_dz[2]] )
-        utils.delete_object(ob_base_copy)
-        utils.delete_object(ob_base_morphed_copy)
+        mat = np.array(self.blend_to_dz_mat, dtype=np.float64)
+        deltas_values = core.get_base_morph_deltas( base_positions @ mat.T, morphed_positions @ mat.T,
+                                                    self.gScale, min_len=self.delta_dz_min_len )
 
         base_morph_info = {}
         base_morph_info["count"] = len(deltas_values)
@@ -130,149 +114,141 @@ class GenerateNewMorphFiles(dhdmGenBaseOperator):
         addon_props = context.scene.daz_dhdm_gen
         if (addon_props.output_type == 'DHDM'):
             return True
-        dsf_new_id = self.morph_name
-
-        if (addon_props.output_type == 'DSF_TEMPLATE'):
-            dsf_fp_templ = os.path.abspath( bpy.path.abspath(addon_props.dsf_file_template) )
-            if not utils.has_extension( dsf_fp_templ, "dsf" ):
-                self.report({'ERROR'}, "Invalid Template .dsf file.")
-                return False
-            if not os.path.isfile(dsf_fp_templ):
-                self.report({'ERROR'}, "Template .dsf file not found.")
-                return False
-            dsf_fp = utils.copy_file( dsf_fp_templ, self.morph_files_diroutput, dsf_new_id )
-            del dsf_fp_templ
-        else:   # addon_props.output_type == 'DSF_BASIC'
-            dsf_fp_templ = os.path.join(os.path.dirname(__file__), "other_files", "dhdmGenHDMorph.dsf")
-            if not os.path.isfile(dsf_fp_templ):
-                self.report({'ERROR'}, "Basic template .dsf file not found.")
-                return False
-            dsf_fp = utils.copy_file( dsf_fp_templ, self.morph_files_diroutput, dsf_new_id )
-            del dsf_fp_templ
 
         print("Generating dsf file...")
         base_morph_info = self.get_base_morph_info(context)
-        dsf_j = utils.get_dsf_json(dsf_fp)
         try:
-            dsf_orig_asset_id = os.path.basename(dsf_j["asset_info"]["id"]).rsplit(".", 1)[0]
-            dsf_orig_id = dsf_j["modifier_library"][0]["id"]
-            dsf_morph = dsf_j["modifier_library"][0]["morph"]
-
-            if (addon_props.output_type == 'DSF_BASIC'):
-                dsf_morph["vertex_count"] = len(self.base_ob.data.vertices)
-                dz_dir = addon_props.morph_daz_directory.strip().replace("\\","/")
-                if not dz_dir:
-                    os.remove(dsf_fp)
-                    self.report({'ERROR'}, "No morph daz directory given.")
-                    return False
-                if not dz_dir.startswith('/'):
-                    os.remove(dsf_fp)
-                    self.report({'ERROR'}, "Morph daz directory given is invalid (must start with '/').")
-                    return False
-                dz_dir = quote(dz_dir, safe="/#")
-                dsf_j["asset_info"]["id"] = os.path.join(dz_dir, dsf_orig_id + ".dsf").replace("\\","/")
-                dsf_morph["hd_url"] = dsf_j["asset_info"]["id"].rsplit(".", 1)[0] + ".dhdm"
-                base_ob_url = getattr(self.base_ob, "DazUrl", "").strip()
-                if len(base_ob_url) > 0:
-                    base_ob_url = quote(base_ob_url.replace("\\","/"), safe="/#")
-                    dsf_j["modifier_library"][0]["parent"] = base_ob_url
-                else:
-                    self.to_complete = True
-            else:  # addon_props.output_type == 'DSF_TEMPLATE'
-                vcount = dsf_morph["vertex_count"]
-                if (vcount != -1) and (vcount != len(self.base_ob.data.vertices)):
-                    os.remove(dsf_fp)
-                    self.report({'ERROR'}, "Template .dsf file given is not valid for specified base mesh.")
-                    return False
-                dsf_morph["hd_url"] = dsf_j["asset_info"]["id"].rsplit(".", 1)[0] + ".dhdm"
-
-            dsf_morph["deltas"]["count"] = base_morph_info["count"]
-            dsf_morph["deltas"]["values"] = base_morph_info["values"]
-
-        except KeyError as e:
-            os.remove(dsf_fp)
-            self.report({'ERROR'}, ".dsf file has invalid structure.")
+            dsf_fp, self.to_complete = core.write_morph_dsf(
+                                            addon_props.output_type,
+                                            os.path.abspath( bpy.path.abspath(addon_props.dsf_file_template) ),
+                                            self.morph_files_diroutput, self.morph_name,
+                                            len(self.base_ob.data.vertices), base_morph_info,
+                                            morph_daz_directory=addon_props.morph_daz_directory,
+                                            parent_url=getattr(self.base_ob, "DazUrl", ""),
+                                            gzip_level=self.gzip_level, num_threads=self.num_threads )
+        except ValueError as e:
+            self.report({'ERROR'}, str(e))
             return False
-
-        if ("scene" in dsf_j) and ("modifiers" in dsf_j["scene"]):
-            dsf_modif = dsf_j["scene"]["modifiers"]
-            n = 0
-            for e in dsf_modif:
-                if (e["id"] == dsf_orig_id) or (e["id"] == dsf_orig_asset_id):
-                    e["id"] = "{}-{}".format(e["id"], n)
-                    n += 1
-            del n, dsf_modif
-
-        if ("modifier_library" in dsf_j):
-            dsf_modif_lib = dsf_j["modifier_library"]
-            for e in dsf_modif_lib:
-                if ("channel" not in e) or ("label" not in e["channel"]):
-                    continue
-                if (e["id"] == dsf_orig_id) or (e["id"] == dsf_orig_asset_id):
-                    e["channel"]["label"] = dsf_new_id
-            del dsf_modif_lib
-
-        dsf_text = json.dumps(dsf_j)
-        for dsf_id in [dsf_orig_id, dsf_orig_asset_id]:
-            exp = "([^\w]){0}([^\w])".format(dsf_id)
-            exp = re.compile(exp)
-            str_sub = "\g<1>{0}\g<2>".format(dsf_new_id)
-            dsf_text = exp.sub(str_sub, dsf_text)
-
-        utils.text_to_json_file(dsf_fp, dsf_text, with_gzip=(not self.to_complete), indent=4)
         print("Finished generating .dsf file \"{0}\".".format(dsf_fp))
         return True
 
     def generate_dhdm_file(self, context):
         print("Generating dhdm file...")
-        filepaths_list = self.mfiles.get_filepaths(self.hd_level, self.base_subdiv_method)
+        self.set_status(context, "exporting meshes...")
+        yield
+        with self.trace.stage("matching_lookup"):
+            filepaths_list = self.mfiles.get_filepaths(self.hd_level, self.base_subdiv_method)
+        self.trace.info.update( hd_level=self.hd_level, base_subdiv_method=self.base_subdiv_method,
+                                use_mesh_buffers=self.use_mesh_buffers, num_threads=self.num_threads,
+                                sparse_refine=self.sparse_refine, low_memory_mb=self.low_memory_mb,
+                                base_vertices=len(self.base_ob.data.vertices) )
 
         base_ob_copy = None
-        if self.morphed_base_ob is not None:
-            base_ob_copy = utils.copy_object(self.morphed_base_ob)
-            utils.apply_shape_keys(base_ob_copy)
-        else:
-            base_ob_copy = utils.copy_object(self.hd_ob)
-            utils.remove_shape_keys(base_ob_copy)
+        with self.trace.stage("copy_object"):
+            if self.morphed_base_ob is not None:
+                base_ob_copy = utils.copy_object(self.morphed_base_ob)
+                utils.apply_shape_keys(base_ob_copy)
+            else:
+                base_ob_copy = utils.copy_object(self.hd_ob)
+                utils.remove_shape_keys(base_ob_copy)
         base_ob_copy.modifiers.clear()
         base_ob_copy.vertex_groups.clear()
         utils.delete_uv_layers(base_ob_copy)
         base_ob_copy.parent = None
         base_ob_copy.matrix_world.translation = (0, 0, 0)
 
+        cache = self.get_mesh_cache()
+        with self.trace.stage("get_mesh_arrays"):
+            base_arrays = utils.get_mesh_arrays( base_ob_copy, apply_modifiers=False )
         f_name_base = "base"
-        fp_base = self.export_ob_obj( base_ob_copy, f_name_base, apply_modifiers=False )
+        if self.use_mesh_buffers:
+            base_exp = base_arrays
+        else:
+            base_exp = self.export_ob_mesh( base_ob_copy, f_name_base, apply_modifiers=False )
 
-        f_name = f_name_base + "_hd_no_edit"
+        # The base mesh subdivided without the hd edits is only used to find the edited vertices,
+        # only its positions are kept. They only depend on the base mesh and the subdivision settings.
+        subdiv_settings = ( self.base_subdiv_method, self.hd_level, tuple(bpy.app.version) )
         if self.base_subdiv_method == 'MULTIRES':
-            base_ob_copy.data.materials.clear()
-            utils.subdivide_object_m(base_ob_copy, self.subd_m, self.hd_level)
-            fp_hd_no_edit = self.export_ob_obj( base_ob_copy, f_name, apply_modifiers=True )
+            subdiv_settings += ( self.subd_m.quality, self.subd_m.uv_smooth, self.subd_m.boundary_smooth,
+                                 self.subd_m.use_creases, self.subd_m.use_custom_normals )
+        else:
+            subdiv_settings += ( self.gScale, )
+        hd_no_edit_key = utils.get_mesh_hash( *base_arrays, "hd_no_edit_positions", *subdiv_settings )
+        del base_arrays
+
+        hd_no_edit_positions = None
+        if cache is not None:
+            cached = cache.get_arrays(hd_no_edit_key)
+            if cached is not None:
+                hd_no_edit_positions = cached[0]
+        hd_no_edit_cached = (hd_no_edit_positions is not None)
+        self.trace.count("mesh_cache_hits" if hd_no_edit_cached else "mesh_cache_misses")
+        if hd_no_edit_cached:
+            print("Using cached subdivided base mesh ({0}).".format(hd_no_edit_key))
+            utils.delete_object(base_ob_copy)
+        elif self.base_subdiv_method == 'MULTIRES':
+            with self.trace.stage("subdivide_object_m"):
+                utils.subdivide_object_m(base_ob_copy, self.subd_m, self.hd_level)
+            with self.trace.stage("get_mesh_arrays"):
+                hd_no_edit_positions = utils.get_mesh_arrays( base_ob_copy, apply_modifiers=True, positions_only=True )
             utils.delete_object(base_ob_copy)
         else: # MULTIRES_REC
             outputDirpath = self.create_temporary_subdir()
-            hd_base = utils.api_generate_simple_hd_mesh(context, base_ob_copy, self.hd_level, self.gScale, outputDirpath)
+            with self.trace.stage("api_generate_simple_hd_mesh"):
+                hd_base = utils.api_generate_simple_hd_mesh(context, base_ob_copy, self.hd_level, self.gScale, outputDirpath)
             utils.delete_object(base_ob_copy)
             if hd_base is None:
                 print("Required addon \"daz_hd_morphs\" not found or function api_generate_simple_hd_mesh() failed.")
                 self.report({'ERROR'}, "Operator failed (see console output).")
                 return False
             utils.create_unsubdivide_multires(hd_base)
-            fp_hd_no_edit = self.export_ob_obj( hd_base, f_name, apply_modifiers=True )
+            hd_no_edit_positions = utils.get_mesh_arrays( hd_base, apply_modifiers=True, positions_only=True )
             utils.delete_object(hd_base)
             del hd_base, outputDirpath
+        if cache is not None and not hd_no_edit_cached:
+            cache.put_arrays( hd_no_edit_key, (hd_no_edit_positions,) )
         del base_ob_copy
 
         hd_ob_ms = utils.ModifiersStatus(self.hd_ob, 'ENABLE_ONLY', m_types={'SUBDIV'})
         f_name = f_name_base + "_hd_edit"
-        fp_hd_edit = self.export_ob_obj( self.hd_ob, f_name, apply_modifiers=True )
+        hd_edit_exp = self.export_ob_mesh( self.hd_ob, f_name, apply_modifiers=True )
+        if self.use_mesh_buffers:
+            hd_edit_positions = hd_edit_exp[0]
+        else:
+            with self.trace.stage("get_mesh_arrays"):
+                hd_edit_positions = utils.get_mesh_arrays( self.hd_ob, apply_modifiers=True, positions_only=True )
         hd_ob_ms.restore()
         del hd_ob_ms
 
-        dll_wrapper.execute_in_new_thread( "generate_dhdm_file",
-                                           self.gScale, fp_base, self.hd_level,
-                                           self.morph_files_diroutput, self.morph_name,
-                                           filepaths_list )
+        # the dll gets the edited vertices instead of the whole hd mesh without edits
+        with self.trace.stage("edited_mask"):
+            edited_mask = utils.get_edited_mask( hd_no_edit_positions, hd_edit_positions, self.gScale )
+        self.trace.info["hd_vertices"] = len(hd_edit_positions)
+        del hd_no_edit_positions, hd_edit_positions
+        self.trace.count("edited_vertices", int(edited_mask.sum()))
+        print("Vertices detected as edited: {0}.".format(int(edited_mask.sum())))
+
+        session = dll_wrapper.get_session(self.session_cache_mb)
+        dll_stats = {}
+        self.set_status(context, "calculating displacements...")
+        if self.use_mesh_buffers:
+            yield from self.run_dll_job( dll_wrapper.call_dll_function, "generate_dhdm_file_from_buffers",
+                                         self.gScale, self.hd_level,
+                                         self.morph_files_diroutput, self.morph_name,
+                                         filepaths_list,
+                                         base_exp, None, hd_edit_exp,
+                                         self.num_threads, self.sparse_refine, session,
+                                         edited_mask=edited_mask, low_memory_mb=self.low_memory_mb,
+                                         stats=dll_stats, with_progress=True )
+        else:
+            yield from self.run_dll_job( dll_wrapper.call_dll_function, "generate_dhdm_file",
+                                         self.gScale, base_exp, self.hd_level,
+                                         self.morph_files_diroutput, self.morph_name,
+                                         filepaths_list, self.num_threads, self.sparse_refine,
+                                         session, edited_mask=edited_mask, low_memory_mb=self.low_memory_mb,
+                                         stats=dll_stats, with_progress=True )
+        self.trace.add_dll_stats(dll_stats)
 
         fp_dhdm = os.path.join(self.morph_files_diroutput, self.morph_name + ".dhdm")
         print("Finished generating .dhdm file \"{0}\".".format(fp_dhdm))
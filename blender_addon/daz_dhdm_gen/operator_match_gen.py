@@ -1,13 +1,10 @@
-import bpy, os, time, mathutils, json
+import bpy, os, json
+import numpy as np
 from . import dll_wrapper
 from . import utils
 from .operator_common import dhdmGenBaseOperator, MatchedFiles
 
 
-class GeoMatch:
-    def __init__(self, d_vn):
-        self.d_vn = d_vn
-
 class GenerateMatching(dhdmGenBaseOperator):
     """Generate matching files for base mesh"""
     bl_idname = "dazdhdmgen.generatematch"
@@ -18,6 +15,19 @@ class GenerateMatching(dhdmGenBaseOperator):
     force_new:  bpy.props.BoolProperty( name="Overwrite all", default=False,
                                         description="Force generation of files for all subdivision levels, overwriting any existing compatible files" )
 
+    match_method:   bpy.props.EnumProperty(
+                            name = "Matching",
+                            items = (
+                                ("TOPOLOGY", "Topology", "Exact matching by walking the faces of both subdivided meshes (falls back to distance if it fails)"),
+                                ("DISTANCE", "Distance", "Match every vertex to the nearest one")
+                            ),
+                            default = "TOPOLOGY" )
+
+    # a matched vertex farther than max_dist is non-optimal, more than max_non_optimal_n of them cancel the matching
+    max_dist = 3e-3
+    max_non_optimal_n = 50
+    max_non_optimal_print_n = 20
+
     with_mrr = None
 
     def invoke(self, context, event):
@@ -33,15 +43,18 @@ class GenerateMatching(dhdmGenBaseOperator):
         row.prop(self, "hd_level_max")
         row = layout.row()
         row.prop(self, "force_new")
+        row = layout.row()
+        row.prop(self, "match_method")
 
-    def execute(self, context):
-        t0 = time.perf_counter()
+    def run_steps(self, context):
         if not self.check_input(context, check_hd=False, check_morph_name=False):
             return {'CANCELLED'}
 
         self.with_mrr = True
-        r = self.generate_matches(context)
-        self.cleanup(context)
+        try:
+            r = yield from self.generate_matches(context)
+        finally:
+            self.cleanup(context)
         if not r:
             return {'CANCELLED'}
 
@@ -49,20 +62,25 @@ class GenerateMatching(dhdmGenBaseOperator):
             self.report({'INFO'}, "Matching file/s generated.")
         else:
             self.report({'WARNING'}, "File/s generated only for direct subdiv method (see console output).")
-        print("Elapsed: {}".format(time.perf_counter() - t0))
         return {'FINISHED'}
 
-    def create_matching_file(self, gm, level, mrm):
+    def create_matching_file(self, indices, level, mrm):
         print("Writing matching file...")
         if not os.path.isdir(self.matching_files_dir):
             raise RuntimeError("Directory \"{0}\" not found.".format(self.matching_files_dir))
-        filename = "f{0}_div{1}_{2}.json".format( self.mfiles.fingerprint, level, mrm )
+        filename = utils.get_matching_filename( self.mfiles.fingerprint, level, mrm,
+                                                topology_hash=self.mfiles.topology_hash )
         fp = os.path.join(self.matching_files_dir, filename)
-        utils.j_to_json_file(fp, gm.d_vn, with_gzip=True, indent=None)
+        utils.write_matching_file(fp, indices, self.mfiles.fingerprint, level, mrm,
+                                  topology_hash=self.mfiles.topology_hash)
+        self.mfiles.update()
         print("File \"{0}\" generated.".format(fp))
 
     def generate_matches(self, context):
-        ob_base_copy = utils.copy_object(self.base_ob)
+        self.trace.info.update( hd_level_max=self.hd_level_max, match_method=self.match_method,
+                                base_vertices=len(self.base_ob.data.vertices) )
+        with self.trace.stage("copy_object"):
+            ob_base_copy = utils.copy_object(self.base_ob)
         ob_base_copy.modifiers.clear()
         utils.remove_shape_keys(ob_base_copy)
         utils.delete_uv_layers(ob_base_copy)
@@ -70,11 +88,9 @@ class GenerateMatching(dhdmGenBaseOperator):
         ob_base_copy.parent = None
         ob_base_copy.matrix_world.translation = (0, 0, 0)
 
-        ob_base_copy_2 = utils.copy_object(ob_base_copy)
+        with self.trace.stage("copy_object"):
+            ob_base_copy_2 = utils.copy_object(ob_base_copy)
         ob_base_copy.data.materials.clear()
-
-        f_name = "base"
-        fp_base = self.export_ob_obj( ob_base_copy, f_name, apply_modifiers=False )
         outputDirpath = self.create_temporary_subdir()
 
         missing_levels_mr = None
@@ -92,6 +108,24 @@ class GenerateMatching(dhdmGenBaseOperator):
             self.report({'INFO'}, "Matching file/s already exist.")
             return False
 
+        # the dll refines the base mesh once and returns the vertices and faces of all the missing levels
+        # (in the .obj files' space, like the multires positions below)
+        hd_levels_arrays = {}
+        if len(missing_levels_mr) > 0:
+            base_arrays = utils.get_mesh_arrays( ob_base_copy, apply_modifiers=False )
+            self.set_status(context, "subdividing base mesh (levels {0})...".format(missing_levels_mr))
+            try:
+                hd_levels_arrays = yield from self.run_dll_job( dll_wrapper.call_dll_function, "generate_hd_levels",
+                                                                base_arrays, max(missing_levels_mr),
+                                                                set(missing_levels_mr),
+                                                                cancel_check=lambda: self.cancel_requested,
+                                                                with_faces=True )
+            except dll_wrapper.JobCanceled as e:
+                utils.delete_object(ob_base_copy)
+                utils.delete_object(ob_base_copy_2)
+                raise e
+            del base_arrays
+
         mr = utils.create_multires_modifier(ob_base_copy)
         mr.show_viewport = True
 
@@ -100,36 +134,42 @@ class GenerateMatching(dhdmGenBaseOperator):
             bpy.ops.object.multires_subdivide(modifier=mr.name, mode='CATMULL_CLARK')
             if (level not in missing_levels_mr) and (level not in missing_levels_mrr):
                 continue
+            if self.cancel_requested:
+                utils.delete_object(ob_base_copy)
+                utils.delete_object(ob_base_copy_2)
+                raise dll_wrapper.JobCanceled()
+            self.set_status(context, "matching level {0}/{1}...".format(level, self.hd_level_max))
+            yield
             print("Performing matching for level {0}...".format(level))
 
             if level in missing_levels_mr:
-                outputFilename = "{0}-div{1}".format(utils.makeValidFilename(self.base_ob.name), level)
-                dll_wrapper.execute_in_new_thread( "generate_hd_mesh",
-                                                   self.gScale, fp_base, level,
-                                                   outputDirpath, outputFilename )
-                hd_dz_ob = utils.import_dll_obj(os.path.join(outputDirpath, outputFilename + ".obj"))
-                ds = context.evaluated_depsgraph_get()
-                ob_base_copy_eval = ob_base_copy.evaluated_get(ds)
-                if len(hd_dz_ob.data.vertices) != len(ob_base_copy_eval.data.vertices):
+                hd_dz_arrays = hd_levels_arrays.pop(level)
+                with self.trace.stage("get_mesh_arrays"):
+                    hd_mr_arrays = utils.get_mesh_arrays( ob_base_copy, apply_modifiers=True )
+                if len(hd_dz_arrays[0]) != len(hd_mr_arrays[0]):
                     raise RuntimeError("Vertex count mismatch.")
-                print("Matching vertices by distance (mr)...")
-                gm = self.create_matching_map_distance( ob_base_copy_eval, hd_dz_ob )
-                if gm is None:
+                print("Matching vertices (mr)...")
+                try:
+                    indices = yield from self.create_matching_map( hd_mr_arrays, hd_dz_arrays )
+                except dll_wrapper.JobCanceled as e:
+                    utils.delete_object(ob_base_copy)
+                    utils.delete_object(ob_base_copy_2)
+                    raise e
+                del hd_dz_arrays, hd_mr_arrays
+                if indices is None:
                     self.report({'ERROR'}, "Matching between meshes not found.")
-                    utils.delete_object(hd_dz_ob)
                     utils.delete_object(ob_base_copy)
+                    utils.delete_object(ob_base_copy_2)
                     return False
                 print("Done matching vertices (mr).")
                 print()
                 try:
-                    self.create_matching_file(gm, level, "mr")
+                    self.create_matching_file(indices, level, "mr")
                 except Exception as e:
                     utils.delete_object(ob_base_copy)
                     utils.delete_object(ob_base_copy_2)
                     self.report({'ERROR'}, "Generation of matching file failed.")
                     raise e
-                finally:
-                    utils.delete_object(hd_dz_ob)
 
             if (self.with_mrr) and (level in missing_levels_mrr):
                 hd_dz_ob = utils.api_generate_simple_hd_mesh(context, ob_base_copy_2, level, self.gScale, outputDirpath)
@@ -139,13 +179,21 @@ class GenerateMatching(dhdmGenBaseOperator):
                 else:
                     hd_dz_ob_copy = utils.copy_object(hd_dz_ob)
                     utils.create_unsubdivide_multires(hd_dz_ob_copy)
-                    ds = context.evaluated_depsgraph_get()
-                    hd_dz_ob_copy_eval = hd_dz_ob_copy.evaluated_get(ds)
-                    if len(hd_dz_ob.data.vertices) != len(hd_dz_ob_copy_eval.data.vertices):
+                    hd_dz_arrays = utils.get_mesh_arrays( hd_dz_ob, apply_modifiers=False )
+                    hd_mrr_arrays = utils.get_mesh_arrays( hd_dz_ob_copy, apply_modifiers=True )
+                    if len(hd_dz_arrays[0]) != len(hd_mrr_arrays[0]):
                         raise RuntimeError("Vertex count mismatch.")
-                    print("Matching vertices by distance (mrr)...")
-                    gm = self.create_matching_map_distance( hd_dz_ob_copy_eval, hd_dz_ob )
-                    if gm is None:
+                    print("Matching vertices (mrr)...")
+                    try:
+                        indices = yield from self.create_matching_map( hd_mrr_arrays, hd_dz_arrays )
+                    except dll_wrapper.JobCanceled as e:
+                        utils.delete_object(hd_dz_ob)
+                        utils.delete_object(hd_dz_ob_copy)
+                        utils.delete_object(ob_base_copy)
+                        utils.delete_object(ob_base_copy_2)
+                        raise e
+                    del hd_dz_arrays, hd_mrr_arrays
+                    if indices is None:
                         self.report({'ERROR'}, "Matching between meshes not found.")
                         utils.delete_object(hd_dz_ob)
                         utils.delete_object(hd_dz_ob_copy)
@@ -153,7 +201,7 @@ class GenerateMatching(dhdmGenBaseOperator):
                     print("Done matching vertices (mrr).")
                     print()
                     try:
-                        self.create_matching_file(gm, level, "mrr")
+                        self.create_matching_file(indices, level, "mrr")
                     except Exception as e:
                         utils.delete_object(ob_base_copy)
                         utils.delete_object(ob_base_copy_2)
@@ -167,27 +215,41 @@ class GenerateMatching(dhdmGenBaseOperator):
         utils.delete_object(ob_base_copy_2)
         return True
 
-    def create_matching_map_distance(self, hd_mr_ob, hd_dz_ob):
-        kd = mathutils.kdtree.KDTree(len(hd_mr_ob.data.vertices))
-        for i, v in enumerate(hd_mr_ob.data.vertices):
-            kd.insert(v.co, i)
-        kd.balance()
-
-        max_dist = 3e-3
-        max_non_optimal_n = 50
-        max_non_optimal_print_n = 20
-        non_optimal_n = 0
-        d_vn = {}
-        for j, v in enumerate(hd_dz_ob.data.vertices):
-            co, i, dist = kd.find(v.co)
-            if dist > max_dist:
-                non_optimal_n += 1
-                if non_optimal_n < max_non_optimal_print_n:
-                    print("WARNING: vertex matching wasn't optimal (distance = {0}).".format(dist))
-                if non_optimal_n > max_non_optimal_n:
-                    self.report({'ERROR'}, "Canceled: more than {0} non-optimal matches.".format(max_non_optimal_n))
-                    return None
-            d_vn[j] = i
-
-        gm = GeoMatch(d_vn)
-        return gm
+    def create_matching_map(self, hd_mr_arrays, hd_dz_arrays):
+        # generator: hd_dz vertex j -> index of the hd_mr vertex at the same place (mesh arrays as
+        # utils.get_mesh_arrays(), in the same space), None if not found
+        if self.match_method == 'TOPOLOGY':
+            try:
+                indices, stats = yield from self.run_dll_job( dll_wrapper.call_dll_function, "match_vertices_topology",
+                                                              hd_mr_arrays, hd_dz_arrays, self.max_dist )
+            except RuntimeError:
+                print("Topology matching failed, matching by distance.")
+            else:
+                print("Matching distances: max {0:.6g}, mean {1:.6g}.".format(stats["max_dist"], stats["mean_dist"]))
+                # the topologies match, but not the geometry (e.g. a symmetric part matched to its mirror image)
+                if stats["non_optimal_n"] <= self.max_non_optimal_n:
+                    return indices
+                print("Topology matching: {0} vertices farther than {1}, matching by distance.".format(
+                            stats["non_optimal_n"], self.max_dist))
+        print("Matching vertices by distance...")
+        return (yield from self.create_matching_map_distance( hd_mr_arrays[0], hd_dz_arrays[0] ))
+
+    def create_matching_map_distance(self, hd_mr_positions, hd_dz_positions):
+        # generator: hd_dz vertex j -> index of the nearest hd_mr vertex (both given as (n, 3) arrays
+        # in the same space), None if there are too many non-optimal matches
+        max_dist = self.max_dist
+        max_non_optimal_n = self.max_non_optimal_n
+        max_non_optimal_print_n = self.max_non_optimal_print_n
+
+        indices, distances, stats = yield from self.run_dll_job( dll_wrapper.call_dll_function, "match_vertices",
+                                                                 hd_mr_positions, hd_dz_positions,
+                                                                 max_dist, self.num_threads )
+        print("Matching distances: max {0:.6g}, mean {1:.6g}.".format(stats["max_dist"], stats["mean_dist"]))
+        non_optimal = np.flatnonzero(distances > max_dist)
+
+        for j in non_optimal[:max_non_optimal_print_n - 1]:
+            print("WARNING: vertex matching wasn't optimal (distance = {0}).".format(distances[j]))
+        if len(non_optimal) > max_non_optimal_n:
+            self.report({'ERROR'}, "Canceled: more than {0} non-optimal matches.".format(max_non_optimal_n))
+            return None
+        return indices
@@ -0,0 +1,299 @@
+# Runs the morphs of a manifest (see cli.py) in several worker processes.
+#
+#     python -m daz_dhdm_gen.scheduler manifest.json --workers 4 [--blender /path/to/blender]
+#
+# Entries are grouped in shards of entries sharing a base mesh (pre-exported entries) or a .blend file
+# (blender entries), so a worker reuses its dll session / opened file. Each shard runs in its own
+# process: "python -m daz_dhdm_gen.cli" for pre-exported entries, "blender -b" for the others.
+# A shard is only started if the estimated memory of the running shards stays under --memory-mb.
+# Failed entries are retried in new shards (--retries), then a summary of the outputs, timings and
+# errors of all entries is written (--summary, default: <work dir>/summary.json).
+#
+# Memory estimates: "memory_mb" of the entry if set, from the sizes of the .obj files for pre-exported
+# entries, --default-job-mb for blender entries. The summary has the peak memory of the worker of every
+# entry ("peak_rss_mb", Linux/macOS), a measured base for "memory_mb" (see also "low_memory_mb" in cli.py).
+
+import os, sys, json, time, argparse, tempfile, subprocess
+import collections
+
+from . import core
+from .cli import read_manifest, entry_path, ManifestError
+
+
+class Shard:
+    def __init__(self, key, entries, attempt):
+        self.key = key
+        self.entries = entries          # (index in manifest, entry)
+        self.attempt = attempt
+        self.memory = 0
+        self.generate_matching = False
+        self.process = None
+        self.log_fp = None
+        self.summary_fp = None
+        self.t_start = None
+
+    def is_blender(self):
+        return "base_mesh" not in self.entries[0][1]
+
+
+def get_physical_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def estimate_entry_memory(entry, manifest_dir, default_job_mb):
+    if "memory_mb" in entry:
+        return int(entry["memory_mb"]) << 20
+    if "base_mesh" not in entry:
+        return default_job_mb << 20
+    # the hd meshes dominate: as arrays in python, as dhdm::Mesh and refined topology in the dll,
+    # about 5 times the size of their .obj files
+    n = 0
+    for key in ("hd_mesh", "hd_base_mesh"):
+        try:
+            n += os.path.getsize( entry_path(entry, key, manifest_dir) )
+        except OSError:
+            pass
+    return 5 * n + (256 << 20)
+
+def make_shards(entries, batch_size):
+    groups = collections.OrderedDict()
+    for i, e in enumerate(entries):
+        key = e["base_mesh"] if "base_mesh" in e else "blend:{0}".format(e.get("blend_file", ""))
+        groups.setdefault(key, []).append( (i, e) )
+    shards = []
+    for key, group in groups.items():
+        for i in range(0, len(group), batch_size):
+            shards.append( Shard(key, group[i:i + batch_size], 1) )
+    return shards
+
+
+class Scheduler:
+    def __init__(self, args, manifest, entries, manifest_dir, work_dir):
+        self.args = args
+        self.manifest = manifest
+        self.entries = entries
+        self.manifest_dir = manifest_dir
+        self.work_dir = work_dir
+        self.memory_budget = None
+        if args.memory_mb:
+            self.memory_budget = args.memory_mb << 20
+        else:
+            m = get_physical_memory()
+            if m:
+                self.memory_budget = int(m * 0.75)
+
+        self.pending = collections.deque()
+        self.running = []
+        self.nr_shards = 0
+        self.results = {}               # manifest index -> result
+        self.attempts = collections.Counter()
+        self.matching_keys_pending = set()
+
+    def add_shard(self, shard):
+        memories = [ estimate_entry_memory(e, self.manifest_dir, self.args.default_job_mb) for _, e in shard.entries ]
+        # the entries of a shard run one after the other
+        shard.memory = max(memories)
+        if not shard.is_blender() and self.args.session_cache_mb > 0:
+            shard.memory += self.args.session_cache_mb << 20
+        self.pending.append(shard)
+
+    def memory_used(self):
+        return sum(s.memory for s in self.running)
+
+    def can_start(self, shard):
+        # matching files are generated by the first shard of each .blend file, one at a time since
+        # .blend files can share a figure, and the other shards of the file wait for them
+        if shard.generate_matching:
+            if any(s.generate_matching for s in self.running):
+                return False
+        elif shard.key in self.matching_keys_pending:
+            return False
+        if len(self.running) == 0:
+            return True
+        if len(self.running) >= self.args.workers:
+            return False
+        if self.memory_budget is not None and self.memory_used() + shard.memory > self.memory_budget:
+            return False
+        return True
+
+    def worker_command(self, shard, manifest_fp):
+        cli_args = [ manifest_fp, "--base-dir", self.manifest_dir, "--summary", shard.summary_fp ]
+        if shard.is_blender():
+            cmd = [ self.args.blender, "-b" ]
+            if "blend_file" in shard.entries[0][1]:
+                cmd.append( entry_path(shard.entries[0][1], "blend_file", self.manifest_dir) )
+            cli_fp = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cli.py")
+            return cmd + [ "--python", cli_fp, "--" ] + cli_args
+        cmd = [ sys.executable, "-m", __package__ + ".cli" ] + cli_args
+        cmd += [ "--session-cache-mb", str(self.args.session_cache_mb) ]
+        if self.args.dll:
+            cmd += [ "--dll", os.path.abspath(self.args.dll) ]
+        return cmd
+
+    def start(self, shard):
+        self.nr_shards += 1
+        name = "shard_{0:03d}_attempt_{1}".format(self.nr_shards, shard.attempt)
+        manifest_fp = os.path.join(self.work_dir, name + ".json")
+        shard.summary_fp = os.path.join(self.work_dir, name + "_summary.json")
+        shard.log_fp = os.path.join(self.work_dir, name + ".log")
+
+        shard_manifest = { "morphs": [ e for _, e in shard.entries ] }
+        if shard.generate_matching:
+            shard_manifest["generate_matching"] = self.manifest["generate_matching"]
+        core.j_to_json_file(manifest_fp, shard_manifest, with_gzip=False, indent=1)
+
+        env = dict(os.environ)
+        package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env["PYTHONPATH"] = os.pathsep.join( p for p in (package_parent, env.get("PYTHONPATH")) if p )
+
+        print("Starting {0}: {1} ({2} MB estimated).".format( name, ", ".join(e["name"] for _, e in shard.entries),
+                                                              shard.memory >> 20 ))
+        with open(shard.log_fp, "w", encoding="utf-8") as log_f:
+            shard.process = subprocess.Popen( self.worker_command(shard, manifest_fp), env=env,
+                                              stdout=log_f, stderr=subprocess.STDOUT )
+        shard.t_start = time.perf_counter()
+        for i, _ in shard.entries:
+            self.attempts[i] += 1
+        self.running.append(shard)
+
+    def read_shard_results(self, shard):
+        try:
+            with open(shard.summary_fp, "r", encoding="utf-8") as f:
+                return { r["name"]: r for r in json.load(f)["entries"] }
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def finish(self, shard):
+        self.running.remove(shard)
+        returncode = shard.process.returncode
+        shard_results = self.read_shard_results(shard)
+        to_retry = []
+        for i, e in shard.entries:
+            r = shard_results.get(e["name"])
+            if r is None:
+                # crashed or killed before finishing this entry
+                r = { "name": e["name"], "status": "failed", "outputs": [], "seconds": None,
+                      "error": "Worker exited with code {0} (see log).".format(returncode) }
+            r["attempts"] = self.attempts[i]
+            r["log"] = shard.log_fp
+            self.results[i] = r
+            if r["status"] != "ok" and self.attempts[i] <= self.args.retries:
+                to_retry.append( (i, e) )
+
+        nr_failed = sum(1 for i, _ in shard.entries if self.results[i]["status"] != "ok")
+        print("Finished {0} in {1:.1f} s: {2} generated, {3} failed.".format(
+                os.path.basename(shard.log_fp)[:-4], time.perf_counter() - shard.t_start,
+                len(shard.entries) - nr_failed, nr_failed ))
+        if to_retry:
+            print("Retrying: {0}.".format(", ".join(e["name"] for _, e in to_retry)))
+            retry_shard = Shard(shard.key, to_retry, shard.attempt + 1)
+            retry_shard.generate_matching = shard.generate_matching
+            self.add_shard(retry_shard)
+        elif shard.generate_matching:
+            self.matching_keys_pending.discard(shard.key)
+
+    def run(self):
+        for shard in make_shards(self.entries, self.args.batch_size):
+            if shard.is_blender() and self.manifest.get("generate_matching") and \
+               shard.key not in self.matching_keys_pending:
+                shard.generate_matching = True
+                self.matching_keys_pending.add(shard.key)
+            self.add_shard(shard)
+
+        while self.pending or self.running:
+            # in manifest order, a shard that doesn't fit yet doesn't block smaller ones behind it
+            for shard in list(self.pending):
+                if self.can_start(shard):
+                    self.pending.remove(shard)
+                    self.start(shard)
+            time.sleep(0.2)
+            for shard in list(self.running):
+                if shard.process.poll() is not None:
+                    self.finish(shard)
+
+    def terminate(self):
+        for shard in self.running:
+            shard.process.terminate()
+        for shard in self.running:
+            shard.process.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser( prog="daz_dhdm_gen.scheduler",
+                                      description="Generate the morphs of a manifest in several worker processes." )
+    parser.add_argument("manifest", help="manifest file (.json or .toml, see cli.py)")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="maximum number of worker processes")
+    parser.add_argument("--memory-mb", type=int, default=0,
+                        help="estimated memory of the running workers is kept under this (default: 75%% of the RAM)")
+    parser.add_argument("--default-job-mb", type=int, default=4096,
+                        help="estimated memory of a blender entry without \"memory_mb\"")
+    parser.add_argument("--batch-size", type=int, default=4, help="maximum number of entries run by one worker")
+    parser.add_argument("--retries", type=int, default=1, help="times a failed entry is retried")
+    parser.add_argument("--blender", default=os.environ.get("BLENDER", "blender"),
+                        help="blender executable for entries without \"base_mesh\" (default: BLENDER or blender)")
+    parser.add_argument("--dll", help="path of the dhdm_gen library for pre-exported entries")
+    parser.add_argument("--session-cache-mb", type=int, default=1024, help="dll session memory of each worker")
+    parser.add_argument("--work-dir", help="directory of the shard manifests, logs and summary (default: temporary)")
+    parser.add_argument("--summary", help="summary file (default: <work dir>/summary.json)")
+    args = parser.parse_args(argv)
+    args.batch_size = max(1, args.batch_size)
+
+    manifest_dir = os.path.dirname(os.path.abspath(args.manifest))
+    try:
+        manifest, entries = read_manifest(args.manifest)
+    except (OSError, ValueError, ManifestError) as e:
+        print("Invalid manifest \"{0}\": {1}".format(args.manifest, e))
+        return 2
+    names = [ e["name"] for e in entries ]
+    if len(set(names)) != len(names):
+        print("Invalid manifest \"{0}\": entry names must be unique.".format(args.manifest))
+        return 2
+
+    work_dir = args.work_dir
+    if work_dir:
+        os.makedirs(work_dir, exist_ok=True)
+    else:
+        work_dir = tempfile.mkdtemp(prefix="dhdm_gen_")
+    work_dir = os.path.abspath(work_dir)
+    print("Work directory: \"{0}\".".format(work_dir))
+
+    scheduler = Scheduler(args, manifest, entries, manifest_dir, work_dir)
+    t0 = time.perf_counter()
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        print("Interrupted, stopping the workers.")
+        scheduler.terminate()
+    seconds = time.perf_counter() - t0
+
+    results = []
+    for i, e in enumerate(entries):
+        results.append( scheduler.results.get(i, { "name": e["name"], "status": "not run", "outputs": [],
+                                                   "seconds": None, "error": None, "attempts": 0, "log": None }) )
+    summary_fp = args.summary or os.path.join(work_dir, "summary.json")
+    summary = { "manifest": os.path.abspath(args.manifest),
+                "workers": args.workers,
+                "memory_budget_mb": None if scheduler.memory_budget is None else scheduler.memory_budget >> 20,
+                "seconds": round(seconds, 3),
+                "generated": sum(1 for r in results if r["status"] == "ok"),
+                "failed": sum(1 for r in results if r["status"] != "ok"),
+                "peak_rss_mb": max( (r["peak_rss_mb"] for r in results if r.get("peak_rss_mb") is not None),
+                                    default=None ),
+                "entries": results }
+    core.j_to_json_file(summary_fp, summary, with_gzip=False, indent=1)
+
+    print("\n{0} generated, {1} failed ({2:.1f} s), summary: \"{3}\".".format(
+            summary["generated"], summary["failed"], seconds, summary_fp ))
+    if summary["peak_rss_mb"] is not None:
+        print("Largest worker peak memory: {0} MB.".format(summary["peak_rss_mb"]))
+    for r in results:
+        if r["status"] != "ok":
+            print("  {0}: {1}".format(r["name"], r["error"] or r["status"]))
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
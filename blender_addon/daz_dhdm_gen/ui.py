@@ -0,0 +1,216 @@
+import bpy
+from . import operator_dhdm_gen
+from . import operator_match_gen
+from . import dll_wrapper
+
+
+class dhdmGenProperties(bpy.types.PropertyGroup):
+    working_dirpath:    bpy.props.StringProperty( subtype="DIR_PATH", name="Working directory" )
+
+    unit_scale:         bpy.props.FloatProperty( name="Unit scale", default=0.01, min=0.00001,
+                                description= "Scale used to convert from daz's units to Blender's units" )
+
+    base_ob:            bpy.props.StringProperty( name="Base mesh", description= "Base mesh" )
+
+    matching_files_dir: bpy.props.StringProperty(subtype="DIR_PATH", name="Matching files directory")
+
+    hd_ob:              bpy.props.StringProperty( name="HD mesh", description= "HD mesh" )
+
+    base_subdiv_method: bpy.props.EnumProperty( name = "Subdiv method",
+                                                items = ( ('MULTIRES', "From direct multires", "hd mesh has a (non-applied) multiresolution modifier"),
+                                                          ('MULTIRES_REC', "From daz_hd_morphs multires", "hd mesh was generated with daz_hd_morphs addon"), ),
+                                                default = 'MULTIRES',
+                                                description = "Subdivision method used to generate the hd mesh"
+                                               )
+
+    base_morphs: bpy.props.EnumProperty( name = "Base morphs",
+                                         items = ( ('HD_MESH', "From hd mesh", "Use base level of hd mesh as base morph data"),
+                                                   ('BASE_MORPHED', "From morphed base mesh", "Get base morph data from morphed base mesh"), ),
+                                         default = 'HD_MESH',
+                                         description = "Base morph data used by the new morph"
+                                       )
+
+    morphed_base_ob:  bpy.props.StringProperty( name="Morphed base mesh", description="Base mesh morphed with the base morphs used to derive the hd mesh" )
+
+    morph_name:  bpy.props.StringProperty(name="New morph name", description="New morph name (without extension)", default="")
+
+    output_type: bpy.props.EnumProperty( name = "Output",
+                                         items = ( ('DHDM', ".dhdm only", "Generate .dhdm file only (without .dsf file)"),
+                                                   ('DSF_TEMPLATE', ".dhdm and .dsf (template)", "Generate .dhdm file and .dsf file from provided template .dsf"),
+                                                   ('DSF_BASIC', ".dhdm and .dsf (basic)", "Generate .dhdm file and .dsf file from generated basic .dsf"),
+                                                  ),
+                                         default = 'DSF_BASIC',
+                                         description = "Output files. .dhdm file is always generated."
+                                       )
+
+    dsf_file_template:  bpy.props.StringProperty(subtype="FILE_PATH", name="Template .dsf file",
+                                                 description="Template .dsf file to use to create new .dsf file with HD mesh's base morph data "
+                                                              "and HD mesh's HD morph data (by linking the generated .dhdm file to it). "
+                                                              "The given .dsf file must have \"hd_url\" field")
+
+    morph_daz_directory:    bpy.props.StringProperty( name="Morph daz directory",
+                                                      description="Directory in daz's library where the morph will be located. Relative path."
+                                                                  "For example, \"/data/DAZ 3D/Genesis 8/Female/Morphs/DAZ 3D/Expressions\"")
+
+class AddonPanel:
+    bl_space_type = "VIEW_3D"
+    bl_region_type = "UI"
+    bl_category = "dhdm"
+
+    @classmethod
+    def poll(cls, context):
+        return context.mode == 'OBJECT'
+
+
+class PANEL_PT_dhdmGenhPanel(AddonPanel, bpy.types.Panel):
+    bl_label = "Main settings"
+    bl_idname = "PANEL_PT_dhdmGenhPanel"
+
+    def draw(self, context):
+        layout = self.layout
+        layout.use_property_split = True
+        layout.use_property_decorate = False
+        addon_props = context.scene.daz_dhdm_gen
+
+        box = layout.box()
+        row = box.row()
+        row.prop(addon_props, "working_dirpath")
+        row = box.row()
+        row.prop(addon_props, "unit_scale")
+        row = box.row()
+        row.prop_search(addon_props, "base_ob", context.scene, "objects")
+        row = box.row()
+        row.prop(addon_props, "matching_files_dir")
+        row = box.row()
+        row.operator(operator_match_gen.GenerateMatching.bl_idname)
+
+
+class PANEL_PT_dhdmGenHDPanel(AddonPanel, bpy.types.Panel):
+    bl_idname = "PANEL_PT_dhdmGenHDPanel"
+    bl_label = "New HD morph"
+    bl_options = {"DEFAULT_CLOSED"}
+
+    def draw(self, context):
+        layout = self.layout
+        layout.use_property_split = True
+        layout.use_property_decorate = False
+        addon_props = context.scene.daz_dhdm_gen
+
+        row = layout.row()
+        row.prop_search(addon_props, "hd_ob", context.scene, "objects")
+        row = layout.row()
+        row.prop(addon_props, "base_subdiv_method")
+        row = layout.row()
+        row.prop(addon_props, "base_morphs")
+        if addon_props.base_morphs == 'BASE_MORPHED':
+            row = layout.row()
+            row.prop_search(addon_props, "morphed_base_ob", context.scene, "objects")
+        row = layout.row()
+        row.prop(addon_props, "morph_name")
+        row = layout.row()
+        row.prop(addon_props, "output_type")
+        if addon_props.output_type == 'DSF_TEMPLATE':
+            row = layout.row()
+            row.prop(addon_props, "dsf_file_template")
+        elif addon_props.output_type == 'DSF_BASIC':
+            row = layout.row()
+            row.prop(addon_props, "morph_daz_directory")
+        row = layout.row()
+        row.operator(operator_dhdm_gen.GenerateNewMorphFiles.bl_idname)
+
+
+class dazHDCustomPreferences(bpy.types.AddonPreferences):
+    bl_idname = __package__
+
+    delete_temporary_files:  bpy.props.BoolProperty(
+                                name="Delete temporary files", default=True,
+                                description="Delete .obj/.mtl/.dae files in the working directory after operators finish"
+                             )
+
+    use_mesh_buffers:  bpy.props.BoolProperty(
+                                name="Pass meshes in memory", default=True,
+                                description="Pass meshes to the dll as in-memory buffers instead of exporting/parsing .obj files"
+                             )
+
+    num_threads:  bpy.props.IntProperty(
+                                name="Threads", default=0, min=0, max=256,
+                                description="Number of threads used to calculate .dhdm displacements, to match vertices and to compress .dsf files (0: all cores)"
+                             )
+
+    sparse_refine:  bpy.props.BoolProperty(
+                                name="Sparse subdivision", default=True,
+                                description="Only subdivide the base faces around the edited vertices when generating .dhdm files"
+                             )
+
+    low_memory_mb:  bpy.props.IntProperty(
+                                name="Low memory mode (MB)", default=0, min=0, max=1048576,
+                                description="Subdivide the mesh in pieces using about this much memory each when generating "
+                                            ".dhdm files, slower but with a bounded peak (0: subdivide it at once)"
+                             )
+
+    session_cache_mb:  bpy.props.IntProperty(
+                                name="Session cache (MB)", default=1024, min=0, max=65536,
+                                description="Memory used to keep the base mesh's subdivision and matching files between .dhdm generations (0: disabled)"
+                             )
+
+    mesh_cache_mb:  bpy.props.IntProperty(
+                                name="Mesh cache (MB)", default=2048, min=0, max=1048576,
+                                description="Disk space used to keep intermediate meshes (base mesh subdivided without hd edits) "
+                                            "between runs with the same base mesh and settings (0: disabled)"
+                             )
+
+    gzip_level:  bpy.props.IntProperty(
+                                name="Compression level", default=6, min=1, max=9,
+                                description="gzip level of the generated .dsf files, compressed in parallel with the number "
+                                            "of threads above (1: fastest, 9: smallest)"
+                             )
+
+    profile_runs:  bpy.props.BoolProperty(
+                                name="Profile runs", default=False,
+                                description="Profile the Python code of the operators with cProfile, the stats are written "
+                                            "next to the run reports (\"_reports\" in the working directory, .prof files)"
+                             )
+
+    def draw(self, context):
+        box = self.layout.box()
+        row = box.row()
+        row.prop(self, "delete_temporary_files")
+        row = box.row()
+        row.prop(self, "use_mesh_buffers")
+        row = box.row()
+        row.prop(self, "num_threads")
+        row = box.row()
+        row.prop(self, "sparse_refine")
+        row = box.row()
+        row.prop(self, "low_memory_mb")
+        row = box.row()
+        row.prop(self, "session_cache_mb")
+        row = box.row()
+        row.prop(self, "mesh_cache_mb")
+        row = box.row()
+        row.prop(self, "gzip_level")
+        row = box.row()
+        row.prop(self, "profile_runs")
+
+
+classes = (
+    dhdmGenProperties,
+    dazHDCustomPreferences,
+
+    operator_dhdm_gen.GenerateNewMorphFiles,
+    operator_match_gen.GenerateMatching,
+
+    PANEL_PT_dhdmGenhPanel,
+    PANEL_PT_dhdmGenHDPanel,
+)
+
+def register():
+    for c in classes:
+        bpy.utils.register_class(c)
+    bpy.types.Scene.daz_dhdm_gen = bpy.props.PointerProperty(type=dhdmGenProperties)
+
+def unregister():
+    dll_wrapper.close_session()
+    del bpy.types.Scene.daz_dhdm_gen
+    for c in reversed(classes):
+        bpy.utils.unregister_class(c)
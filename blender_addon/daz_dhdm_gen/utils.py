@@ -1,27 +1,17 @@
-import bpy, os, math, time, gzip, json, re, shutil
-from urllib.parse import unquote
-from mathutils import Vector
+import bpy, os, math, time
+import numpy as np
+from mathutils import Vector, Matrix
+# bpy-free helpers, re-exported for the operators
+from .core import ( has_extension, get_extension, remove_extension, makeValidFilename,
+                    read_dhdm_level, is_gzip_file, get_dsf_json, read_dsf_metadata, read_dsf_level, read_dsf_id,
+                    dsf_vcount, get_file_id, get_info_from_filename, get_matching_filename,
+                    MATCHING_MAGIC, MATCHING_VERSION, matching_header_struct, matching_header_struct_v1, matching_methods,
+                    write_matching_file, is_binary_matching_file, read_matching_file_header,
+                    read_matching_file, read_legacy_matching_file, convert_legacy_matching_file,
+                    copy_file, text_to_json_file, j_to_json_file, get_topology_hash, get_mesh_hash,
+                    get_edited_mask )
 
 
-def has_extension(filepath, *exts):
-    assert(len(exts) > 0)
-    t = os.path.basename(filepath).rsplit(".", 1)
-    return (len(t) == 2 and t[1].lower() in exts)
-
-def get_extension(filepath):
-    t = os.path.basename(filepath).rsplit(".", 1)
-    if len(t) != 2:
-        return None
-    return t[1].lower()
-
-def remove_extension(filename):
-    t = filename.rsplit(".", 1)
-    return t[0].strip()
-
-def makeValidFilename(name):
-    name = name.strip().lower()
-    return "".join( c for c in name if (c.isalnum() or c in "._- ") )
-
 def delete_object(ob):
     assert(ob.type == 'MESH')
     ob_data = ob.data
@@ -206,70 +196,6 @@ def remove_shape_keys(ob):
         ob.active_shape_key_index = 0
         ob.shape_key_clear()
 
-def read_dhdm_level(dhdm_fp):
-    if not os.path.isfile(dhdm_fp):
-        raise ValueError("File \"{}\" not found.".format(dhdm_fp))
-    with open(dhdm_fp, "rb") as f:
-        h = f.read(8)
-    return int.from_bytes(h[4:], byteorder='little', signed=False)
-
-def is_gzip_file(fp):
-    with open(fp, "rb") as f:
-        return f.read(2) == b'\x1f\x8b'
-
-def get_dsf_json(dsf_fp):
-    j = None
-    if is_gzip_file(dsf_fp):
-        with gzip.open(dsf_fp, "rt", encoding="utf-8") as f:
-            j = json.loads(f.read())
-    else:
-        with open(dsf_fp, "r", encoding="utf-8") as f:
-            j = json.loads(f.read())
-    return j
-
-def read_dsf_level(dsf_fp):
-    j = get_dsf_json(dsf_fp)
-    try:
-        dhdm = j["modifier_library"][0]["morph"]["hd_url"]
-        dhdm_fp = os.path.join( os.path.dirname(dsf_fp), os.path.basename(dhdm) )
-        dhdm_fp = unquote(dhdm_fp)
-        return read_dhdm_level(dhdm_fp)
-    except KeyError:
-        return 0
-
-def read_dsf_id(dsf_fp, only_with_dhdm=False):
-    j = get_dsf_json(dsf_fp)
-    try:
-        if only_with_dhdm:
-            dhdm = j["modifier_library"][0]["morph"]["hd_url"]
-        return j["modifier_library"][0]["id"]
-    except KeyError:
-        return None
-
-def dsf_vcount(dsf_fp):
-    j = get_dsf_json(dsf_fp)
-    try:
-        v_count = j["modifier_library"][0]["morph"]["vertex_count"]
-        return v_count
-    except KeyError:
-        return None
-
-def get_file_id(filepath):
-    filename = os.path.basename(filepath).rsplit(".",1)[0]
-
-    if has_extension(filepath, "dhdm"):
-        dsf_fp = os.path.join(os.path.dirname(filepath), filename + ".dsf")
-        if not os.path.isfile(dsf_fp):
-            return filename
-        filepath = dsf_fp
-    elif not has_extension(filepath, "dsf"):
-        raise ValueError("File \"{0}\" is not .dsf or .dhdm file.".format(filepath))
-
-    dsf_id = read_dsf_id(filepath)
-    if dsf_id is not None:
-        return dsf_id
-    return filename
-
 def get_selected_meshes(context):
     return [ ob for ob in context.view_layer.objects
              if ob.select_get() and ob.type == 'MESH'
@@ -362,6 +288,45 @@ class ModifiersStatus:
         self.m_n = None
         self.m_status = None
 
+def get_vertex_positions(vertices):
+    # coordinates of mesh vertices or shape key points as float64 (n, 3)
+    positions = np.empty(len(vertices) * 3, dtype=np.float32)
+    vertices.foreach_get("co", positions)
+    return positions.reshape(-1, 3).astype(np.float64)
+
+def get_basis_positions(ob):
+    # local coordinates of the mesh without shape keys nor modifiers (what remove_shape_keys() leaves)
+    keys = ob.data.shape_keys
+    if keys is not None and keys.reference_key is not None:
+        return get_vertex_positions(keys.reference_key.data)
+    return get_vertex_positions(ob.data.vertices)
+
+def get_shape_keys_mix(ob):
+    # Local coordinates of the current mix of the shape keys without modifiers (what apply_shape_keys()
+    # leaves), without changing the object. Relative keys are mixed here, the rest (absolute keys, pinned
+    # key, keys with vertex groups) is evaluated by Blender with the modifiers hidden.
+    keys = ob.data.shape_keys
+    if keys is None or len(keys.key_blocks) == 0:
+        return get_vertex_positions(ob.data.vertices)
+    ref = keys.reference_key
+    active = [ kb for kb in keys.key_blocks if kb != ref and not kb.mute and kb.value != 0 ]
+    if keys.use_relative and not ob.show_only_shape_key and not any( kb.vertex_group for kb in active ):
+        positions = get_vertex_positions(ref.data)
+        for kb in active:
+            positions += kb.value * ( get_vertex_positions(kb.data) - get_vertex_positions(kb.relative_key.data) )
+        return positions
+
+    ms = ModifiersStatus(ob, 'DISABLE', m_types={'ALL'})
+    try:
+        ob_eval = ob.evaluated_get(bpy.context.evaluated_depsgraph_get())
+        me = ob_eval.to_mesh()
+        try:
+            return get_vertex_positions(me.vertices)
+        finally:
+            ob_eval.to_mesh_clear()
+    finally:
+        ms.restore()
+
 def apply_shape_keys(ob):
     if ob.data.shape_keys is not None:
         make_single_active(ob)
@@ -389,38 +354,15 @@ def get_fingerprint(ob):
         raise ValueError("Object \"{0}\" is not a mesh.".format(ob.name))
     return "{0}-{1}-{2}".format( len(ob.data.vertices), len(ob.data.edges), len(ob.data.polygons) )
 
-def get_info_from_filename(filename):
-    r = re.search(r'^f(\d+-\d+-\d+)_div(\d)_(mr|mrr)\.json$', filename)
-    if r is None:
-        return None, None, None
-    return r.group(1), int(r.group(2)), r.group(3)
-
-def copy_file(fp, target_dir, target_filename=None):
-    if not os.path.isdir(target_dir):
-        raise ValueError("Directory \"{0}\" not found.".format(target_dir))
-    if not os.path.isfile(fp):
-        raise ValueError("File \"{0}\" not found.".format(fp))
-
-    if target_filename is None:
-        target_fp = os.path.join(target_dir, os.path.basename(fp))
-    else:
-        ext = get_extension(fp)
-        target_fp = os.path.join(target_dir, "{0}.{1}".format(target_filename, ext))
-
-    new_fp = shutil.copyfile( fp, target_fp )
-    return new_fp
-
-def text_to_json_file(fp, text, with_gzip=True, indent=None):
-    j = json.loads(text)
-    j_to_json_file(fp, j, with_gzip=with_gzip, indent=indent)
-
-def j_to_json_file(fp, j, with_gzip=True, indent=None):
-    if with_gzip:
-        with gzip.open(fp, 'wt', encoding="utf-8") as f:
-            json.dump(j, f, indent=indent)
-    else:
-        with open(fp, 'w', encoding="utf-8") as f:
-            json.dump(j, f, indent=indent)
+def get_ob_topology_hash(ob):
+    # same as core.get_topology_hash() of the object's .obj export (without modifiers)
+    if ob.type != 'MESH':
+        raise ValueError("Object \"{0}\" is not a mesh.".format(ob.name))
+    face_vert_counts = np.empty(len(ob.data.polygons), dtype=np.int32)
+    ob.data.polygons.foreach_get("loop_total", face_vert_counts)
+    face_vert_indices = np.empty(len(ob.data.loops), dtype=np.int32)
+    ob.data.loops.foreach_get("vertex_index", face_vert_indices)
+    return get_topology_hash(len(ob.data.vertices), face_vert_counts, face_vert_indices)
 
 def apply_only_base_multiresolution_modifier(ob):
     for m in ob.modifiers:
@@ -471,6 +413,43 @@ def subdivide_object(ob, method, levels):
         for _ in range(0, levels):
             bpy.ops.object.multires_subdivide(modifier=mr.name, mode='CATMULL_CLARK')
 
+# same axes conversion as bpy.ops.wm.obj_export() with its default forward/up axes (-Z, Y)
+obj_export_axes_mat = Matrix([ (1, 0,  0),
+                               (0, 0,  1),
+                               (0, -1, 0) ])
+
+# Mesh data as contiguous arrays (positions float32 (n, 3), face_vert_counts int32, face_vert_indices int32),
+# in the same space as the .obj files written by export_ob_obj() (rotation/scale applied, no translation).
+# positions_only: only the positions array is returned.
+def get_mesh_arrays(ob, apply_modifiers, positions_only=False):
+    assert(ob.type == 'MESH')
+    ob_eval = None
+    if apply_modifiers:
+        ob_eval = ob.evaluated_get(bpy.context.evaluated_depsgraph_get())
+        me = ob_eval.to_mesh()
+    else:
+        me = ob.data
+
+    try:
+        nv = len(me.vertices)
+        positions = np.empty(nv * 3, dtype=np.float32)
+        me.vertices.foreach_get("co", positions)
+        if not positions_only:
+            face_vert_counts = np.empty(len(me.polygons), dtype=np.int32)
+            me.polygons.foreach_get("loop_total", face_vert_counts)
+            face_vert_indices = np.empty(len(me.loops), dtype=np.int32)
+            me.loops.foreach_get("vertex_index", face_vert_indices)
+    finally:
+        if ob_eval is not None:
+            ob_eval.to_mesh_clear()
+
+    mat = np.array(obj_export_axes_mat @ ob.matrix_world.to_3x3(), dtype=np.float64)
+    positions = positions.reshape(nv, 3) @ mat.T
+    positions = np.ascontiguousarray(positions, dtype=np.float32)
+    if positions_only:
+        return positions
+    return positions, face_vert_counts, face_vert_indices
+
 def api_generate_simple_hd_mesh(context, ob, hd_level, gScale, outputDirpath):
     try:
         from daz_hd_morphs import api
@@ -0,0 +1,64 @@
+#include <iostream>
+#include <fmt/format.h>
+
+#include "mesh.hh"
+#include "utils.hh"
+
+
+/*
+    Builds a mesh from contiguous buffers filled on the Python side
+    (same coordinates and face order as the .obj exported by Blender).
+*/
+dhdm::Mesh dhdm::Mesh::fromBuffers( const MeshBuffers & buffers,
+                                    const bool use_face_id_mat_id,
+                                    const double scale )
+{
+    if ( buffers.positions == nullptr || buffers.face_vert_counts == nullptr ||
+         buffers.face_vert_indices == nullptr )
+        throw std::runtime_error("fromBuffers(): null buffer");
+
+    dhdm::Mesh mesh;
+
+    mesh.vertices.resize(buffers.vert_count);
+    const double inv_scale = 1 / scale;
+    for (size_t i = 0; i < buffers.vert_count; i++)
+    {
+        const float * co = buffers.positions + 3 * i;
+        mesh.vertices[i].pos = glm::dvec3(co[0], co[1], co[2]) * inv_scale;
+    }
+
+    size_t corners_n = 0;
+    for (size_t i = 0; i < buffers.face_count; i++)
+    {
+        const int c = buffers.face_vert_counts[i];
+        if ( c < 3 )
+            throw std::runtime_error( fmt::format("Invalid face {}: {} vertices", i, c) );
+        corners_n += c;
+    }
+    for (size_t j = 0; j < corners_n; j++)
+    {
+        const int vi = buffers.face_vert_indices[j];
+        if ( vi < 0 || (size_t) vi >= buffers.vert_count )
+            throw std::runtime_error( fmt::format("Invalid vertex index {} in corner {}", vi, j) );
+    }
+
+    // the buffers are already in the faces' layout
+    dhdm::Faces & faces = mesh.faces;
+    faces.counts.assign( buffers.face_vert_counts, buffers.face_vert_counts + buffers.face_count );
+    faces.corner_verts.assign( buffers.face_vert_indices, buffers.face_vert_indices + corners_n );
+    faces.offsets.resize(buffers.face_count + 1);
+    faces.matIds.resize(buffers.face_count);
+    for (size_t i = 0; i < buffers.face_count; i++)
+    {
+        faces.offsets[i+1] = faces.offsets[i] + faces.counts[i];
+        faces.matIds[i] = use_face_id_mat_id ? i : 0;
+    }
+
+    mesh.uses_uvs = false;
+    mesh.uses_materials = false;
+    mesh.uses_vgroups = false;
+
+    std::cout << fmt::format("Loaded mesh from buffers: {} vertices, {} faces.\n",
+                             mesh.vertices.size(), mesh.faces.size());
+    return mesh;
+}
@@ -47,7 +47,7 @@ XMLElement* makeInput(XMLDocument & dae, const char* semantic, const char* sourc
 }
 
 
-void dhdm::Mesh::insertVerticesPosSource(XMLDocument & dae, XMLElement* parent) {
+void dhdm::Mesh::insertVerticesPosSource(XMLDocument & dae, XMLElement* parent, const double scale) {
     XMLElement* source = dae.NewElement("source");
     source->SetAttribute("id", "mesh_positions");
     parent->InsertEndChild(source);
@@ -57,7 +57,7 @@ void dhdm::Mesh::insertVerticesPosSource(XMLDocument & dae, XMLElement* parent)
     float_array->SetAttribute("count", vertices.size() * 3);
     std::ostringstream ss(std::ostringstream::out);
     for (auto & v : vertices) {
-        const glm::dvec3 pos = v.pos * dhdm::gScale;
+        const glm::dvec3 pos = v.pos * scale;
         ss << fmt::format("{} {} {} ", (float) pos.x, (float) pos.y, (float) pos.z);
     }
     float_array->SetText(ss.str().c_str());
@@ -109,12 +109,17 @@ void dhdm::Mesh::insertUVsSource( XMLDocument & dae, XMLElement* parent,
 
 
 void insertMaterialPolylist( XMLDocument & dae, XMLElement* parent,
-                             const std::vector<dhdm::Face> & mat_faces,
+                             const dhdm::Faces & faces,
+                             const std::vector<dhdm::FaceId> * mat_faces,
                              const short mat_slot,
                              const std::vector<std::string> & uv_layers_names )
 {
+    // mat_faces: faces of the material slot, nullptr for all
+    const size_t faces_n = mat_faces ? mat_faces->size() : faces.size();
+    auto face_at = [&](const size_t i) -> dhdm::FaceId { return mat_faces ? (*mat_faces)[i] : (dhdm::FaceId) i; };
+
     XMLElement* polylist = dae.NewElement("polylist");
-    polylist->SetAttribute("count", mat_faces.size());
+    polylist->SetAttribute("count", faces_n);
     if (mat_slot >= 0)
         polylist->SetAttribute("material", fmt::format("mat{}", mat_slot).c_str());
     parent->InsertEndChild(polylist);
@@ -130,8 +135,8 @@ void insertMaterialPolylist( XMLDocument & dae, XMLElement* parent,
     }
 
     std::ostringstream ss(std::ostringstream::out);
-    for (size_t i = 0; i < mat_faces.size(); i++)
-        ss << "4 ";
+    for (size_t i = 0; i < faces_n; i++)
+        ss << faces.count(face_at(i)) << " ";
     XMLElement* vcount = dae.NewElement("vcount");
     vcount->SetText(ss.str().c_str());
     polylist->InsertEndChild(vcount);
@@ -141,16 +146,18 @@ void insertMaterialPolylist( XMLDocument & dae, XMLElement* parent,
     // uses_uvs
     if ( uv_layers_names.size() > 0 )
     {
-        for (auto & face : mat_faces) {
-            for (auto & fv : face.vertices)
-                ss << fmt::format("{} {} ", fv.vertex, fv.uv);
+        for (size_t i = 0; i < faces_n; i++) {
+            const dhdm::FaceId f = face_at(i);
+            for (int j = 0; j < faces.count(f); j++)
+                ss << fmt::format("{} {} ", faces.vertex(f, j), faces.uv(f, j));
         }
     }
     else
     {
-        for (auto & face : mat_faces) {
-            for (auto & fv : face.vertices)
-                ss << fmt::format("{} ", fv.vertex);
+        for (size_t i = 0; i < faces_n; i++) {
+            const dhdm::FaceId f = face_at(i);
+            for (int j = 0; j < faces.count(f); j++)
+                ss << fmt::format("{} ", faces.vertex(f, j));
         }
     }
     XMLElement* p = dae.NewElement("p");
@@ -160,7 +167,7 @@ void insertMaterialPolylist( XMLDocument & dae, XMLElement* parent,
 
 
 void dhdm::Mesh::insertPolylist( XMLDocument & dae, XMLElement* parent,
-                                 const std::vector< std::vector<Face> > & materials_faces,
+                                 const std::vector< std::vector<FaceId> > & materials_faces,
                                  const std::vector<std::string> & uv_layers_names )
 {
     XMLElement* vertices = dae.NewElement("vertices");
@@ -170,10 +177,10 @@ void dhdm::Mesh::insertPolylist( XMLDocument & dae, XMLElement* parent,
 
     if (uses_materials) {
         for (size_t i=0; i < materials_faces.size(); i++)
-            insertMaterialPolylist(dae, parent, materials_faces[i], (short) i, uv_layers_names);
+            insertMaterialPolylist(dae, parent, faces, &materials_faces[i], (short) i, uv_layers_names);
     }
     else {
-        insertMaterialPolylist(dae, parent, faces, -1, uv_layers_names);
+        insertMaterialPolylist(dae, parent, faces, nullptr, -1, uv_layers_names);
     }
 }
 
@@ -370,7 +377,7 @@ void dhdm::Mesh::insertSceneNodes( XMLDocument & dae, XMLElement* parent,
 }
 
 
-void dhdm::Mesh::writeCollada(const std::string & fp, const std::string & name)
+void dhdm::Mesh::writeCollada(const std::string & fp, const std::string & name, const double scale)
 {
     std::cout << "Writing .dae...\n";
     XMLDocument dae;
@@ -394,13 +401,14 @@ void dhdm::Mesh::writeCollada(const std::string & fp, const std::string & name)
     asset->InsertEndChild(up_axis);
     collada->InsertEndChild(asset);
 
-    std::vector< std::vector<Face> > materials_faces;
+    std::vector< std::vector<FaceId> > materials_faces;
     if (uses_materials) {
-        for (auto & face : faces) {
-            // assert(face.matId >= 0);
-            if ( (size_t) face.matId >= materials_faces.size())
-                materials_faces.resize(face.matId + 1);
-            materials_faces[face.matId].push_back(face);
+        for (size_t f = 0; f < faces.size(); f++) {
+            const short matId = faces.matIds[f];
+            // assert(matId >= 0);
+            if ( (size_t) matId >= materials_faces.size())
+                materials_faces.resize(matId + 1);
+            materials_faces[matId].push_back(f);
         }
         XMLElement* library_materials = dae.NewElement("library_materials");
         collada->InsertEndChild(library_materials);
@@ -429,7 +437,7 @@ void dhdm::Mesh::writeCollada(const std::string & fp, const std::string & name)
     XMLElement* mesh = dae.NewElement("mesh");
     geometry->InsertEndChild(mesh);
 
-    insertVerticesPosSource(dae, mesh);
+    insertVerticesPosSource(dae, mesh, scale);
     insertUVsSource(dae, mesh, uv_layers_names);
     insertPolylist(dae, mesh, materials_faces, uv_layers_names);
     const short num_materials = (short) materials_faces.size();
@@ -17,7 +17,8 @@ dhdm::Mesh dhdm::Mesh::fromDae( const char * fp_dae,
                                 const char * fp_obj,
                                 const short load_uv_layers,
                                 bool load_materials,
-                                bool load_vgroups )
+                                bool load_vgroups,
+                                const double scale )
 {
     std::cout << "Reading file \"" << std::string(fp_dae) << "\"...\n";
 
@@ -79,7 +80,7 @@ dhdm::Mesh dhdm::Mesh::fromDae( const char * fp_dae,
                         vert.pos[1] = nr.read_next();
                         vert.pos[2] = nr.read_next();
 
-                        vert.pos = vert.pos * (1/dhdm::gScale);
+                        vert.pos = vert.pos * (1/scale);
                         mesh.vertices.push_back( std::move(vert) );
                     }
 
@@ -155,27 +156,26 @@ dhdm::Mesh dhdm::Mesh::fromDae( const char * fp_dae,
                                 throw std::runtime_error("Face not found.");
                             }
 
-                            Face & f = mesh.faces[it->second];
+                            dhdm::Faces & faces = mesh.faces;
+                            const dhdm::FaceId f = it->second;
+                            if (!faces.has_uvs())
+                                faces.corner_uvs.resize(faces.corners_size(), 0);
 
-                            f.matId = mat_id;
+                            faces.matIds[f] = (short) mat_id;
                             for (unsigned long i = 0; i < n_vcount; i++)
-                                f.vertices[i].uv = uvs[i];
+                                faces.corner_uvs[faces.first(f) + i] = uvs[i];
                         }
                         else
                         {
-                            dhdm::Face face;
-                            face.matId = mat_id;
+                            dhdm::VertexId verts[4];
+                            dhdm::UvId uvs[4];
                             for (unsigned long i = 0; i < n_vcount; i++)
                             {
-                                dhdm::FaceVertex fv;
-
-                                fv.vertex = nr_p.read_next();
+                                verts[i] = nr_p.read_next();
                                 nr_p.read_next();
-                                fv.uv = nr_p.read_next();
-
-                                face.vertices.push_back( std::move(fv) );
+                                uvs[i] = nr_p.read_next();
                             }
-                            mesh.faces.push_back( std::move(face) );
+                            mesh.faces.push_back( verts, uvs, n_vcount, (short) mat_id );
                         }
 
                     }
@@ -3,34 +3,97 @@
 #include <fmt/format.h>
 #include <unordered_map>
 #include <set>
+#include <atomic>
+#include <chrono>
+#include <limits>
+#include <thread>
+#include <exception>
+#include <cstdio>
+#include <cstring>
 
 #include "dhdm_calc.hh"
+#include "matching.hh"
+#include "sparse_region.hh"
+#include "session.hh"
 #include "utils.hh"
 
 using namespace OpenSubdiv;
 
 
+template <typename T>
+static void append( std::vector<char> & buffer, const T & value )
+{
+    const size_t n = buffer.size();
+    buffer.resize( n + sizeof(T) );
+    std::memcpy( buffer.data() + n, &value, sizeof(T) );
+}
+
+
 DhdmWriter::DhdmWriter( const dhdm::Mesh *base_mesh, const dhdm::Mesh *hd_mesh,
-                        const FilepathsInfo* fps_info, const std::set<uint32_t> *edited_vis ) :
-    base_mesh(base_mesh), hd_mesh(hd_mesh), fps_info(fps_info), edited_vis(edited_vis)
+                        const FilepathsInfo* fps_info, const VertexMask *edited_vis,
+                        const unsigned int num_threads, const bool sparse_refine,
+                        DhdmSession * session, const unsigned int low_memory_mb ) :
+    base_mesh(base_mesh), hd_mesh(hd_mesh), fps_info(fps_info), edited_vis(edited_vis),
+    num_threads(num_threads), sparse_refine(sparse_refine), low_memory_mb(low_memory_mb), session(session)
 {
+    if (this->num_threads == 0)
+        this->num_threads = std::max(1u, std::thread::hardware_concurrency());
 }
 
 
-void DhdmWriter::calc_inverse_dhdm_mats( std::vector< std::vector<glm::dmat3x3> > & mats,
-                                         std::vector<int> & firstLevelSubFaceOffset )
+void DhdmWriter::setProgressCallback( ProgressCallback callback, void* user_data )
 {
-    int subFaceOffset = 0;
-    for (auto & face : base_mesh->faces) {
-        const int num_face_verts = face.vertices.size();
-        assert( num_face_verts >= 3 );
+    progress_callback = callback;
+    progress_user_data = user_data;
+}
+
+
+void DhdmWriter::reportProgress( const uint32_t lvl, const uint32_t faces_done, const uint32_t faces_total,
+                                 const uint32_t nr_displacements )
+{
+    if (progress_callback == nullptr)
+        return;
+
+    // The start and end of a level are always reported. Otherwise a worker only reports if the interval
+    // has passed and no other worker is reporting, so the workers don't queue on the callback (the
+    // Python one takes the GIL).
+    const bool forced = (faces_done == 0) || (faces_done == faces_total);
+    const int64_t now_ns = std::chrono::duration_cast<std::chrono::nanoseconds>(
+                                std::chrono::steady_clock::now().time_since_epoch() ).count();
+    if (!forced && now_ns < next_progress_ns.load(std::memory_order_relaxed))
+        return;
+    std::unique_lock<std::mutex> lock(progress_mtx, std::defer_lock);
+    if (forced)
+        lock.lock();
+    else if (!lock.try_lock())
+        return;
+    if (!forced && now_ns < next_progress_ns.load(std::memory_order_relaxed))
+        return;
+    // after the end of a level, late workers' reports (fewer faces done) are dropped until the next one
+    next_progress_ns.store( (faces_done == faces_total) ? std::numeric_limits<int64_t>::max() : now_ns + progress_interval_ns,
+                            std::memory_order_relaxed );
+
+    ProgressInfo progress;
+    progress.level = lvl;
+    progress.nr_levels = nr_levels;
+    progress.faces_done = faces_done;
+    progress.faces_total = faces_total;
+    progress.nr_displacements = nr_displacements;
+    if ( progress_callback(&progress, progress_user_data) != 0 )
+        canceled = true;
+}
 
-        firstLevelSubFaceOffset.push_back(subFaceOffset);
-        subFaceOffset += num_face_verts;
+
+void DhdmWriter::calc_inverse_dhdm_mats( const dhdm::Mesh & base_mesh, InverseMats & mats )
+{
+    const dhdm::Faces & faces = base_mesh.faces;
+    for (size_t f = 0; f < faces.size(); f++) {
+        const int num_face_verts = faces.count(f);
+        assert( num_face_verts >= 3 );
 
         std::vector< glm::dvec3 > face_coords;
         for (int i = 0; i < num_face_verts; i++)
-            face_coords.push_back( base_mesh->vertices[face.vertices[i].vertex].pos );
+            face_coords.push_back( base_mesh.vertices[faces.vertex(f, i)].pos );
 
         /*
         glm::dvec3 x_axis = glm::normalize( face_coords[3] - face_coords[0] );
@@ -62,294 +125,466 @@ void DhdmWriter::calculateDhdm()
 {
     uint32_t level = relative_subd_level(*base_mesh, *hd_mesh);
     std::cout << fmt::format("Subdivision levels: {}.\n", level);
+
+    nr_levels = level;
+    stats.nr_levels = level;
+    const uint32_t file_header[4] = { MAG1, nr_levels, MAG2, nr_levels };
+    out_file.write( (const char*) file_header, sizeof(file_header) );
+    stats.bytes_written += sizeof(file_header);
     if (level == 0)
         return;
 
     const bool do_translate = (fps_info != nullptr) && (fps_info->fps_count > 0);
-    nlohmann::json vi_translate;
+    std::shared_ptr<const VertexMatching> vi_translate;
     if (do_translate)
     {
-        if ( fps_info->fps_count < level )
+        // fps_count > 0 (do_translate)
+        if ( (uint32_t) fps_info->fps_count < level )
             throw std::runtime_error( fmt::format("matching files with max level {} < subdivisions level {}",
                                               fps_info->fps_count, level ) );
-        vi_translate = readJSON( fps_info->filepaths[level-1] );
+        const std::string fp_matching( fps_info->filepaths[level-1] );
+        Stopwatch sw;
+        if (session != nullptr)
+            vi_translate = session->get_matching(fp_matching);
+        else
+            vi_translate = std::make_shared<const VertexMatching>(fp_matching);
+        stats.matching_s += sw.lap();
+
+        const VertexMatching::FileHeader * mheader = vi_translate->get_header();
+        if ( mheader != nullptr )
+        {
+            if ( mheader->level != level )
+                throw std::runtime_error( fmt::format("matching file is for level {}, not {}",
+                                                      mheader->level, level) );
+            if ( mheader->fp_vertices != base_mesh->vertices.size() || mheader->fp_faces != base_mesh->faces.size() )
+                throw std::runtime_error("matching file doesn't belong to base mesh");
+        }
     }
 
     std::cout << "Calculating dhdm...\n";
 
-    dhdm_fd.magic1 = MAG1;
-    dhdm_fd.magic2 = MAG2;
-    dhdm_fd.nr_levels = level;
-    dhdm_fd.nr_levels2 = level;
+    std::shared_ptr<const InverseMats> mats;
+    if (session != nullptr)
+        mats = session->get_inverse_mats(*base_mesh, calc_inverse_dhdm_mats);
+    else
+    {
+        auto new_mats = std::make_shared<InverseMats>();
+        calc_inverse_dhdm_mats(*base_mesh, *new_mats);
+        mats = new_mats;
+    }
 
-    std::vector< std::vector<glm::dmat3x3> > mats;
-    std::vector<int> firstLevelSubFaceOffset;
-    calc_inverse_dhdm_mats(mats, firstLevelSubFaceOffset);
+    levels_out.resize(level);
+    for (LevelOutput & lo : levels_out)
+        lo.data.resize( sizeof(LevelHeader) );
 
     /* ----------- subd ------------ */
-    std::cout << fmt::format("Subdividing to level {}...\n", level);
-    dhdm::Mesh base_mesh_sd = *base_mesh;
-    base_mesh_sd.uv_layers.clear();
-    base_mesh_sd.uses_uvs = false;
-
-    std::unique_ptr<Far::TopologyRefiner> refiner( dhdm::createTopologyRefiner( level, base_mesh_sd ) );
-    Far::PrimvarRefiner primvarRefiner(*refiner);
-    auto lastLevel = refiner->GetLevel(level);
-    const int last_level_faces = lastLevel.GetNumFaces();
-    const int last_level_verts = lastLevel.GetNumVertices();
+    Stopwatch sw;
+    std::unique_ptr<SparseRegion> region;
+    if (sparse_refine)
+    {
+        region = std::make_unique<SparseRegion>( *base_mesh, level, *edited_vis, vi_translate.get() );
+        if (!region->is_worthwhile())
+        {
+            std::cout << "Edited region too big for sparse refinement, refining the whole mesh.\n";
+            region.reset();
+        }
+    }
+    stats.refine_s += sw.lap();
 
-    /* material faces */
-    std::vector<uint32_t> matIdbuffer;
+    if (low_memory_mb > 0)
     {
-        matIdbuffer.resize( refiner->GetNumFacesTotal() );
-        int face_offset = base_mesh_sd.faces.size();
-        for ( size_t i=0; i < face_offset; i++ )
-            matIdbuffer[i] = base_mesh_sd.faces[i].matId;
-        uint32_t * srcFUnifMat = matIdbuffer.data();
-        for (unsigned int lvl = 1; lvl <= level; ++lvl)
+        /* tiles of consecutive base faces (of the edited region with sparse refinement), refined one at a time */
+        const std::vector<char> faces_mask = region ? std::move(region->in_region)
+                                                    : std::vector<char>(base_mesh->faces.size(), 1);
+        region.reset();
+        const size_t tile_faces = std::max( (size_t) chunk_base_faces,
+                                            ((size_t) low_memory_mb << 20) / (refined_face_bytes << (2 * level)) );
+
+        std::vector<char> tile_mask;
+        size_t f = 0;
+        for (uint32_t tile_idx = 1; f < faces_mask.size(); tile_idx++)
         {
-            auto dstFUnifMat = (matIdbuffer.data() + face_offset);
-            primvarRefiner.InterpolateFaceUniform(lvl, srcFUnifMat, dstFUnifMat);
-            srcFUnifMat = dstFUnifMat;
-            face_offset += refiner->GetLevel(lvl).GetNumFaces();
+            tile_mask.assign(faces_mask.size(), 0);
+            size_t tile_n = 0;
+            const size_t tile_begin = f;
+            for (; f < faces_mask.size() && tile_n < tile_faces; f++)
+            {
+                if (faces_mask[f])
+                {
+                    tile_mask[f] = 1;
+                    tile_n++;
+                }
+            }
+            if (tile_n == 0)
+                break;
+
+            sw.lap();
+            SparseRegion tile( *base_mesh, level, tile_mask, vi_translate.get() );
+            std::cout << fmt::format("Tile {}: base faces {}..{} ({} with 1-ring), subdividing to level {}...\n",
+                                     tile_idx, tile_begin, f - 1, tile.sub_mesh.faces.size(), level);
+            const RefinedTopology topology( tile.sub_mesh, level );
+            tile.build_vertex_maps(*topology.refiner);
+            stats.refine_s += sw.lap();
+            calculateLevels( tile.sub_mesh, topology, &tile, *mats, vi_translate.get(), false );
         }
+
+        for (uint32_t lvl = 1; lvl <= level; ++lvl)
+            flushLevel(lvl);
+    }
+    else
+    {
+        /* the region's topology depends on the edits, only the whole mesh's is cached */
+        std::cout << fmt::format("Subdividing to level {}...\n", level);
+        std::shared_ptr<const RefinedTopology> topology;
+        if (region)
+            topology = std::make_shared<const RefinedTopology>( region->sub_mesh, level );
+        else if (session != nullptr)
+            topology = session->get_topology( *base_mesh, level );
+        else
+            topology = std::make_shared<const RefinedTopology>( *base_mesh, level );
+
+        if (region)
+            region->build_vertex_maps(*topology->refiner);
+        stats.refine_s += sw.lap();
+        calculateLevels( region ? region->sub_mesh : *base_mesh, *topology, region.get(), *mats, vi_translate.get(), true );
     }
 
-    /* vertices */
-    std::vector<dhdm::Vertex> vbuffer_pv( refiner->GetNumVerticesTotal() - base_mesh_sd.vertices.size() );
-    dhdm::Vertex * srcVerts = base_mesh_sd.vertices.data();
-    size_t vert_offset = 0;
+    stats.peak_rss = get_peak_rss();
+    std::cout << "Finished calculating dhdm." << std::endl;
+    std::cout << fmt::format("Peak memory: {} MB.\n", stats.peak_rss >> 20);
+}
+
+
+// refines base_mesh_sd (the base mesh or a region of it) level by level and adds its displacements to levels_out
+void DhdmWriter::calculateLevels( const dhdm::Mesh & base_mesh_sd, const RefinedTopology & topology,
+                                  const SparseRegion * region, const InverseMats & mats,
+                                  const VertexMatching * vi_translate, const bool flush_levels )
+{
+    const Far::TopologyRefiner * refiner = topology.refiner.get();
+    Far::PrimvarRefiner primvarRefiner(*refiner);
+
+    /* vertices of the previous and current levels only, each level is interpolated from the displaced previous one */
+    std::vector<dhdm::Vertex> prev_verts;
+    std::vector<dhdm::Vertex> verts;
+    const dhdm::Vertex * srcVerts = base_mesh_sd.vertices.data();
     size_t face_offset = base_mesh_sd.faces.size();
-    size_t prev_level_verts = base_mesh_sd.vertices.size();
-    // std::set<uint32_t> inserted_verts;
 
-    for (unsigned int lvl = 1; lvl <= level; ++lvl)
+    for (unsigned int lvl = 1; lvl <= topology.level; ++lvl)
     {
         std::cout << "Calculating level " << lvl << "...";
-        auto dstVerts = vbuffer_pv.data() + vert_offset;
-        primvarRefiner.Interpolate(lvl, srcVerts, dstVerts);
-
-        auto this_level = refiner->GetLevel(lvl);
-        const size_t this_level_verts = this_level.GetNumVertices();
+        Stopwatch sw;
+        const auto & this_level = refiner->GetLevel(lvl);
         const size_t this_level_faces = this_level.GetNumFaces();
+        verts.resize( this_level.GetNumVertices() );
+        dhdm::Vertex * dstVerts = verts.data();
+        primvarRefiner.Interpolate(lvl, srcVerts, dstVerts);
 
-        LevelHeader lh;
-        lh.nr_faces = base_mesh_sd.faces.size();
-        lh.level = lvl;
-        lh.nrDisplacements = 0;
-        lh.data_size = 0;
+        LevelData ld;
+        ld.lvl = lvl;
+        ld.this_level = &this_level;
+        ld.face_offset = face_offset;
+        ld.vbuffer = dstVerts;
+        ld.matIdbuffer = &topology.matIdbuffer;
+        ld.firstLevelSubFaceOffset = region ? &region->sub_first_level_offsets : &topology.firstLevelSubFaceOffset;
+        ld.mats = &mats;
+        ld.vi_translate = vi_translate;
+        ld.vert_owner = &topology.vert_owners[lvl-1];
+        ld.base_face_map = region ? &region->sub_to_base_face : nullptr;
+        ld.base_face_in_region = region ? &region->sub_face_in_region : nullptr;
+        ld.vert_map = region ? &region->vert_maps[lvl] : nullptr;
+
+        /* base faces are processed in chunks by the workers, chunks are merged in order */
+        const uint32_t nr_base_faces = ld.firstLevelSubFaceOffset->size();
+        const uint32_t nr_chunks = (nr_base_faces + chunk_base_faces - 1) / chunk_base_faces;
+        std::vector<LevelChunk> chunks(nr_chunks);
+        calculateLevelChunks(ld, chunks);
+
+        LevelOutput & lo = levels_out[lvl-1];
+        size_t level_size = lo.data.size();
+        for (const LevelChunk & chunk : chunks)
+            level_size += chunk.data.size();
+        lo.data.reserve(level_size);
+        for (LevelChunk & chunk : chunks)
+        {
+            lo.nrDisplacements += chunk.nrDisplacements;
+            lo.nrBaseFaces += chunk.nrBaseFaces;
+            lo.data.insert( lo.data.end(), chunk.data.begin(), chunk.data.end() );
+            std::vector<char>().swap(chunk.data);
+        }
+        chunks.clear();
+        std::cout << "\n";
 
-        const uint8_t lvl_number = (lvl + 1) * 16;
-        const uint32_t subFaceOffsetFactor = ( 1 << ( 2 * (lvl-1) ) );
-        std::unordered_map<uint32_t, uint32_t> face_disps_map;
-        std::set<uint32_t> inserted_verts;
+        const double level_s = sw.lap();
+        stats.compute_s += level_s;
+        if (lvl <= RUN_STATS_MAX_LEVELS)
+            stats.level_compute_s[lvl-1] += level_s;
 
-        for (int i = 0; i < this_level_faces; i++)
-        {
-            const uint32_t base_face_idx = matIdbuffer[ face_offset + i ];
-            const uint32_t subface_idx = (uint32_t) (i - firstLevelSubFaceOffset[base_face_idx] * subFaceOffsetFactor);
-            // auto currLevel_faceIdx = firstLevelSubFaceOffset[displ_faceIdx] * subFaceOffsetFactor + displ.subfaceIdx;
+        if (flush_levels)
+            flushLevel(lvl);
 
-            const auto fverts = this_level.GetFaceVertices(i);
-            //const auto fvuvs = this_level.GetFaceFVarValues(i, 0);
-            assert(fverts.size() <= 4);
+        face_offset += this_level_faces;
+        std::swap(prev_verts, verts);
+        srcVerts = prev_verts.data();
+    }
+}
 
-            for (int j = 0; j < fverts.size(); j++)
-            {
-                const uint32_t fvert_idx = j;
-                const uint32_t vert_idx = (uint32_t) fverts[j];
-                // const uint32_t uv_idx = (uint32_t) fvuvs[j];
-
-                //if (vert_idx < prev_level_verts)
-                //    continue;
-                //if (lvl == 1)
-                //    continue;
-                if (inserted_verts.count(vert_idx) > 0)
-                    continue;
 
-                const glm::dvec3 & vert = vbuffer_pv[vert_offset + vert_idx].pos;
-                glm::dvec3 delta;
-                if (do_translate)
-                {
-                    const std::string vert_idx_str = std::to_string(vert_idx);
-                    if (!vi_translate.contains(vert_idx_str))
-                    {
-                        throw std::runtime_error( fmt::format("Vertex index {} not found in json.\n",
-                                                  vert_idx_str) );
-                    }
-                    const unsigned int vi = vi_translate[vert_idx_str];
-                    if (vi >= hd_mesh->vertices.size())
-                    {
-                        throw std::runtime_error( fmt::format("Vertex index {} not found in hd_mesh.\n",
-                                                  vi) );
-                    }
-                    if (edited_vis->count(vi) == 0)
-                        continue;
-                    const glm::dvec3 & hd_vert = hd_mesh->vertices[vi].pos;
-                    delta = hd_vert - vert;
-                }
-                else
-                {
-                    if (edited_vis->count(vert_idx) == 0)
-                        continue;
-                    const glm::dvec3 & hd_vert = hd_mesh->vertices[vert_idx].pos;
-                    delta = hd_vert - vert;
-                }
+void DhdmWriter::calculateLevelChunks( const LevelData & ld, std::vector<LevelChunk> & chunks )
+{
+    const uint32_t nr_base_faces = ld.firstLevelSubFaceOffset->size();
+    const size_t workers_n = std::min( (size_t) num_threads, chunks.size() );
 
-                const double minimum_disp = 1e-5;
-                if (glm::length(delta) > minimum_disp)
-                {
-                    const uint32_t submat_idx = uint32_t( subface_idx / subFaceOffsetFactor );
-                    /*
-                    std::cout << "lvl = " << lvl << std::endl;
-                    std::cout << "subFaceOffsetFactor = " << subFaceOffsetFactor << std::endl;
-                    std::cout << "this_level_faces = " << this_level_faces << std::endl;
-                    std::cout << "i = " << i << std::endl;
-                    std::cout << "base_face_idx = " << base_face_idx << std::endl;
-                    std::cout << "subface_idx = " << subface_idx << std::endl;
-                    std::cout << "submat_idx = " << submat_idx << std::endl;
-                    */
-                    const glm::dvec3 delta_tan = mats[base_face_idx][submat_idx] * delta;
-
-                    DhdmWriter::VertDisp vert_disp;
-                    vert_disp.x = delta_tan[0];
-                    vert_disp.y = delta_tan[1];
-                    vert_disp.z = delta_tan[2];
-
-                    vert_disp.b1 = 0;
-                    vert_disp.b2 = 0;
-                    vert_disp.b3 = 0;
-                    vert_disp.b4 = 0;
-
-                    lh.nrDisplacements++;
-                    inserted_verts.insert(vert_idx);
-
-                    if (lvl < 4)
-                    {
-                        vert_disp.b2 = lvl_number;
-                        const unsigned short shift = 8 - (lvl << 1);
-                        vert_disp.b1 = subface_idx << shift;
-                        vert_disp.b1 = vert_disp.b1 | ( fvert_idx << (shift - 2) );
-                    }
-                    else
-                    {
-                        vert_disp.b4 = lvl_number;
-                        const unsigned short shift = 16 - (lvl << 1);
-                        uint16_t tmp = subface_idx << shift;
-                        tmp = tmp | ( fvert_idx << (shift - 2) );
-                        vert_disp.b3 = (uint8_t)(tmp >> 8);
-                        vert_disp.b2 = (uint8_t)(tmp & 0x00ff);
-                    }
-
-                    if (face_disps_map.count(base_face_idx) > 0)
-                    {
-                        DhdmWriter::LevelDisps & lvl_face_disps = lh.level_disps[ face_disps_map[base_face_idx] ];
-                        lvl_face_disps.vertices++;
-                        lvl_face_disps.vert_disps.push_back(std::move(vert_disp));
-                    }
-                    else
-                    {
-                        DhdmWriter::LevelDisps lvl_face_disps;
-                        lvl_face_disps.faceIdx = base_face_idx;
-                        lvl_face_disps.vertices = 1;
-                        lvl_face_disps.vert_disps.push_back(std::move(vert_disp));
-
-                        face_disps_map[base_face_idx] = lh.level_disps.size();
-                        lh.level_disps.push_back(std::move(lvl_face_disps));
-                    }
-
-                    vbuffer_pv[vert_offset + vert_idx].pos += delta;
-                }
-            }
-        }
+    std::atomic<size_t> next_chunk = 0;
+    std::atomic<bool> failed = false;
+    std::atomic<uint32_t> faces_done = 0;
+    std::atomic<uint32_t> nr_displacements = 0;
+    reportProgress(ld.lvl, 0, nr_base_faces, 0);
+    std::vector<std::exception_ptr> errors(workers_n);
 
-        uint32_t tot_lvl_size = 0;
-        for (size_t i = 0; i < lh.level_disps.size(); i++)
+    auto worker = [&](const size_t worker_idx)
+    {
+        try
         {
-            tot_lvl_size += sizeof(uint32_t) * 2;
-
-            const LevelDisps & lvl_face_disps = lh.level_disps[i];
-            for (size_t j = 0; j < lvl_face_disps.vert_disps.size(); j++)
+            for (size_t c = next_chunk++; c < chunks.size() && !failed && !canceled; c = next_chunk++)
             {
-                if (lh.level < 4)
-                    tot_lvl_size += sizeof(float) * 3 + sizeof(uint8_t) * 2;
-                else
-                    tot_lvl_size += sizeof(float) * 3 + sizeof(uint8_t) * 4;
+                const uint32_t bf_begin = c * chunk_base_faces;
+                const uint32_t bf_end = std::min( bf_begin + chunk_base_faces, nr_base_faces );
+                calculateLevelChunk(ld, bf_begin, bf_end, chunks[c]);
+
+                const uint32_t done = faces_done += bf_end - bf_begin;
+                const uint32_t disps = nr_displacements += chunks[c].nrDisplacements;
+                reportProgress(ld.lvl, done, nr_base_faces, disps);
             }
         }
-        lh.data_size = tot_lvl_size;
-
-        std::cout << fmt::format("  displacements in level {}: {}.\n", lvl, lh.nrDisplacements);
-        std::cout << fmt::format("  nr_faces in level {}: {}.\n", lvl, lh.nr_faces);
-        std::cout << fmt::format("  base faces with displacements in level {}: {}.\n\n", lvl, face_disps_map.size());
+        catch (...)
+        {
+            errors[worker_idx] = std::current_exception();
+            failed = true;
+        }
+    };
 
-        dhdm_fd.levels_headers.push_back(std::move(lh));
-        srcVerts = dstVerts;
-        vert_offset += this_level_verts;
-        face_offset += this_level_faces;
-        prev_level_verts = this_level_verts;
+    if (workers_n <= 1)
+    {
+        worker(0);
+    }
+    else
+    {
+        std::vector<std::thread> threads;
+        for (size_t t = 0; t < workers_n; t++)
+            threads.emplace_back(worker, t);
+        for (auto & t : threads)
+            t.join();
     }
 
-    std::cout << "Finished calculating dhdm." << std::endl;
+    for (auto & e : errors)
+    {
+        if (e)
+            std::rethrow_exception(e);
+    }
+    if (canceled)
+        throw JobCanceled();
 }
 
 
-void DhdmWriter::writeDhdm(const std::string filepath)
+void DhdmWriter::calculateLevelChunk( const LevelData & ld,
+                                      const uint32_t base_face_begin, const uint32_t base_face_end,
+                                      LevelChunk & chunk )
 {
-    std::cout << "Writing \"" << filepath << "\"...\n";
-    std::ofstream out_file;
-    out_file.open( filepath, std::ofstream::out | std::ofstream::binary | std::ofstream::trunc );
-
-    out_file.write( (char*) &dhdm_fd, sizeof(uint32_t) * 4 );
-
-    for (size_t i=0; i < dhdm_fd.levels_headers.size(); i++)
+    const uint32_t lvl = ld.lvl;
+    const uint8_t lvl_number = (lvl + 1) * 16;
+    const uint32_t subFaceOffsetFactor = ( 1 << ( 2 * (lvl-1) ) );
+    const auto & firstLevelSubFaceOffset = *ld.firstLevelSubFaceOffset;
+    const auto & matIdbuffer = *ld.matIdbuffer;
+    const auto & mats = *ld.mats;
+    const VertexMatching * vi_translate = ld.vi_translate;
+
+    /* faces of a base face are contiguous in every level */
+    const int face_begin = firstLevelSubFaceOffset[base_face_begin] * subFaceOffsetFactor;
+    const int face_end = (base_face_end < firstLevelSubFaceOffset.size()) ?
+                            firstLevelSubFaceOffset[base_face_end] * subFaceOffsetFactor :
+                            ld.this_level->GetNumFaces();
+
+    for (int i = face_begin; i < face_end; i++)
     {
-        const LevelHeader & curr_lvl_h = dhdm_fd.levels_headers[i];
-        out_file.write( (char*) &curr_lvl_h, sizeof(uint32_t) * 4 );
+        /* refined base face (a sub face in sparse refinement) and base face written to the file */
+        const uint32_t ref_face_idx = matIdbuffer[ ld.face_offset + i ];
+        /* 1-ring faces of a region: their vertices are displaced (the next levels of the region depend on them)
+           but written by the region that contains them */
+        const bool write_face = (ld.base_face_in_region == nullptr) || (*ld.base_face_in_region)[ref_face_idx];
+        const uint32_t base_face_idx = (ld.base_face_map != nullptr) ? (*ld.base_face_map)[ref_face_idx] : ref_face_idx;
+        const uint32_t subface_idx = (uint32_t) (i - firstLevelSubFaceOffset[ref_face_idx] * subFaceOffsetFactor);
+        // auto currLevel_faceIdx = firstLevelSubFaceOffset[displ_faceIdx] * subFaceOffsetFactor + displ.subfaceIdx;
+
+        const auto fverts = ld.this_level->GetFaceVertices(i);
+        //const auto fvuvs = this_level.GetFaceFVarValues(i, 0);
+        assert(fverts.size() <= 4);
+
+        for (int j = 0; j < fverts.size(); j++)
+        {
+            const uint32_t fvert_idx = j;
+            const uint32_t vert_idx = (uint32_t) fverts[j];
+            // const uint32_t uv_idx = (uint32_t) fvuvs[j];
+
+            if ((*ld.vert_owner)[vert_idx] != (uint32_t) i)
+                continue;
+            /* index in the whole mesh's refinement */
+            const uint32_t full_vert_idx = (ld.vert_map != nullptr) ? (*ld.vert_map)[vert_idx] : vert_idx;
+
+            const glm::dvec3 & vert = ld.vbuffer[vert_idx].pos;
+            glm::dvec3 delta;
+            if (vi_translate != nullptr)
+            {
+                if (full_vert_idx >= vi_translate->size())
+                {
+                    throw std::runtime_error( fmt::format("Vertex index {} not found in matching file.\n",
+                                              full_vert_idx) );
+                }
+                const unsigned int vi = (*vi_translate)[full_vert_idx];
+                if (vi >= hd_mesh->vertices.size())
+                {
+                    throw std::runtime_error( fmt::format("Vertex index {} not found in hd_mesh.\n",
+                                              vi) );
+                }
+                if (!edited_vis->contains(vi))
+                    continue;
+                const glm::dvec3 & hd_vert = hd_mesh->vertices[vi].pos;
+                delta = hd_vert - vert;
+            }
+            else
+            {
+                if (!edited_vis->contains(full_vert_idx))
+                    continue;
+                const glm::dvec3 & hd_vert = hd_mesh->vertices[full_vert_idx].pos;
+                delta = hd_vert - vert;
+            }
 
-        uint32_t lvl_data_size = 0;
+            const double minimum_disp = 1e-5;
+            if (glm::length(delta) > minimum_disp)
+            {
+                /* only the owner face touches this vertex, so no other worker reads it in this level */
+                ld.vbuffer[vert_idx].pos += delta;
+                if (!write_face)
+                    continue;
 
-        for (size_t j=0; j < curr_lvl_h.level_disps.size(); j++)
-        {
-            const LevelDisps & curr_fdisp = curr_lvl_h.level_disps[j];
+                const uint32_t submat_idx = uint32_t( subface_idx / subFaceOffsetFactor );
+                const glm::dvec3 delta_tan = mats[base_face_idx][submat_idx] * delta;
 
-            lvl_data_size += sizeof(uint32_t) * 2;
-            out_file.write( (char*) &curr_fdisp, sizeof(uint32_t) * 2 );
+                const float x = delta_tan[0];
+                const float y = delta_tan[1];
+                const float z = delta_tan[2];
+                uint8_t b1 = 0;
+                uint8_t b2 = 0;
+                uint8_t b3 = 0;
+                uint8_t b4 = 0;
 
-            assert(curr_fdisp.vertices == curr_fdisp.vert_disps.size());
-            for (size_t k=0; k < curr_fdisp.vert_disps.size(); k++)
-            {
-                const VertDisp & curr_vdisp = curr_fdisp.vert_disps[k];
+                chunk.nrDisplacements++;
 
-                if (curr_lvl_h.level < 4)
+                if (lvl < 4)
                 {
-                    lvl_data_size += sizeof(float) * 3 + sizeof(uint8_t) * 2;
-
-                    out_file.write( (char*) &curr_vdisp.x, sizeof(float) );
-                    out_file.write( (char*) &curr_vdisp.b1, sizeof(uint8_t) );
-                    out_file.write( (char*) &curr_vdisp.b2, sizeof(uint8_t) );
-                    out_file.write( (char*) &curr_vdisp.y, sizeof(float) );
-                    out_file.write( (char*) &curr_vdisp.z, sizeof(float) );
+                    b2 = lvl_number;
+                    const unsigned short shift = 8 - (lvl << 1);
+                    b1 = subface_idx << shift;
+                    b1 = b1 | ( fvert_idx << (shift - 2) );
                 }
                 else
                 {
-                    lvl_data_size += sizeof(float) * 3 + sizeof(uint8_t) * 4;
-
-                    out_file.write( (char*) &curr_vdisp.x, sizeof(float) );
-                    out_file.write( (char*) &curr_vdisp.b1, sizeof(uint8_t) );
-                    out_file.write( (char*) &curr_vdisp.b2, sizeof(uint8_t) );
-                    out_file.write( (char*) &curr_vdisp.b3, sizeof(uint8_t) );
-                    out_file.write( (char*) &curr_vdisp.b4, sizeof(uint8_t) );
-                    out_file.write( (char*) &curr_vdisp.y, sizeof(float) );
-                    out_file.write( (char*) &curr_vdisp.z, sizeof(float) );
+                    b4 = lvl_number;
+                    const unsigned short shift = 16 - (lvl << 1);
+                    uint16_t tmp = subface_idx << shift;
+                    tmp = tmp | ( fvert_idx << (shift - 2) );
+                    b3 = (uint8_t)(tmp >> 8);
+                    b2 = (uint8_t)(tmp & 0x00ff);
+                }
+
+                /* faces of the same base face are contiguous, so its record is always the last one */
+                if ( chunk.lastFaceIdx != base_face_idx )
+                {
+                    append( chunk.data, base_face_idx );
+                    chunk.countOffset = chunk.data.size();
+                    append( chunk.data, uint32_t(0) );
+                    chunk.lastFaceIdx = base_face_idx;
+                    chunk.nrBaseFaces++;
                 }
+                uint32_t count;
+                std::memcpy( &count, chunk.data.data() + chunk.countOffset, sizeof(count) );
+                count++;
+                std::memcpy( chunk.data.data() + chunk.countOffset, &count, sizeof(count) );
+
+                append( chunk.data, x );
+                append( chunk.data, b1 );
+                append( chunk.data, b2 );
+                if (lvl >= 4)
+                {
+                    append( chunk.data, b3 );
+                    append( chunk.data, b4 );
+                }
+                append( chunk.data, y );
+                append( chunk.data, z );
             }
         }
+    }
+}
+
+
+// header of a complete level, then its data to the background writer (levels are written in order)
+void DhdmWriter::flushLevel( const uint32_t lvl )
+{
+    LevelOutput & lo = levels_out[lvl-1];
+    LevelHeader lh;
+    lh.nr_faces = base_mesh->faces.size();
+    lh.level = lvl;
+    lh.nrDisplacements = lo.nrDisplacements;
+    lh.data_size = lo.data.size() - sizeof(LevelHeader);
+    std::memcpy( lo.data.data(), &lh, sizeof(lh) );
+
+    std::cout << fmt::format("  displacements in level {}: {}.\n", lvl, lh.nrDisplacements);
+    std::cout << fmt::format("  nr_faces in level {}: {}.\n", lvl, lh.nr_faces);
+    std::cout << fmt::format("  base faces with displacements in level {}: {}.\n\n", lvl, lo.nrBaseFaces);
+
+    if (lvl <= RUN_STATS_MAX_LEVELS)
+        stats.level_displacements[lvl-1] = lh.nrDisplacements;
+    stats.bytes_written += lo.data.size();
+
+    /* one write at a time, write_s is only updated by the writer thread until the next get() */
+    if (pending_write.valid())
+        pending_write.get();
+    pending_write = std::async( std::launch::async, [this, data = std::move(lo.data)]() {
+                                    Stopwatch sw;
+                                    out_file.write( data.data(), data.size() );
+                                    stats.write_s += sw.lap();
+                                } );
+    lo.data = std::vector<char>();
+}
+
+
+void DhdmWriter::writeDhdm(const std::string filepath)
+{
+    const std::string filepath_tmp = filepath + ".tmp";
+    std::cout << "Writing \"" << filepath << "\"...\n";
+    out_file.open( filepath_tmp, std::ofstream::out | std::ofstream::binary | std::ofstream::trunc );
+    if (!out_file)
+        throw std::runtime_error( fmt::format("can't write \"{}\"", filepath_tmp) );
 
-        assert( lvl_data_size == curr_lvl_h.data_size );
+    try
+    {
+        calculateDhdm();
+        if (pending_write.valid())
+            pending_write.get();
+        out_file.close();
+        if (!out_file)
+            throw std::runtime_error( fmt::format("error writing \"{}\"", filepath_tmp) );
+    }
+    catch (...)
+    {
+        if (pending_write.valid())
+            pending_write.wait();
+        out_file.close();
+        std::remove( filepath_tmp.c_str() );
+        throw;
     }
 
-    out_file.close();
+    std::remove( filepath.c_str() );
+    if ( std::rename( filepath_tmp.c_str(), filepath.c_str() ) != 0 )
+        throw std::runtime_error( fmt::format("can't rename \"{}\"", filepath_tmp) );
     std::cout << "Done writing .dhdm file.\n";
 }
-
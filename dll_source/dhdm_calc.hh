@@ -1,66 +1,144 @@
 #ifndef DHDM_CALC_H_INCLUDED
 #define DHDM_CALC_H_INCLUDED
+#include <atomic>
+#include <fstream>
+#include <future>
+#include <mutex>
+#include <stdexcept>
+
 #include "mesh.hh"
+#include "session.hh"
+#include "vertex_mask.hh"
+
+class VertexMatching;
+class SparseRegion;
+struct RefinedTopology;
+
+
+class JobCanceled : public std::runtime_error
+{
+public:
+    JobCanceled() : std::runtime_error("job canceled") {}
+};
 
 
 class DhdmWriter
 {
 public:
     DhdmWriter( const dhdm::Mesh *base_mesh, const dhdm::Mesh *hd_mesh,
-                const FilepathsInfo* fps_info, const std::set<uint32_t> *edited_vis );
+                const FilepathsInfo* fps_info, const VertexMask *edited_vis,
+                const unsigned int num_threads = 1, const bool sparse_refine = false,
+                DhdmSession * session = nullptr, const unsigned int low_memory_mb = 0 );
 
-    void calculateDhdm();
+    // progress is reported between face chunks, the callback can cancel writeDhdm() (throws JobCanceled)
+    void setProgressCallback( ProgressCallback callback, void* user_data );
+
+    // Calculates the displacements and writes the .dhdm file (to filepath + ".tmp", renamed when done).
+    // Levels are serialized by the workers and written as soon as they're complete (at the end in
+    // the low memory mode, where every tile adds to all the levels), on a background thread.
     void writeDhdm(const std::string filepath);
 
+    // timings and counters of writeDhdm() (parse_s and total_s are left to the caller)
+    const RunStats & getStats() const { return stats; }
+
 private:
     static constexpr uint32_t MAG1 = 0xd0d0d0d0;
     static constexpr uint32_t MAG2 = 0x3f800000;
 
-    struct VertDisp
-    {
-        float x;
-        uint8_t b1;
-        uint8_t b2;
-        uint8_t b3;
-        uint8_t b4;
-        float y;
-        float z;
-    };
-
-    struct LevelDisps
-    {
-        uint32_t faceIdx;
-        uint32_t vertices;
-        std::vector<DhdmWriter::VertDisp> vert_disps;
-    };
-
+    // 16 bytes before the data of each level in the file
     struct LevelHeader
     {
         uint32_t nr_faces;
         uint32_t level;
         uint32_t nrDisplacements;
         uint32_t data_size;
-        std::vector<DhdmWriter::LevelDisps> level_disps;
     };
 
-    struct DhdmFileData
+    /*
+        Serialized level data: for each base face with displacements, faceIdx and number of
+        displacements (uint32), then the displacements: x, b1, b2, [b3, b4 (level >= 4),] y, z.
+    */
+    struct LevelOutput
     {
-        uint32_t magic1;
-        uint32_t nr_levels;
-        uint32_t magic2;
-        uint32_t nr_levels2;
+        uint32_t nrDisplacements = 0;
+        uint32_t nrBaseFaces = 0;
+        std::vector<char> data;     // starts with the space of the LevelHeader, set when complete
+    };
 
-        std::vector<DhdmWriter::LevelHeader> levels_headers;
+    // shared (read-only, except vbuffer) by the workers of a level
+    struct LevelData
+    {
+        uint32_t lvl;
+        const OpenSubdiv::Far::TopologyLevel * this_level;
+        size_t face_offset;
+        dhdm::Vertex * vbuffer;
+        const std::vector<uint32_t> * matIdbuffer;
+        const std::vector<int> * firstLevelSubFaceOffset;
+        const InverseMats * mats;
+        const VertexMatching * vi_translate;
+        const std::vector<uint32_t> * vert_owner;
+
+        // sparse refinement only
+        const std::vector<uint32_t> * base_face_map;
+        const std::vector<char> * base_face_in_region;
+        const std::vector<uint32_t> * vert_map;
+    };
+
+    struct LevelChunk
+    {
+        uint32_t nrDisplacements = 0;
+        uint32_t nrBaseFaces = 0;
+        uint32_t lastFaceIdx = UINT32_MAX;
+        size_t countOffset = 0;     // of the last base face's number of displacements in data
+        std::vector<char> data;
     };
 
+    static constexpr uint32_t chunk_base_faces = 64;
+
+    // rough memory per refined face in the low memory mode's tiles (topology, vertices, tables, 1-ring)
+    static constexpr size_t refined_face_bytes = 512;
+
     const dhdm::Mesh * base_mesh;
     const dhdm::Mesh * hd_mesh;
     const FilepathsInfo* fps_info;
-    const std::set<uint32_t> * edited_vis;
-    DhdmFileData dhdm_fd;
+    const VertexMask * edited_vis;
+    unsigned int num_threads;
+    bool sparse_refine;
+    unsigned int low_memory_mb;
+    DhdmSession * session;
+    uint32_t nr_levels = 0;
+
+    std::vector<LevelOutput> levels_out;
+    std::ofstream out_file;
+    std::future<void> pending_write;
+    RunStats stats {};
+
+    ProgressCallback progress_callback = nullptr;
+    void * progress_user_data = nullptr;
+    std::mutex progress_mtx;
+    // the workers report at most once per progress_interval_ns (steady clock), see reportProgress()
+    static constexpr int64_t progress_interval_ns = 100'000'000;
+    std::atomic<int64_t> next_progress_ns = 0;
+    std::atomic<bool> canceled = false;
+
+    static void calc_inverse_dhdm_mats( const dhdm::Mesh & base_mesh, InverseMats & mats );
+
+    void reportProgress( const uint32_t lvl, const uint32_t faces_done, const uint32_t faces_total,
+                         const uint32_t nr_displacements );
+
+    void calculateDhdm();
+
+    void calculateLevels( const dhdm::Mesh & base_mesh_sd, const RefinedTopology & topology,
+                          const SparseRegion * region, const InverseMats & mats,
+                          const VertexMatching * vi_translate, const bool flush_levels );
+
+    void flushLevel( const uint32_t lvl );
+
+    void calculateLevelChunks( const LevelData & ld, std::vector<LevelChunk> & chunks );
 
-    void calc_inverse_dhdm_mats( std::vector< std::vector<glm::dmat3x3> > & mats,
-                                 std::vector<int> & firstLevelSubFaceOffset );
+    void calculateLevelChunk( const LevelData & ld,
+                              const uint32_t base_face_begin, const uint32_t base_face_end,
+                              LevelChunk & chunk );
 };
 
 #endif // DHDM_CALC_H_INCLUDED
@@ -44,17 +44,23 @@ dhdm::Mesh dhdm::Mesh::fromDSF(const std::string & geoFile, const std::string &
         mesh.vertices.push_back({glm::dvec3(vertex[0], -(double) vertex[2], vertex[1])});
     }
 
-    for (auto & poly : geometry["polylist"]["values"]) {
+    const auto & polys = geometry["polylist"]["values"];
+    mesh.faces.reserve(polys.size(), 4 * polys.size(), true);
+    std::vector<VertexId> vertices;
+    std::vector<UvId> uvs;
+    for (auto & poly : polys) {
         assert(poly.size() >= 5);
-        std::vector<FaceVertex> vertices;
+        vertices.clear();
+        uvs.clear();
         dhdm::FaceId faceIdx = mesh.faces.size();
         for (size_t i = 2; i < poly.size(); ++i) {
             VertexId vertexIdx = poly[i];
             assert(vertexIdx < mesh.vertices.size());
             auto uvIdx = get(overrides, {faceIdx, vertexIdx}).value_or(vertexIdx);
-            vertices.push_back({ .vertex = vertexIdx, .uv = uvIdx });
+            vertices.push_back(vertexIdx);
+            uvs.push_back(uvIdx);
         }
-        mesh.faces.push_back({ .vertices = std::move(vertices) });
+        mesh.faces.push_back(vertices.data(), uvs.data(), vertices.size(), 0);
     }
 
     std::cout << fmt::format( "Read {}: {} vertices, {} faces, {} UVs\n",
@@ -1,11 +1,21 @@
 #include <iostream>
 #include <fstream>
 #include <future>
+#include <algorithm>
+#include <cmath>
 #include <fmt/format.h>
 
 #include "main.hh"
 #include "utils.hh"
 #include "dhdm_calc.hh"
+#include "session.hh"
+#include "vertex_matcher.hh"
+
+
+DLL_EXPORT unsigned int get_abi_version()
+{
+    return DHDM_GEN_ABI_VERSION;
+}
 
 
 DLL_EXPORT int generate_hd_mesh( const MeshInfo* mesh_info,
@@ -13,15 +23,15 @@ DLL_EXPORT int generate_hd_mesh( const MeshInfo* mesh_info,
                                  const char* output_filename )
 {
     try{
-        dhdm::gScale = 1; // mesh_info->gScale;
+        const double scale = 1; // mesh_info->gScale;
         const std::string fp_obj = std::string(mesh_info->base_exportedf) + ".obj";
-        dhdm::Mesh loadedBaseMesh = dhdm::Mesh::fromObj( fp_obj, false, false, false );
+        dhdm::Mesh loadedBaseMesh = dhdm::Mesh::fromObj( fp_obj, false, false, false, scale );
 
         loadedBaseMesh.subdivide_simple( mesh_info->hd_level );
 
         const std::string filename(output_filename);
         const std::string filepath( std::string(output_dirpath) + "/" + filename + ".obj" );
-        loadedBaseMesh.writeObj(filepath);
+        loadedBaseMesh.writeObj(filepath, scale);
         return 0;
 
     } catch (std::exception & e) {
@@ -31,33 +41,288 @@ DLL_EXPORT int generate_hd_mesh( const MeshInfo* mesh_info,
 }
 
 
+DLL_EXPORT int generate_hd_levels( const MeshInfo* mesh_info,
+                                   const MeshBuffers* base_buffers,
+                                   HdLevelCallback callback,
+                                   void* user_data )
+{
+    try{
+        const double scale = 1;
+        const uint32_t max_level = mesh_info->hd_level;
+        if (max_level == 0)
+            throw std::runtime_error("generate_hd_levels(): level 0");
+        dhdm::Mesh baseMesh = dhdm::Mesh::fromBuffers( *base_buffers, false, scale );
+
+        std::cout << fmt::format("Subdividing (simple) to levels 1..{}...\n", max_level);
+        std::unique_ptr<OpenSubdiv::Far::TopologyRefiner> refiner( dhdm::createTopologyRefiner( max_level, baseMesh ) );
+        OpenSubdiv::Far::PrimvarRefiner primvarRefiner(*refiner);
+
+        // each level is interpolated from the previous one, then passed as floats
+        std::vector<dhdm::Vertex> src = std::move(baseMesh.vertices);
+        std::vector<dhdm::Vertex> dst;
+        std::vector<float> positions;
+        std::vector<int> face_vert_indices;
+        for (uint32_t lvl = 1; lvl <= max_level; lvl++)
+        {
+            const int nverts = refiner->GetLevel(lvl).GetNumVertices();
+            dst.resize(nverts);
+            dhdm::Vertex * srcVerts = src.data();
+            dhdm::Vertex * dstVerts = dst.data();
+            primvarRefiner.Interpolate(lvl, srcVerts, dstVerts);
+
+            positions.resize( size_t(nverts) * 3 );
+            for (int i = 0; i < nverts; i++)
+            {
+                positions[3*i]     = (float) dst[i].pos.x;
+                positions[3*i + 1] = (float) dst[i].pos.y;
+                positions[3*i + 2] = (float) dst[i].pos.z;
+            }
+            // faces of refined levels are all quads
+            const OpenSubdiv::Far::TopologyLevel & level = refiner->GetLevel(lvl);
+            const int nfaces = level.GetNumFaces();
+            face_vert_indices.resize( size_t(nfaces) * 4 );
+            for (int f = 0; f < nfaces; f++)
+            {
+                const OpenSubdiv::Far::ConstIndexArray fverts = level.GetFaceVertices(f);
+                std::copy( fverts.begin(), fverts.end(), face_vert_indices.begin() + 4 * (size_t) f );
+            }
+
+            if (callback( lvl, positions.data(), nverts, face_vert_indices.data(), nfaces, user_data ) != 0)
+                throw JobCanceled();
+            std::swap(src, dst);
+        }
+        return 0;
+    } catch (JobCanceled & e) {
+        std::cout << "-Canceled." << std::endl;
+        return -2;
+    } catch (std::exception & e) {
+        std::cout << "-Error in DLL: " << e.what() << std::endl;
+        return -1;
+    }
+}
+
+
+static void get_match_stats( const float* distances, unsigned int count, float max_dist, MatchStats & stats )
+{
+    double sum = 0;
+    stats.max_dist = 0;
+    stats.non_optimal_n = 0;
+    for (unsigned int j = 0; j < count; j++)
+    {
+        sum += distances[j];
+        if (distances[j] > stats.max_dist)
+            stats.max_dist = distances[j];
+        if (distances[j] > max_dist)
+            stats.non_optimal_n++;
+    }
+    stats.mean_dist = count > 0 ? (float) (sum / count) : 0.0f;
+}
+
+
+DLL_EXPORT int match_vertices( const float* ref_positions,
+                               unsigned int ref_count,
+                               const float* query_positions,
+                               unsigned int query_count,
+                               float max_dist,
+                               unsigned int num_threads,
+                               unsigned int* out_indices,
+                               float* out_distances,
+                               MatchStats* stats )
+{
+    try{
+        static_assert( sizeof(unsigned int) == sizeof(uint32_t) );
+        match_nearest( ref_positions, ref_count, query_positions, query_count, num_threads,
+                       reinterpret_cast<uint32_t*>(out_indices), out_distances );
+
+        if (stats)
+            get_match_stats( out_distances, query_count, max_dist, *stats );
+        return 0;
+    } catch (std::exception & e) {
+        std::cout << "-Error in DLL: " << e.what() << std::endl;
+        return -1;
+    }
+}
+
+
+DLL_EXPORT int match_vertices_topology( const MeshBuffers* ref_buffers,
+                                        const MeshBuffers* query_buffers,
+                                        float max_dist,
+                                        unsigned int* out_indices,
+                                        MatchStats* stats )
+{
+    try{
+        static_assert( sizeof(unsigned int) == sizeof(uint32_t) );
+        match_topology( *ref_buffers, *query_buffers, reinterpret_cast<uint32_t*>(out_indices) );
+
+        if (stats)
+        {
+            std::vector<float> distances( query_buffers->vert_count );
+            for (unsigned int j = 0; j < query_buffers->vert_count; j++)
+            {
+                const float * q = query_buffers->positions + 3 * (size_t) j;
+                const float * r = ref_buffers->positions + 3 * (size_t) out_indices[j];
+                distances[j] = (float) std::sqrt( double(q[0]-r[0])*(q[0]-r[0]) + double(q[1]-r[1])*(q[1]-r[1])
+                                                  + double(q[2]-r[2])*(q[2]-r[2]) );
+            }
+            get_match_stats( distances.data(), query_buffers->vert_count, max_dist, *stats );
+        }
+        return 0;
+    } catch (std::exception & e) {
+        std::cout << "-Error in DLL: " << e.what() << std::endl;
+        return -1;
+    }
+}
+
+
+static VertexMask get_edited_mask( const MeshInfo* mesh_info, const dhdm::Mesh & editedhdMesh )
+{
+    if (mesh_info->edited_mask_size != editedhdMesh.vertices.size())
+        throw std::runtime_error( fmt::format("edited mask has {} vertices, hd mesh has {}",
+                                              mesh_info->edited_mask_size, editedhdMesh.vertices.size()) );
+    return VertexMask( mesh_info->edited_mask, mesh_info->edited_mask_size );
+}
+
+
+static void write_dhdm_file( const MeshInfo* mesh_info,
+                             const dhdm::Mesh & baseMesh,
+                             const dhdm::Mesh & editedhdMesh,
+                             const VertexMask & edited_vis,
+                             const FilepathsInfo* fps_info,
+                             const char* output_dirpath,
+                             const char* output_filename,
+                             DhdmSession* session,
+                             const double parse_s )
+{
+    std::cout << fmt::format("Number of vertices detected as edited: {}.\n", edited_vis.count());
+    Stopwatch sw;
+
+    DhdmWriter dhdm_writer( &baseMesh, &editedhdMesh, fps_info, &edited_vis,
+                            mesh_info->num_threads, mesh_info->sparse_refine != 0, session,
+                            mesh_info->low_memory_mb );
+    dhdm_writer.setProgressCallback( mesh_info->progress_callback, mesh_info->progress_user_data );
+
+    const std::string dhdm_filepath( std::string(output_dirpath) + "/" + std::string(output_filename) + ".dhdm" );
+    dhdm_writer.writeDhdm(dhdm_filepath);
+
+    if (mesh_info->stats != nullptr)
+    {
+        RunStats & stats = *mesh_info->stats;
+        stats = dhdm_writer.getStats();
+        stats.parse_s = parse_s;
+        stats.total_s = parse_s + sw.lap();
+    }
+}
+
+
+DLL_EXPORT void* create_session( const size_t memory_cap )
+{
+    try{
+        return new DhdmSession(memory_cap);
+    } catch (std::exception & e) {
+        std::cout << "-Error in DLL: " << e.what() << std::endl;
+        return nullptr;
+    }
+}
+
+
+DLL_EXPORT void destroy_session( void* session )
+{
+    delete static_cast<DhdmSession*>(session);
+}
+
+
 DLL_EXPORT int generate_dhdm_file( const MeshInfo* mesh_info,
                                    const FilepathsInfo* fps_info,
                                    const char* output_dirpath,
                                    const char* output_filename )
+{
+    return session_generate_dhdm_file( nullptr, mesh_info, fps_info, output_dirpath, output_filename );
+}
+
+
+DLL_EXPORT int session_generate_dhdm_file( void* session,
+                                           const MeshInfo* mesh_info,
+                                           const FilepathsInfo* fps_info,
+                                           const char* output_dirpath,
+                                           const char* output_filename )
 {
     try{
-        dhdm::gScale = mesh_info->gScale;
+        Stopwatch sw;
+        const double scale = mesh_info->gScale;
         const std::string fp_base = std::string(mesh_info->base_exportedf) + ".obj";
         const std::string fp_hd_edit = std::string(mesh_info->base_exportedf) + "_hd_edit.obj";
-        dhdm::Mesh baseMesh = dhdm::Mesh::fromObj( fp_base, false, false, true );
-        dhdm::Mesh editedhdMesh = dhdm::Mesh::fromObj( fp_hd_edit, false, false, true );
+        const std::string fp_hd_no_edit = std::string(mesh_info->base_exportedf) + "_hd_no_edit.obj";
+        dhdm::Mesh baseMesh = dhdm::Mesh::fromObj( fp_base, false, false, true, scale );
+        dhdm::Mesh editedhdMesh = dhdm::Mesh::fromObj( fp_hd_edit, false, false, true, scale );
 
-        std::set<uint32_t> edited_vis;
+        VertexMask edited_vis;
+        if (mesh_info->edited_mask != nullptr)
+            edited_vis = get_edited_mask(mesh_info, editedhdMesh);
+        else
         {
-            const std::string fp_hd_no_edit = std::string(mesh_info->base_exportedf) + "_hd_no_edit.obj";
-            dhdm::Mesh noeditedhdMesh = dhdm::Mesh::fromObj( fp_hd_no_edit, false, false, true );
+            dhdm::Mesh noeditedhdMesh = dhdm::Mesh::fromObj( fp_hd_no_edit, false, false, true, scale );
             edited_vis = get_hd_disp_mask(noeditedhdMesh, editedhdMesh);
         }
-        std::cout << fmt::format("Number of vertices detected as edited: {}.\n", edited_vis.size());
 
-        DhdmWriter dhdm_writer(&baseMesh, &editedhdMesh, fps_info, &edited_vis);
-        dhdm_writer.calculateDhdm();
+        write_dhdm_file( mesh_info, baseMesh, editedhdMesh, edited_vis, fps_info,
+                         output_dirpath, output_filename, static_cast<DhdmSession*>(session), sw.lap() );
+        return 0;
+    } catch (JobCanceled & e) {
+        std::cout << "-Canceled." << std::endl;
+        return -2;
+    } catch (std::exception & e) {
+        std::cout << "-Error in DLL: " << e.what() << std::endl;
+        return -1;
+    }
+}
 
-        const std::string dhdm_filepath( std::string(output_dirpath) + "/" + std::string(output_filename) + ".dhdm" );
-        dhdm_writer.writeDhdm(dhdm_filepath);
 
+DLL_EXPORT int generate_dhdm_file_from_buffers( const MeshInfo* mesh_info,
+                                                const FilepathsInfo* fps_info,
+                                                const MeshBuffers* base_buffers,
+                                                const MeshBuffers* hd_no_edit_buffers,
+                                                const MeshBuffers* hd_edit_buffers,
+                                                const char* output_dirpath,
+                                                const char* output_filename )
+{
+    return session_generate_dhdm_file_from_buffers( nullptr, mesh_info, fps_info,
+                                                    base_buffers, hd_no_edit_buffers, hd_edit_buffers,
+                                                    output_dirpath, output_filename );
+}
+
+
+DLL_EXPORT int session_generate_dhdm_file_from_buffers( void* session,
+                                                        const MeshInfo* mesh_info,
+                                                        const FilepathsInfo* fps_info,
+                                                        const MeshBuffers* base_buffers,
+                                                        const MeshBuffers* hd_no_edit_buffers,
+                                                        const MeshBuffers* hd_edit_buffers,
+                                                        const char* output_dirpath,
+                                                        const char* output_filename )
+{
+    try{
+        Stopwatch sw;
+        const double scale = mesh_info->gScale;
+        dhdm::Mesh baseMesh = dhdm::Mesh::fromBuffers( *base_buffers, true, scale );
+        dhdm::Mesh editedhdMesh = dhdm::Mesh::fromBuffers( *hd_edit_buffers, true, scale );
+
+        VertexMask edited_vis;
+        if (mesh_info->edited_mask != nullptr)
+            edited_vis = get_edited_mask(mesh_info, editedhdMesh);
+        else
+        {
+            if (hd_no_edit_buffers == nullptr)
+                throw std::runtime_error("no hd_no_edit mesh nor edited mask given");
+            dhdm::Mesh noeditedhdMesh = dhdm::Mesh::fromBuffers( *hd_no_edit_buffers, true, scale );
+            edited_vis = get_hd_disp_mask(noeditedhdMesh, editedhdMesh);
+        }
+
+        write_dhdm_file( mesh_info, baseMesh, editedhdMesh, edited_vis, fps_info,
+                         output_dirpath, output_filename, static_cast<DhdmSession*>(session), sw.lap() );
         return 0;
+    } catch (JobCanceled & e) {
+        std::cout << "-Canceled." << std::endl;
+        return -2;
     } catch (std::exception & e) {
         std::cout << "-Error in DLL: " << e.what() << std::endl;
         return -1;
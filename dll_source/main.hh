@@ -1,26 +1,95 @@
 #ifndef __MAIN_H__
 #define __MAIN_H__
 
-#include <windows.h>
 #include "shared.hh"
 
-#ifdef BUILD_DLL
-    #define DLL_EXPORT __declspec(dllexport)
+#ifdef _WIN32
+    #include <windows.h>
+    #ifdef BUILD_DLL
+        #define DLL_EXPORT __declspec(dllexport)
+    #else
+        #define DLL_EXPORT __declspec(dllimport)
+    #endif
 #else
-    #define DLL_EXPORT __declspec(dllimport)
+    // shared library for headless use on Linux render nodes (see cli.py)
+    #define DLL_EXPORT __attribute__((visibility("default")))
 #endif
 
 extern "C" {
 
+    // DHDM_GEN_ABI_VERSION of the build
+    DLL_EXPORT unsigned int get_abi_version();
+
     DLL_EXPORT int generate_hd_mesh( const MeshInfo* mesh_info,
                                      const char* output_dirpath,
                                      const char* output_filename );
 
+    // Refines base_buffers once up to mesh_info->hd_level and calls callback with the vertices of every
+    // level (1..hd_level), in OpenSubdiv's order and the buffers' space (as generate_hd_mesh()'s .obj files).
+    // 0 on success, -1 on error, -2 if canceled by the callback.
+    DLL_EXPORT int generate_hd_levels( const MeshInfo* mesh_info,
+                                       const MeshBuffers* base_buffers,
+                                       HdLevelCallback callback,
+                                       void* user_data );
+
+    // Nearest reference vertex of every query vertex (kd-tree, num_threads threads, 0: all hardware threads).
+    // out_indices and out_distances: query_count values. stats (optional) gets the distance statistics.
+    // 0 on success, -1 on error.
+    DLL_EXPORT int match_vertices( const float* ref_positions,
+                                   unsigned int ref_count,
+                                   const float* query_positions,
+                                   unsigned int query_count,
+                                   float max_dist,
+                                   unsigned int num_threads,
+                                   unsigned int* out_indices,
+                                   float* out_distances,
+                                   MatchStats* stats );
+
+    // Exact correspondence between two meshes with the same topology (see match_topology() in vertex_matcher.hh):
+    // out_indices: query vertex -> ref vertex (query_buffers->vert_count values).
+    // stats (optional): distances between the matched vertices, max_dist as in match_vertices().
+    // 0 on success, -1 on error (e.g. the topologies don't match).
+    DLL_EXPORT int match_vertices_topology( const MeshBuffers* ref_buffers,
+                                            const MeshBuffers* query_buffers,
+                                            float max_dist,
+                                            unsigned int* out_indices,
+                                            MatchStats* stats );
+
+    // generate_dhdm_file*(): 0 on success, -1 on error, -2 if canceled by mesh_info's progress callback.
+    // With mesh_info->edited_mask, the hd_no_edit mesh isn't needed (no "_hd_no_edit.obj", null hd_no_edit_buffers).
     DLL_EXPORT int generate_dhdm_file( const MeshInfo* mesh_info,
                                        const FilepathsInfo* fps_info,
                                        const char* output_dirpath,
                                        const char* output_filename );
 
+    DLL_EXPORT int generate_dhdm_file_from_buffers( const MeshInfo* mesh_info,
+                                                    const FilepathsInfo* fps_info,
+                                                    const MeshBuffers* base_buffers,
+                                                    const MeshBuffers* hd_no_edit_buffers,
+                                                    const MeshBuffers* hd_edit_buffers,
+                                                    const char* output_dirpath,
+                                                    const char* output_filename );
+
+    // sessions cache base mesh data between generate calls (see session.hh)
+    DLL_EXPORT void* create_session( const size_t memory_cap );
+
+    DLL_EXPORT void destroy_session( void* session );
+
+    DLL_EXPORT int session_generate_dhdm_file( void* session,
+                                               const MeshInfo* mesh_info,
+                                               const FilepathsInfo* fps_info,
+                                               const char* output_dirpath,
+                                               const char* output_filename );
+
+    DLL_EXPORT int session_generate_dhdm_file_from_buffers( void* session,
+                                                            const MeshInfo* mesh_info,
+                                                            const FilepathsInfo* fps_info,
+                                                            const MeshBuffers* base_buffers,
+                                                            const MeshBuffers* hd_no_edit_buffers,
+                                                            const MeshBuffers* hd_edit_buffers,
+                                                            const char* output_dirpath,
+                                                            const char* output_filename );
+
 
     //-------------------------------------------------------
     /*
@@ -0,0 +1,112 @@
+#ifdef _WIN32
+    #include <windows.h>
+#else
+    #include <fcntl.h>
+    #include <sys/mman.h>
+    #include <sys/stat.h>
+    #include <unistd.h>
+#endif
+
+#include "mapped_file.hh"
+
+
+MappedFile::~MappedFile()
+{
+    close();
+}
+
+
+#ifdef _WIN32
+
+bool MappedFile::open(const std::string & fp)
+{
+    close();
+    HANDLE f = CreateFileA( fp.c_str(), GENERIC_READ, FILE_SHARE_READ, nullptr,
+                            OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL, nullptr );
+    if (f == INVALID_HANDLE_VALUE)
+        return false;
+
+    LARGE_INTEGER size;
+    if (!GetFileSizeEx(f, &size) || size.QuadPart == 0)
+    {
+        CloseHandle(f);
+        return false;
+    }
+
+    HANDLE m = CreateFileMappingA(f, nullptr, PAGE_READONLY, 0, 0, nullptr);
+    if (m == nullptr)
+    {
+        CloseHandle(f);
+        return false;
+    }
+
+    void * p = MapViewOfFile(m, FILE_MAP_READ, 0, 0, 0);
+    if (p == nullptr)
+    {
+        CloseHandle(m);
+        CloseHandle(f);
+        return false;
+    }
+
+    file_handle = f;
+    mapping_handle = m;
+    mapped = p;
+    mapped_size = (size_t) size.QuadPart;
+    return true;
+}
+
+void MappedFile::close()
+{
+    if (mapped != nullptr)
+        UnmapViewOfFile(mapped);
+    if (mapping_handle != nullptr)
+        CloseHandle((HANDLE) mapping_handle);
+    if (file_handle != nullptr)
+        CloseHandle((HANDLE) file_handle);
+    mapped = nullptr;
+    mapping_handle = nullptr;
+    file_handle = nullptr;
+    mapped_size = 0;
+}
+
+#else
+
+bool MappedFile::open(const std::string & fp)
+{
+    close();
+    const int f = ::open(fp.c_str(), O_RDONLY);
+    if (f < 0)
+        return false;
+
+    struct stat st;
+    if (fstat(f, &st) != 0 || st.st_size == 0)
+    {
+        ::close(f);
+        return false;
+    }
+
+    void * p = mmap(nullptr, (size_t) st.st_size, PROT_READ, MAP_SHARED, f, 0);
+    if (p == MAP_FAILED)
+    {
+        ::close(f);
+        return false;
+    }
+
+    fd = f;
+    mapped = p;
+    mapped_size = (size_t) st.st_size;
+    return true;
+}
+
+void MappedFile::close()
+{
+    if (mapped != nullptr)
+        munmap(mapped, mapped_size);
+    if (fd >= 0)
+        ::close(fd);
+    mapped = nullptr;
+    fd = -1;
+    mapped_size = 0;
+}
+
+#endif
@@ -0,0 +1,38 @@
+#ifndef MAPPED_FILE_H_INCLUDED
+#define MAPPED_FILE_H_INCLUDED
+
+#include <cstddef>
+#include <string>
+
+
+/*
+    Read-only memory mapping of a whole file (unmapped by close() or the destructor).
+*/
+class MappedFile
+{
+public:
+    MappedFile() = default;
+    ~MappedFile();
+
+    MappedFile(const MappedFile &) = delete;
+    MappedFile & operator=(const MappedFile &) = delete;
+
+    // false if the file can't be opened or mapped, or is empty
+    bool open(const std::string & fp);
+    void close();
+
+    const char * data() const { return (const char *) mapped; }
+    size_t size() const { return mapped_size; }
+
+private:
+    void * mapped = nullptr;
+    size_t mapped_size = 0;
+#ifdef _WIN32
+    void * file_handle = nullptr;
+    void * mapping_handle = nullptr;
+#else
+    int fd = -1;
+#endif
+};
+
+#endif // MAPPED_FILE_H_INCLUDED
@@ -0,0 +1,101 @@
+#include <cstring>
+#include <fstream>
+#include <iostream>
+#include <fmt/format.h>
+
+#include "matching.hh"
+#include "utils.hh"
+
+
+VertexMatching::VertexMatching(const std::string & fp)
+{
+    char magic[4] = {0, 0, 0, 0};
+    {
+        std::ifstream fs(fp, std::ios::binary);
+        if (!fs)
+            throw std::runtime_error( fmt::format("can't open matching file \"{}\"", fp) );
+        fs.read(magic, sizeof(magic));
+    }
+
+    if (std::memcmp(magic, MAGIC, sizeof(MAGIC)) != 0)
+    {
+        load_legacy(fp);
+        return;
+    }
+
+    std::cout << "Mapping " << "\"" << fp << "\"" << "...";
+    if (!file.open(fp))
+        throw std::runtime_error( fmt::format("can't map matching file \"{}\"", fp) );
+
+    if (file.size() < sizeof(FileHeader))
+    {
+        unmap_file();
+        throw std::runtime_error("matching file: missing header");
+    }
+    header = (const FileHeader *) file.data();
+
+    if (header->version == 0 || header->version > VERSION)
+    {
+        const uint32_t version = header->version;
+        unmap_file();
+        throw std::runtime_error( fmt::format("matching file: unsupported version {}", version) );
+    }
+    const size_t indices_offset = header_size(header->version);
+    if (file.size() < indices_offset + sizeof(uint32_t) * (size_t) header->count)
+    {
+        unmap_file();
+        throw std::runtime_error("matching file: truncated index array");
+    }
+
+    count = header->count;
+    indices = (const uint32_t *) (file.data() + indices_offset);
+    std::cout << "done." << std::endl;
+}
+
+
+VertexMatching::~VertexMatching()
+{
+    unmap_file();
+}
+
+
+uint64_t VertexMatching::get_topology_hash() const
+{
+    if (header == nullptr || header->version < 2)
+        return 0;
+    uint64_t h;
+    std::memcpy( &h, file.data() + sizeof(FileHeader), sizeof(h) );
+    return h;
+}
+
+
+void VertexMatching::load_legacy(const std::string & fp)
+{
+    const nlohmann::json j = readJSON(fp);
+    if (!j.is_object())
+        throw std::runtime_error("matching file: invalid legacy .json file");
+
+    legacy_indices.assign(j.size(), 0);
+    std::vector<bool> found(j.size(), false);
+    for (auto & [key, value] : j.items())
+    {
+        const unsigned long i = std::stoul(key);
+        if (i >= legacy_indices.size() || found[i])
+            throw std::runtime_error( fmt::format("matching file: invalid vertex index {}", key) );
+        legacy_indices[i] = value.get<uint32_t>();
+        found[i] = true;
+    }
+
+    header = nullptr;
+    count = legacy_indices.size();
+    indices = legacy_indices.data();
+}
+
+
+void VertexMatching::unmap_file()
+{
+    file.close();
+    header = nullptr;
+    indices = nullptr;
+    count = 0;
+}
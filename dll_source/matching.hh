@@ -0,0 +1,75 @@
+#ifndef MATCHING_H_INCLUDED
+#define MATCHING_H_INCLUDED
+
+#include <cstdint>
+#include <string>
+#include <vector>
+
+#include "mapped_file.hh"
+
+
+/*
+    Vertex matching between the OpenSubdiv subdivided mesh and Blender's hd mesh:
+    index i (vertex in OpenSubdiv's level) -> vertex in Blender's mesh.
+
+    Binary matching files ("f<fingerprint>_div<level>_<mr|mrr>[_<topology hash>].bin") are memory-mapped
+    and indexed directly. Legacy gzip .json files ({"i": vi, ...}) are loaded into memory.
+
+    Version 2 files add a 64 bits hash of the base mesh's topology after the version 1 header
+    (computed and checked by the addon, 0 if unknown).
+*/
+class VertexMatching
+{
+public:
+    static constexpr char MAGIC[4] = { 'D', 'H', 'M', 'F' };
+    static constexpr uint32_t VERSION = 2;
+
+    enum Method : uint32_t { METHOD_MR = 0, METHOD_MRR = 1 };
+
+    struct FileHeader
+    {
+        char magic[4];
+        uint32_t version;
+        uint32_t level;
+        uint32_t method;
+        uint32_t fp_vertices;
+        uint32_t fp_edges;
+        uint32_t fp_faces;
+        uint32_t count;
+    };
+    static_assert(sizeof(FileHeader) == 4 * 8);
+
+    static size_t header_size(const uint32_t version) { return version >= 2 ? sizeof(FileHeader) + sizeof(uint64_t) : sizeof(FileHeader); }
+
+    explicit VertexMatching(const std::string & fp);
+    ~VertexMatching();
+
+    VertexMatching(const VertexMatching &) = delete;
+    VertexMatching & operator=(const VertexMatching &) = delete;
+
+    size_t size() const { return count; }
+
+    uint32_t operator[](const size_t i) const { return indices[i]; }
+
+    bool is_legacy() const { return header == nullptr; }
+
+    // only for binary files
+    const FileHeader * get_header() const { return header; }
+
+    // 0 if unknown (legacy and version 1 files)
+    uint64_t get_topology_hash() const;
+
+private:
+    const FileHeader * header = nullptr;
+    const uint32_t * indices = nullptr;
+    size_t count = 0;
+
+    std::vector<uint32_t> legacy_indices;
+
+    MappedFile file;
+
+    void unmap_file();
+    void load_legacy(const std::string & fp);
+};
+
+#endif // MATCHING_H_INCLUDED
@@ -9,20 +9,86 @@
 #include "utils.hh"
 
 
-double dhdm::gScale = 0.01;
+void dhdm::Faces::reserve(const size_t faces_n, const size_t corners_n, const bool with_uvs)
+{
+    offsets.reserve(faces_n + 1);
+    counts.reserve(faces_n);
+    matIds.reserve(faces_n);
+    corner_verts.reserve(corners_n);
+    if (with_uvs)
+        corner_uvs.reserve(corners_n);
+}
+
+void dhdm::Faces::clear()
+{
+    offsets.assign(1, 0);
+    counts.clear();
+    corner_verts.clear();
+    corner_uvs.clear();
+    matIds.clear();
+}
+
+void dhdm::Faces::push_back(const VertexId * verts, const UvId * uvs, const int count, const short matId)
+{
+    if (uvs != nullptr && corner_uvs.size() < corner_verts.size())
+        corner_uvs.resize(corner_verts.size(), 0);
+
+    corner_verts.insert(corner_verts.end(), verts, verts + count);
+    if (uvs != nullptr)
+        corner_uvs.insert(corner_uvs.end(), uvs, uvs + count);
+    else if (has_uvs())
+        corner_uvs.resize(corner_verts.size(), 0);
+
+    counts.push_back(count);
+    offsets.push_back(corner_verts.size());
+    matIds.push_back(matId);
+}
+
+void dhdm::Faces::append(const Faces & other)
+{
+    if (other.has_uvs() && corner_uvs.size() < corner_verts.size())
+        corner_uvs.resize(corner_verts.size(), 0);
+
+    const uint32_t base = corner_verts.size();
+    corner_verts.insert(corner_verts.end(), other.corner_verts.begin(), other.corner_verts.end());
+    if (other.has_uvs())
+        corner_uvs.insert(corner_uvs.end(), other.corner_uvs.begin(), other.corner_uvs.end());
+    else if (has_uvs())
+        corner_uvs.resize(corner_verts.size(), 0);
+
+    counts.insert(counts.end(), other.counts.begin(), other.counts.end());
+    matIds.insert(matIds.end(), other.matIds.begin(), other.matIds.end());
+    offsets.reserve(offsets.size() + other.size());
+    for (size_t f = 1; f < other.offsets.size(); f++)
+        offsets.push_back(base + other.offsets[f]);
+}
 
 
 void dhdm::Mesh::triangulate()
 {
-    auto nrFaces = faces.size();
-    faces.reserve(nrFaces * 2);
-    for (size_t i = 0; i < nrFaces; ++i) {
-        auto & face = faces[i];
-        if (face.vertices.size() == 3) continue;
-        // assert(face.vertices.size() == 4);
-        faces.push_back(Face { .vertices = { face.vertices[2], face.vertices[3], face.vertices[0] } });
-        face.vertices.pop_back();
+    // quads are split in two triangles, the second ones are appended after all the faces
+    Faces tris;
+    const size_t nrFaces = faces.size();
+    tris.reserve(nrFaces * 2, faces.corners_size() * 3 / 2, faces.has_uvs());
+
+    const bool with_uvs = faces.has_uvs();
+    for (size_t f = 0; f < nrFaces; f++) {
+        const uint32_t c = faces.first(f);
+        tris.push_back( &faces.corner_verts[c], with_uvs ? &faces.corner_uvs[c] : nullptr, 3, faces.matIds[f] );
+    }
+    for (size_t f = 0; f < nrFaces; f++) {
+        if (faces.count(f) == 3) continue;
+        // assert(faces.count(f) == 4);
+        const uint32_t c = faces.first(f);
+        const VertexId verts[3] = { faces.corner_verts[c+2], faces.corner_verts[c+3], faces.corner_verts[c] };
+        if (with_uvs) {
+            const UvId uvs[3] = { faces.corner_uvs[c+2], faces.corner_uvs[c+3], faces.corner_uvs[c] };
+            tris.push_back(verts, uvs, 3, faces.matIds[f]);
+        } else {
+            tris.push_back(verts, nullptr, 3, faces.matIds[f]);
+        }
     }
+    faces = std::move(tris);
 }
 
 void dhdm::Mesh::set_subd_only_deltas(const dhdm::Mesh * originalMesh)
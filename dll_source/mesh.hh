@@ -19,8 +19,6 @@
 
 namespace dhdm {
 
-extern double gScale;
-
 struct Vertex
 {
     glm::dvec3 pos;
@@ -41,16 +39,38 @@ typedef uint32_t VertexId;
 typedef uint32_t UvId;
 typedef uint32_t FaceId;
 
-struct FaceVertex
-{
-    VertexId vertex;
-    UvId uv;
-};
-
-struct Face
+/*
+    Faces in a flat (CSR) layout, no allocation per face: the corners of face f are
+    [offsets[f], offsets[f+1]) in corner_verts (and corner_uvs).
+    counts, corner_verts and corner_uvs have the layout of OpenSubdiv's TopologyDescriptor
+    (numVertsPerFace, vertIndicesPerFace, fvar valueIndices), see topologyDescriptor().
+*/
+struct Faces
 {
-    std::vector<FaceVertex> vertices;
-    short matId;
+    std::vector<uint32_t> offsets { 0 };    // size() + 1
+    std::vector<int> counts;                // corners of each face
+    std::vector<VertexId> corner_verts;
+    std::vector<UvId> corner_uvs;           // empty or one per corner
+    std::vector<short> matIds;
+
+    size_t size() const { return counts.size(); }
+    bool empty() const { return counts.empty(); }
+    size_t corners_size() const { return corner_verts.size(); }
+    bool has_uvs() const { return !corner_uvs.empty(); }
+
+    uint32_t first(const size_t f) const { return offsets[f]; }
+    int count(const size_t f) const { return counts[f]; }
+    VertexId vertex(const size_t f, const int i) const { return corner_verts[offsets[f] + i]; }
+    UvId uv(const size_t f, const int i) const { return corner_uvs[offsets[f] + i]; }
+
+    void reserve(const size_t faces_n, const size_t corners_n, const bool with_uvs);
+    void clear();
+
+    // uvs: nullptr for a face without uvs (0 if other faces have them)
+    void push_back(const VertexId * verts, const UvId * uvs, const int count, const short matId);
+
+    // appends all the faces of other (indices unchanged)
+    void append(const Faces & other);
 };
 
 struct UV
@@ -94,7 +114,7 @@ struct VertexWeights
 struct Mesh
 {
     std::vector<Vertex> vertices;
-    std::vector<Face> faces;
+    Faces faces;
 
     bool uses_uvs = false;
     std::vector<std::vector<UV>> uv_layers;
@@ -113,17 +133,23 @@ struct Mesh
     static Mesh fromObj( const std::string & fp,
                          const bool load_uvs,
                          const bool load_materials,
-                         const bool use_face_id_mat_id );
+                         const bool use_face_id_mat_id,
+                         const double scale );
 
     FaceMap faceMapfromObj( const char * fp_obj );
 
+    static Mesh fromBuffers( const MeshBuffers & buffers,
+                             const bool use_face_id_mat_id,
+                             const double scale );
+
     static Mesh fromDSF(const std::string & geoFile, const std::string & uvFile);
 
     static Mesh fromDae( const char * fp_dae,
                          const char * fp_obj,
                          const short load_uv_layers,
                          bool load_materials,
-                         bool load_vgroups );
+                         bool load_vgroups,
+                         const double scale );
 
     void subdivide_nonvertex( const unsigned int level,
                               std::unique_ptr<OpenSubdiv::Far::TopologyRefiner> & refiner,
@@ -133,18 +159,18 @@ struct Mesh
 
     void triangulate();
 
-    void writeCollada(const std::string & fp, const std::string & name);
+    void writeCollada(const std::string & fp, const std::string & name, const double scale);
 
-    void writeObj(const std::string & fp);
+    void writeObj(const std::string & fp, const double scale);
 
     void set_subd_only_deltas(const Mesh * originalMesh);
 
 private:
-    void insertVerticesPosSource(tinyxml2::XMLDocument & dae, tinyxml2::XMLElement* parent);
+    void insertVerticesPosSource(tinyxml2::XMLDocument & dae, tinyxml2::XMLElement* parent, const double scale);
     void insertUVsSource( tinyxml2::XMLDocument & dae, tinyxml2::XMLElement* parent,
                           const std::vector<std::string> & uv_layers_names );
     void insertPolylist( tinyxml2::XMLDocument & dae, tinyxml2::XMLElement* parent,
-                         const std::vector< std::vector<Face> > & materials_faces,
+                         const std::vector< std::vector<FaceId> > & materials_faces,
                          const std::vector<std::string> & uv_layers_names );
     void insertJointsSource(tinyxml2::XMLDocument & dae, tinyxml2::XMLElement* parent);
     void insertBindPosesSource(tinyxml2::XMLDocument & dae, tinyxml2::XMLElement* parent);
@@ -155,8 +181,18 @@ private:
 };
 
 
+// view of the faces for OpenSubdiv, the index arrays aren't copied (the faces must outlive it)
+// num_uvs: values of the uv channel, 0 for none
+OpenSubdiv::Far::TopologyDescriptor topologyDescriptor( const Faces & faces, const size_t num_vertices,
+                                                        const size_t num_uvs,
+                                                        OpenSubdiv::Far::TopologyDescriptor::FVarChannel & uvChannel );
+
 OpenSubdiv::Far::TopologyRefiner * createTopologyRefiner( const unsigned int level, const Mesh & baseMesh );
 
+// topology only (no uvs)
+OpenSubdiv::Far::TopologyRefiner * createTopologyRefiner( const unsigned int level, const Faces & faces,
+                                                          const size_t num_vertices );
+
 
 class MeshSubdivider
 {
@@ -181,7 +217,7 @@ private:
     std::vector<std::vector<UV>> uv_layers_buffers;
     std::vector<VertexWeights> vweightsbuffer;
     std::vector<short> matIdbuffer;
-    std::vector<Face> faces;
+    Faces faces;
 
     std::unique_ptr<const OpenSubdiv::Far::StencilTable> vertexStencils;
     // std::unique_ptr<const OpenSubdiv::Far::StencilTable> faceVaryingStencils;
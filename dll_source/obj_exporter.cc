@@ -1,3 +1,4 @@
+#include <iterator>
 #include <optional>
 #include <fstream>
 #include <iostream>
@@ -9,76 +10,87 @@
 #include "utils.hh"
 
 
-void dhdm::Mesh::writeObj(const std::string & fp)
+// lines are formatted into a buffer written to the file in blocks of about this size
+static constexpr size_t obj_write_block_size = 1 << 22;
+
+
+void dhdm::Mesh::writeObj(const std::string & fp, const double scale)
 {
     std::cout << "Writing .obj...\n";
     std::ofstream outf;
-    outf.open( fp, std::ofstream::out | std::ofstream::trunc );
+    outf.open( fp, std::ofstream::out | std::ofstream::trunc | std::ofstream::binary );
+    if (!outf)
+        throw std::runtime_error("cannot open file");
+
+    fmt::memory_buffer buf;
+    buf.reserve(obj_write_block_size + 4096);
+    auto out = std::back_inserter(buf);
+    auto flush = [&](const bool force = false) {
+        if (buf.size() >= obj_write_block_size || (force && buf.size() > 0)) {
+            outf.write(buf.data(), buf.size());
+            buf.clear();
+        }
+    };
 
     for (auto & v : vertices)
     {
-        const glm::dvec3 pos = v.pos * dhdm::gScale;
-        outf << fmt::format("v {} {} {}\n", (float) pos.x, (float) pos.y, (float) pos.z);
+        const glm::dvec3 pos = v.pos * scale;
+        fmt::format_to(out, "v {} {} {}\n", (float) pos.x, (float) pos.y, (float) pos.z);
+        flush();
     }
 
     if (uses_uvs && uv_layers.size() > 0) {
-        for (auto & uv : uv_layers[0])
-            outf << fmt::format("vt {} {}\n", (float) uv.pos.x, (float) uv.pos.y);
+        for (auto & uv : uv_layers[0]) {
+            fmt::format_to(out, "vt {} {}\n", (float) uv.pos.x, (float) uv.pos.y);
+            flush();
+        }
     }
 
-    if (!uses_materials) {
+    auto write_face = [&](const size_t f) {
+        buf.push_back('f');
         if (uses_uvs)
         {
-            for (auto & f : faces) {
-                outf << "f";
-                for (auto & fv : f.vertices)
-                    outf << fmt::format(" {}/{}", fv.vertex + 1, fv.uv + 1);
-                outf << "\n";
-            }
+            for (int i = 0; i < faces.count(f); i++)
+                fmt::format_to(out, " {}/{}", faces.vertex(f, i) + 1, faces.uv(f, i) + 1);
         }
         else
         {
-            for (auto & f : faces) {
-                outf << "f";
-                for (auto & fv : f.vertices)
-                    outf << fmt::format(" {}", fv.vertex + 1);
-                outf << "\n";
-            }
+            for (int i = 0; i < faces.count(f); i++)
+                fmt::format_to(out, " {}", faces.vertex(f, i) + 1);
         }
+        buf.push_back('\n');
+        flush();
+    };
+
+    if (!uses_materials) {
+        for (size_t f = 0; f < faces.size(); f++)
+            write_face(f);
     }
     else {
-        std::vector< std::vector<Face> > materials_faces;
-        for (auto & f : faces) {
-            if ( (size_t) f.matId >= materials_faces.size())
-                materials_faces.resize(f.matId + 1);
-            materials_faces[f.matId].push_back(f);
+        std::vector< std::vector<FaceId> > materials_faces;
+        for (size_t f = 0; f < faces.size(); f++) {
+            const short matId = faces.matIds[f];
+            if ( (size_t) matId >= materials_faces.size())
+                materials_faces.resize(matId + 1);
+            materials_faces[matId].push_back(f);
         }
 
         const bool has_material_names = (materialNames.size() > 0);
 
         for (size_t i=0; i < materials_faces.size(); i++) {
             if (has_material_names)
-                outf << fmt::format("usemtl {}\n", materialNames[i]);
+                fmt::format_to(out, "usemtl {}\n", materialNames[i]);
             else
-                outf << fmt::format("usemtl SLOT_{}\n", i);
+                fmt::format_to(out, "usemtl SLOT_{}\n", i);
 
-            for (auto & f : materials_faces[i]) {
-                outf << "f";
-                if (uses_uvs)
-                {
-                    for (auto & fv : f.vertices)
-                        outf << fmt::format(" {}/{}", fv.vertex + 1, fv.uv + 1);
-                }
-                else
-                {
-                    for (auto & fv : f.vertices)
-                        outf << fmt::format(" {}", fv.vertex + 1);
-                }
-                outf << "\n";
-            }
+            for (const FaceId f : materials_faces[i])
+                write_face(f);
         }
     }
 
+    flush(true);
     outf.close();
+    if (!outf)
+        throw std::runtime_error("error writing file");
     std::cout << "Finished writing .obj.\n";
 }
@@ -1,48 +1,239 @@
-#include <optional>
-#include <fstream>
+#include <charconv>
+#include <cstring>
+#include <exception>
 #include <iostream>
+#include <thread>
 #include <unordered_map>
-#include <glm/gtx/io.hpp>
 #include <fmt/format.h>
 
 #include "mesh.hh"
+#include "mapped_file.hh"
 #include "utils.hh"
 
 
+/*
+    .obj reader: the file is memory-mapped and split in chunks at line boundaries, the chunks are
+    parsed in parallel (v, vt, f, usemtl and o lines, the rest is skipped) and merged in order.
+    Materials are resolved while merging, a usemtl line applies to the following faces of all chunks.
+*/
+namespace {
 
-FaceMap dhdm::Mesh::faceMapfromObj( const char * fp_obj )
+struct ObjOptions
+{
+    bool load_vertices;
+    bool load_uvs;
+    bool load_materials;
+    double scale;
+};
+
+struct ObjChunk
 {
-    std::cout << "Reading file \"" << std::string(fp_obj) << "\"...\n";
+    std::vector<dhdm::Vertex> vertices;
+    std::vector<dhdm::UV> uvs;
+    dhdm::Faces faces;
+    std::vector< std::pair<size_t, std::string> > usemtl;   // (faces of the chunk before it, material name)
+    unsigned int objects_n = 0;
+};
 
-    auto fs = std::fstream(fp_obj, std::fstream::in);
-    if (!fs) throw std::runtime_error("cannot open file");
+// minimum size of a chunk parsed by a thread
+constexpr size_t obj_chunk_min_size = 1 << 20;
 
-    FaceMap fm;
-    unsigned int n_face = 0;
-    std::string line;
-    while (std::getline(fs, line))
+
+inline const char * skip_spaces( const char * p, const char * end )
+{
+    while (p < end && (*p == ' ' || *p == '\t'))
+        p++;
+    return p;
+}
+
+template <typename T>
+inline const char * parse_number( const char * p, const char * end, T & value )
+{
+    p = skip_spaces(p, end);
+    const auto r = std::from_chars(p, end, value);
+    return (r.ec == std::errc()) ? r.ptr : nullptr;
+}
+
+inline bool starts_with( const char * p, const char * end, const std::string_view prefix )
+{
+    return size_t(end - p) >= prefix.size() && std::string_view(p, prefix.size()) == prefix;
+}
+
+[[noreturn]] void invalid_line( const char * what, const char * p, const char * end )
+{
+    throw std::runtime_error( std::string(what) + ": " + std::string(p, end) );
+}
+
+
+/*
+    Corners of a face line ("v", "v/vt", "v//vn" or "v/vt/vn", 1-based), 3 or 4 of them.
+    Returns the number of corners, uvs are required if load_uvs.
+*/
+int parse_face( const char * p, const char * end, const bool load_uvs,
+                dhdm::VertexId * verts, dhdm::UvId * uvs )
+{
+    int c = 0;
+    for (p = skip_spaces(p, end); p < end; p = skip_spaces(p, end))
     {
-        if (std::string_view(line).substr(0, 2) == "f ")
+        if (c == 4)
+            return -1;
+        uint32_t vi, uvi = 0;
+        p = parse_number(p, end, vi);
+        if (p == nullptr || vi == 0)
+            return -1;
+        if (p < end && *p == '/')
         {
-            uint32_t vs[4];
-            int c = sscanf(line.c_str() + 2, "%d %d %d %d", vs, vs+1, vs+2, vs+3);
-            if ( c != 4 && c != 3 )
-                throw std::runtime_error("Invalid face: " + line);
-            if ( c == 3 )
-                vs[3] = 0;
-            Face face;
-            for (int i=0; i < c; i++)
+            p++;
+            if (p < end && *p != '/')
             {
-                FaceVertex fv;
-                fv.vertex = vs[i]-1;
-                face.vertices.push_back( std::move(fv) );
+                p = parse_number(p, end, uvi);
+                if (p == nullptr)
+                    return -1;
             }
+            if (p < end && *p == '/')
+            {
+                uint32_t ni;
+                p = parse_number(p + 1, end, ni);
+                if (p == nullptr)
+                    return -1;
+            }
+        }
+        if (load_uvs && uvi == 0)
+            return -1;
+        verts[c] = vi - 1;
+        uvs[c] = uvi - 1;
+        c++;
+    }
+    return (c == 3 || c == 4) ? c : -1;
+}
+
 
-            faces.push_back( std::move(face) );
-            FaceTuple f( vs[0], vs[1], vs[2], vs[3] );
-            fm[ f ] = n_face;
-            n_face++;
+void parse_chunk( const char * p, const char * const end, const ObjOptions & opts, ObjChunk & chunk )
+{
+    const double inv_scale = 1 / opts.scale;
+    while (p < end)
+    {
+        const char * eol = (const char *) memchr(p, '\n', end - p);
+        if (eol == nullptr)
+            eol = end;
+        const char * le = (eol > p && eol[-1] == '\r') ? eol - 1 : eol;
+
+        if (starts_with(p, le, "v "))
+        {
+            if (opts.load_vertices)
+            {
+                glm::dvec3 pos;
+                const char * q = p + 2;
+                for (int i = 0; i < 3 && q != nullptr; i++)
+                    q = parse_number(q, le, pos[i]);
+                if (q == nullptr)
+                    invalid_line("Invalid vertex", p, le);
+                chunk.vertices.push_back( { pos * inv_scale } );
+            }
         }
+        else if (starts_with(p, le, "f "))
+        {
+            dhdm::VertexId verts[4];
+            dhdm::UvId uvs[4];
+            const int c = parse_face(p + 2, le, opts.load_uvs, verts, uvs);
+            if (c < 0)
+                invalid_line("Invalid face", p, le);
+            chunk.faces.push_back(verts, opts.load_uvs ? uvs : nullptr, c, 0);
+        }
+        else if (starts_with(p, le, "vt "))
+        {
+            if (opts.load_uvs)
+            {
+                glm::dvec2 uv;
+                const char * q = parse_number(p + 3, le, uv[0]);
+                if (q != nullptr)
+                    q = parse_number(q, le, uv[1]);
+                if (q == nullptr)
+                    invalid_line("Invalid texture coordinate", p, le);
+                chunk.uvs.push_back({ uv });
+            }
+        }
+        else if (starts_with(p, le, "usemtl "))
+        {
+            if (opts.load_materials)
+                chunk.usemtl.emplace_back( chunk.faces.size(), std::string(p + 7, le) );
+        }
+        else if (starts_with(p, le, "o "))
+        {
+            chunk.objects_n++;
+        }
+
+        p = eol + 1;
+    }
+}
+
+
+std::vector<ObjChunk> parse_obj( const std::string & fp, const ObjOptions & opts )
+{
+    std::cout << "Reading file \"" << fp << "\"...\n";
+    MappedFile file;
+    if (!file.open(fp))
+        throw std::runtime_error("cannot open file");
+
+    const char * const begin = file.data();
+    const char * const end = begin + file.size();
+
+    const size_t max_chunks = std::max<size_t>(1, file.size() / obj_chunk_min_size);
+    const size_t chunks_n = std::min<size_t>( std::max(1u, std::thread::hardware_concurrency()), max_chunks );
+
+    /* chunk boundaries: after the first newline following each nth of the file */
+    std::vector<const char *> bounds { begin };
+    for (size_t i = 1; i < chunks_n; i++)
+    {
+        const char * p = std::max(begin + i * (file.size() / chunks_n), bounds.back());
+        const char * eol = (const char *) memchr(p, '\n', end - p);
+        bounds.push_back(eol ? eol + 1 : end);
+    }
+    bounds.push_back(end);
+
+    std::vector<ObjChunk> chunks(chunks_n);
+    std::vector<std::exception_ptr> errors(chunks_n);
+    auto parse_range = [&](const size_t i) {
+        try {
+            parse_chunk(bounds[i], bounds[i+1], opts, chunks[i]);
+        } catch (...) {
+            errors[i] = std::current_exception();
+        }
+    };
+
+    std::vector<std::thread> threads;
+    for (size_t i = 1; i < chunks_n; i++)
+        threads.emplace_back(parse_range, i);
+    parse_range(0);
+    for (auto & th : threads)
+        th.join();
+
+    for (auto & e : errors)
+    {
+        if (e)
+            std::rethrow_exception(e);
+    }
+    return chunks;
+}
+
+}
+
+
+FaceMap dhdm::Mesh::faceMapfromObj( const char * fp_obj )
+{
+    const std::vector<ObjChunk> chunks = parse_obj( fp_obj, { .load_vertices = false, .load_uvs = false,
+                                                              .load_materials = false, .scale = 1.0 } );
+    for (auto & chunk : chunks)
+        faces.append(chunk.faces);
+
+    FaceMap fm;
+    fm.reserve(faces.size());
+    for (size_t f = 0; f < faces.size(); f++)
+    {
+        uint32_t vs[4] = { 0, 0, 0, 0 };
+        for (int i = 0; i < faces.count(f); i++)
+            vs[i] = faces.vertex(f, i) + 1;
+        fm[ FaceTuple(vs[0], vs[1], vs[2], vs[3]) ] = f;
     }
 
     std::cout << "Finished reading .obj.\n";
@@ -53,98 +244,71 @@ FaceMap dhdm::Mesh::faceMapfromObj( const char * fp_obj )
 dhdm::Mesh dhdm::Mesh::fromObj( const std::string & fp,
                                 const bool load_uvs,
                                 const bool load_materials,
-                                const bool use_face_id_mat_id )
+                                const bool use_face_id_mat_id,
+                                const double scale )
 {
-    std::cout << "Reading file \"" << fp << "\"...\n";
-    auto fs = std::fstream(fp, std::fstream::in);
-    if (!fs)
-        throw std::runtime_error("cannot open file");
+    std::vector<ObjChunk> chunks = parse_obj( fp, { .load_vertices = true, .load_uvs = load_uvs,
+                                                    .load_materials = load_materials, .scale = scale } );
 
     dhdm::Mesh mesh;
 
-    std::optional<std::string> objectName;
+    size_t verts_n = 0, uvs_n = 0, faces_n = 0, corners_n = 0;
+    unsigned int objects_n = 0;
+    for (auto & chunk : chunks)
+    {
+        verts_n += chunk.vertices.size();
+        uvs_n += chunk.uvs.size();
+        faces_n += chunk.faces.size();
+        corners_n += chunk.faces.corners_size();
+        objects_n += chunk.objects_n;
+    }
+    if (objects_n > 1)
+        throw std::runtime_error(".obj file contains multiple meshes.");
+
+    std::vector<UV> uv_layer;
+    mesh.vertices.reserve(verts_n);
+    uv_layer.reserve(uvs_n);
+    mesh.faces.reserve(faces_n, corners_n, load_uvs);
 
     std::unordered_map<std::string, short> materialMap;
     short curr_matId = -1;
+    auto use_material = [&](const std::string & matName) {
+        auto it = materialMap.find(matName);
+        if (it != materialMap.end()) {
+            curr_matId = it -> second;
+        } else {
+            mesh.materialNames.push_back(matName);
+            curr_matId = (short) (mesh.materialNames.size() - 1);
+            materialMap[matName] = curr_matId;
+        }
+    };
 
-    bool first_face = true;
-    std::vector<UV> uv_layer;
-
-    std::string line;
-    while (std::getline(fs, line))
+    for (auto & chunk : chunks)
     {
-        if ( std::string_view(line).substr(0, 2) == "o " ) {
-            if (objectName)
-                throw std::runtime_error(".obj file contains multiple meshes.");
-            objectName = std::string(line, 2);
-
-        } else if (std::string_view(line).substr(0, 2) == "v ") {
-            double x, y, z;
-            if ( sscanf(line.c_str() + 2, "%lf %lf %lf", &x, &y, &z) != 3 )
-                throw std::runtime_error("Invalid vertex: " + line);
-            dhdm::Vertex vert( { glm::dvec3(x, y, z) } );
-            vert.pos = vert.pos * (1/dhdm::gScale);
-            mesh.vertices.push_back( std::move(vert) );
-
-        } else if (std::string_view(line).substr(0, 3) == "vt ") {
-            if (load_uvs)
-            {
-                double u, v;
-                if (sscanf(line.c_str() + 3, "%lf %lf", &u, &v) != 2)
-                    throw std::runtime_error("Invalid texture coordinate: " + line);
-                uv_layer.push_back({ glm::dvec2(u, v) });
-            }
-        } else if (std::string_view(line).substr(0, 2) == "f ") {
-            Face face;
-            if (load_uvs)
-            {
-                uint32_t vs[4];
-                uint32_t uvs[4];
-                int c = sscanf(line.c_str() + 2, "%d/%d %d/%d %d/%d %d/%d", vs, uvs, vs+1, uvs+1, vs+2, uvs+2, vs+3, uvs+3);
-                if ( c != 6 && c != 8 )
-                    throw std::runtime_error("Invalid face: " + line);
-                c /= 2;
-                for (int i=0; i < c; i++)
-                    face.vertices.push_back( { .vertex = VertexId(vs[i]-1), .uv = UvId(uvs[i]-1) } );
-            }
-            else
-            {
-                uint32_t vs[4];
-                const int c = sscanf(line.c_str() + 2, "%d %d %d %d", vs, vs+1, vs+2, vs+3);
-                if ( c != 3 && c != 4 )
-                    throw std::runtime_error("Invalid face: " + line);
-                for (int i=0; i < c; i++)
-                    face.vertices.push_back( { .vertex = VertexId(vs[i]-1), .uv = 0 } );
-            }
+        mesh.vertices.insert(mesh.vertices.end(), chunk.vertices.begin(), chunk.vertices.end());
+        uv_layer.insert(uv_layer.end(), chunk.uvs.begin(), chunk.uvs.end());
+
+        const size_t face_offset = mesh.faces.size();
+        mesh.faces.append(chunk.faces);
 
+        auto mtl = chunk.usemtl.begin();
+        for (size_t f = 0; f < chunk.faces.size(); f++)
+        {
+            for (; mtl != chunk.usemtl.end() && mtl->first <= f; ++mtl)
+                use_material(mtl->second);
+
+            short & matId = mesh.faces.matIds[face_offset + f];
             if (load_materials)
-            {
-                face.matId = curr_matId;
-            }
+                matId = curr_matId;
             else if (use_face_id_mat_id)
-            {
-                face.matId = mesh.faces.size();
-            }
+                matId = face_offset + f;
             else
-            {
-                face.matId = 0;
-            }
-
-            mesh.faces.push_back( std::move(face) );
-
-        } else if (load_materials && std::string_view(line).substr(0, 7) == "usemtl ") {
-            std::string matName = std::string(line, 7);
-
-            auto it = materialMap.find(matName);
-            if (it != materialMap.end()) {
-                curr_matId = it -> second;
-            } else {
-                mesh.materialNames.push_back(matName);
-                curr_matId = (short) (mesh.materialNames.size() - 1);
-                materialMap[matName] = curr_matId;
-            }
+                matId = 0;
         }
+        for (; mtl != chunk.usemtl.end(); ++mtl)
+            use_material(mtl->second);
 
+        chunk = ObjChunk();
     }
 
     mesh.uses_uvs = false;
@@ -160,7 +324,6 @@ dhdm::Mesh dhdm::Mesh::fromObj( const std::string & fp,
     mesh.uses_vgroups = false;
 
     /*
-    std::cout << "Mesh name: " << *objectName << "\n";
     std::cout << fmt::format("Number of vertices: {}\n", mesh.vertices.size());
     std::cout << fmt::format("Number of faces: {}\n", mesh.faces.size());
     std::cout << fmt::format("Number of materials: {}\n", mesh.materialNames.size());
@@ -0,0 +1,204 @@
+#include <iostream>
+#include <filesystem>
+#include <fmt/format.h>
+
+#include "session.hh"
+#include "matching.hh"
+
+using namespace OpenSubdiv;
+
+
+/* FNV-1a */
+static void hash_bytes( uint64_t & h, const void * data, const size_t n )
+{
+    const uint8_t * p = (const uint8_t *) data;
+    for (size_t i = 0; i < n; i++)
+    {
+        h ^= p[i];
+        h *= 0x100000001b3ULL;
+    }
+}
+
+uint64_t topology_hash( const dhdm::Mesh & mesh )
+{
+    uint64_t h = 0xcbf29ce484222325ULL;
+    const uint64_t verts_n = mesh.vertices.size();
+    hash_bytes(h, &verts_n, sizeof(verts_n));
+    const dhdm::Faces & faces = mesh.faces;
+    for (size_t f = 0; f < faces.size(); f++)
+    {
+        const uint32_t face_verts_n = faces.count(f);
+        hash_bytes(h, &face_verts_n, sizeof(face_verts_n));
+        hash_bytes(h, &faces.corner_verts[faces.first(f)], face_verts_n * sizeof(dhdm::VertexId));
+        hash_bytes(h, &faces.matIds[f], sizeof(faces.matIds[f]));
+    }
+    return h;
+}
+
+uint64_t positions_hash( const dhdm::Mesh & mesh )
+{
+    uint64_t h = 0xcbf29ce484222325ULL;
+    for (auto & v : mesh.vertices)
+        hash_bytes(h, &v.pos, sizeof(v.pos));
+    return h;
+}
+
+
+RefinedTopology::RefinedTopology( const dhdm::Mesh & mesh, const uint32_t level ) :
+    level(level)
+{
+    refiner.reset( dhdm::createTopologyRefiner( level, mesh.faces, mesh.vertices.size() ) );
+
+    /* the first level has a quad per corner of the base faces */
+    firstLevelSubFaceOffset.assign( mesh.faces.offsets.begin(), mesh.faces.offsets.end() - 1 );
+
+    /* material faces */
+    Far::PrimvarRefiner primvarRefiner(*refiner);
+    matIdbuffer.resize( refiner->GetNumFacesTotal() );
+    int face_offset = mesh.faces.size();
+    std::copy( mesh.faces.matIds.begin(), mesh.faces.matIds.end(), matIdbuffer.begin() );
+    uint32_t * srcFUnifMat = matIdbuffer.data();
+    for (unsigned int lvl = 1; lvl <= level; ++lvl)
+    {
+        auto dstFUnifMat = (matIdbuffer.data() + face_offset);
+        primvarRefiner.InterpolateFaceUniform(lvl, srcFUnifMat, dstFUnifMat);
+        srcFUnifMat = dstFUnifMat;
+        face_offset += refiner->GetLevel(lvl).GetNumFaces();
+    }
+
+    /* a vertex shared by several faces is written once, by the first face that uses it */
+    for (unsigned int lvl = 1; lvl <= level; ++lvl)
+    {
+        const auto & this_level = refiner->GetLevel(lvl);
+        std::vector<uint32_t> vert_owner( this_level.GetNumVertices(), UINT32_MAX );
+        for (int i = 0; i < this_level.GetNumFaces(); i++)
+        {
+            const auto fverts = this_level.GetFaceVertices(i);
+            for (int j = 0; j < fverts.size(); j++)
+            {
+                if (vert_owner[fverts[j]] == UINT32_MAX)
+                    vert_owner[fverts[j]] = i;
+            }
+        }
+        vert_owners.push_back(std::move(vert_owner));
+    }
+}
+
+size_t RefinedTopology::memory_size() const
+{
+    // rough estimate of Vtr's per component tables
+    size_t n = refiner->GetNumVerticesTotal() * 48 +
+               refiner->GetNumEdgesTotal() * 32 +
+               refiner->GetNumFacesTotal() * 40;
+
+    n += matIdbuffer.size() * sizeof(uint32_t);
+    n += firstLevelSubFaceOffset.size() * sizeof(int);
+    for (auto & vo : vert_owners)
+        n += vo.size() * sizeof(uint32_t);
+    return n;
+}
+
+
+DhdmSession::DhdmSession( const size_t memory_cap ) :
+    memory_cap(memory_cap)
+{
+}
+
+std::shared_ptr<const void> DhdmSession::lookup( const std::string & key )
+{
+    std::lock_guard<std::mutex> lock(mtx);
+    auto it = entries.find(key);
+    if (it == entries.end())
+        return nullptr;
+    lru.splice(lru.begin(), lru, it->second);
+    return it->second->value;
+}
+
+void DhdmSession::insert( const std::string & key, std::shared_ptr<const void> value, const size_t bytes )
+{
+    std::lock_guard<std::mutex> lock(mtx);
+    auto it = entries.find(key);
+    if (it != entries.end())
+    {
+        memory_used -= it->second->bytes;
+        lru.erase(it->second);
+        entries.erase(it);
+    }
+    lru.push_front( Entry{ key, std::move(value), bytes } );
+    entries[key] = lru.begin();
+    memory_used += bytes;
+    evict();
+}
+
+void DhdmSession::evict()
+{
+    // the most recently used entry is always kept
+    while (memory_used > memory_cap && lru.size() > 1)
+    {
+        const Entry & e = lru.back();
+        std::cout << fmt::format("Session: evicting \"{}\" ({} MB).\n", e.key, e.bytes >> 20);
+        memory_used -= e.bytes;
+        entries.erase(e.key);
+        lru.pop_back();
+    }
+}
+
+size_t DhdmSession::get_memory_used()
+{
+    std::lock_guard<std::mutex> lock(mtx);
+    return memory_used;
+}
+
+
+std::shared_ptr<const RefinedTopology> DhdmSession::get_topology( const dhdm::Mesh & base_mesh, const uint32_t level )
+{
+    const std::string key = fmt::format("topology_{:016x}_div{}", topology_hash(base_mesh), level);
+    auto cached = std::static_pointer_cast<const RefinedTopology>( lookup(key) );
+    if (cached)
+    {
+        std::cout << "Session: using cached subdivision topology.\n";
+        return cached;
+    }
+
+    auto topology = std::make_shared<const RefinedTopology>( base_mesh, level );
+    insert( key, topology, topology->memory_size() );
+    return topology;
+}
+
+std::shared_ptr<const InverseMats> DhdmSession::get_inverse_mats( const dhdm::Mesh & base_mesh,
+                                                                  void (*calc_mats)(const dhdm::Mesh &, InverseMats &) )
+{
+    const std::string key = fmt::format("mats_{:016x}_{:016x}", topology_hash(base_mesh), positions_hash(base_mesh));
+    auto cached = std::static_pointer_cast<const InverseMats>( lookup(key) );
+    if (cached)
+    {
+        std::cout << "Session: using cached base mesh matrices.\n";
+        return cached;
+    }
+
+    auto mats = std::make_shared<InverseMats>();
+    calc_mats(base_mesh, *mats);
+    size_t bytes = 0;
+    for (auto & face_mats : *mats)
+        bytes += sizeof(face_mats) + face_mats.size() * sizeof(glm::dmat3x3);
+    insert( key, mats, bytes );
+    return mats;
+}
+
+std::shared_ptr<const VertexMatching> DhdmSession::get_matching( const std::string & fp )
+{
+    // a rewritten matching file gets a new key, the old entry ages out
+    const auto fsp = std::filesystem::u8path(fp);
+    const std::string key = fmt::format( "matching_{}_{}_{}", fp, std::filesystem::file_size(fsp),
+                                         std::filesystem::last_write_time(fsp).time_since_epoch().count() );
+    auto cached = std::static_pointer_cast<const VertexMatching>( lookup(key) );
+    if (cached)
+    {
+        std::cout << "Session: using cached matching file.\n";
+        return cached;
+    }
+
+    auto matching = std::make_shared<const VertexMatching>( fp );
+    insert( key, matching, matching->size() * sizeof(uint32_t) );
+    return matching;
+}
@@ -0,0 +1,87 @@
+#ifndef SESSION_H_INCLUDED
+#define SESSION_H_INCLUDED
+
+#include <list>
+#include <memory>
+#include <mutex>
+#include <string>
+#include <unordered_map>
+#include <vector>
+
+#include "mesh.hh"
+
+class VertexMatching;
+
+
+using InverseMats = std::vector< std::vector<glm::dmat3x3> >;
+
+
+/*
+    Uniform refinement of a base mesh and the data that only depends on its topology.
+*/
+struct RefinedTopology
+{
+    RefinedTopology( const dhdm::Mesh & mesh, const uint32_t level );
+
+    size_t memory_size() const;
+
+    uint32_t level;
+    std::unique_ptr<OpenSubdiv::Far::TopologyRefiner> refiner;
+    std::vector<uint32_t> matIdbuffer;                  // refined faces of all levels -> base face (matId)
+    std::vector<int> firstLevelSubFaceOffset;           // first level subfaces offset of each base face
+    std::vector< std::vector<uint32_t> > vert_owners;   // per level (lvl-1): first face using each vertex
+};
+
+
+/*
+    Caches what doesn't change between morphs of the same base figure:
+    refined topology (per base mesh topology and level), inverse tangent matrices
+    (per base mesh positions) and matching files (per path and modification time).
+
+    Entries are evicted least recently used first when the estimated memory goes above memory_cap.
+    Values are shared_ptrs, so evicted entries still in use by a running generation stay valid.
+    Thread safe: values are created outside the lock, concurrent misses may build the same entry twice.
+*/
+class DhdmSession
+{
+public:
+    explicit DhdmSession( const size_t memory_cap );
+
+    DhdmSession(const DhdmSession &) = delete;
+    DhdmSession & operator=(const DhdmSession &) = delete;
+
+    std::shared_ptr<const RefinedTopology> get_topology( const dhdm::Mesh & base_mesh, const uint32_t level );
+
+    // calc_mats is called on misses
+    std::shared_ptr<const InverseMats> get_inverse_mats( const dhdm::Mesh & base_mesh,
+                                                         void (*calc_mats)(const dhdm::Mesh &, InverseMats &) );
+
+    std::shared_ptr<const VertexMatching> get_matching( const std::string & fp );
+
+    size_t get_memory_used();
+
+private:
+    struct Entry
+    {
+        std::string key;
+        std::shared_ptr<const void> value;
+        size_t bytes;
+    };
+
+    size_t memory_cap;
+    size_t memory_used = 0;
+    std::list<Entry> lru;       // most recently used first
+    std::unordered_map< std::string, std::list<Entry>::iterator > entries;
+    std::mutex mtx;
+
+    std::shared_ptr<const void> lookup( const std::string & key );
+    void insert( const std::string & key, std::shared_ptr<const void> value, const size_t bytes );
+    void evict();
+};
+
+
+uint64_t topology_hash( const dhdm::Mesh & mesh );
+
+uint64_t positions_hash( const dhdm::Mesh & mesh );
+
+#endif // SESSION_H_INCLUDED
@@ -6,18 +6,90 @@
 
 extern "C" {
 
+// Version of the interface (structs and exported functions) dll_wrapper.py is written for, it refuses
+// libraries of another version: increment it with any change to them.
+#define DHDM_GEN_ABI_VERSION 1
+
 struct FilepathsInfo
 {
     char** filepaths;
     short fps_count;
 };
 
+struct ProgressInfo
+{
+    unsigned int level;             // level being calculated (1..nr_levels)
+    unsigned int nr_levels;
+    unsigned int faces_done;        // base faces processed in the level
+    unsigned int faces_total;
+    unsigned int nr_displacements;  // displacements found in the level so far
+};
+
+// called from the worker threads (one call at a time), at the start and end of every level and at most
+// every 100 ms in between; a non-zero return value cancels the job
+typedef int (*ProgressCallback)( const ProgressInfo* progress, void* user_data );
+
+// positions: vert_count * 3 floats, face_vert_indices: face_count * 4 ints (quads), only valid during the call.
+// A non-zero return value cancels the job.
+typedef int (*HdLevelCallback)( unsigned int level, const float* positions, unsigned int vert_count,
+                                const int* face_vert_indices, unsigned int face_count, void* user_data );
+
+#define RUN_STATS_MAX_LEVELS 8
+
+// timings (seconds) and counters of a .dhdm job, filled when MeshInfo::stats is given
+struct RunStats
+{
+    double parse_s;                 // reading the meshes (.obj files or buffers) and the edited vertices
+    double matching_s;              // loading the matching file
+    double refine_s;                // topology refinement (almost 0 when reused from the session)
+    double compute_s;               // displacements of all the levels
+    double write_s;                 // writing the file (on a background thread, overlaps compute_s)
+    double total_s;
+    unsigned int nr_levels;
+    double level_compute_s[RUN_STATS_MAX_LEVELS];
+    unsigned int level_displacements[RUN_STATS_MAX_LEVELS];
+    unsigned long long bytes_written;
+    unsigned long long peak_rss;    // peak resident memory of the process in bytes (0 if unknown)
+};
+
+/*
+    Per job context passed to every exported function (the dll has no process globals,
+    so jobs can run concurrently on different threads).
+*/
 struct MeshInfo
 {
     float gScale;
     char* base_exportedf;
     unsigned short hd_level;
     short load_uv_layers;
+    unsigned short num_threads;     // 0: all hardware threads
+    unsigned short sparse_refine;   // refine only the edited region
+    ProgressCallback progress_callback;     // optional
+    void* progress_user_data;
+    // optional edited hd vertices, bit i (byte i/8, bit i%8) set if hd vertex i was edited.
+    // When given, the hd_no_edit mesh is not used (not read, buffers may be null).
+    const unsigned char* edited_mask;
+    unsigned int edited_mask_size;          // number of bits (hd mesh vertices)
+    // low memory mode: 0 off, else the mesh is refined in tiles of base faces using about this many MB each
+    unsigned int low_memory_mb;
+    RunStats* stats;                        // optional, set by the generate_dhdm_file* functions
+};
+
+struct MeshBuffers
+{
+    const float* positions;         // vert_count * 3 floats
+    unsigned int vert_count;
+    const int* face_vert_counts;    // face_count ints
+    const int* face_vert_indices;   // sum(face_vert_counts) ints
+    unsigned int face_count;
+};
+
+// distance statistics of match_vertices()
+struct MatchStats
+{
+    float max_dist;                 // largest distance to a nearest reference vertex
+    float mean_dist;
+    unsigned int non_optimal_n;     // number of query vertices farther than the given max_dist
 };
 
 }   // extern C
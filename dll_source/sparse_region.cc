@@ -0,0 +1,268 @@
+#include <algorithm>
+#include <iostream>
+#include <fmt/format.h>
+
+#include "sparse_region.hh"
+#include "matching.hh"
+
+using namespace OpenSubdiv;
+
+
+SparseRegion::SparseRegion( const dhdm::Mesh & base_mesh, const uint32_t level,
+                            const VertexMask & edited_vis, const VertexMatching * vi_translate ) :
+    level(level), base_faces_n(base_mesh.faces.size())
+{
+    init_counts(base_mesh, vi_translate);
+
+    /* base faces containing edited vertices */
+    in_region.assign(base_faces_n, 0);
+    for (uint64_t vi = 0; vi < nverts[level]; vi++)
+    {
+        const uint32_t hd_vi = (vi_translate != nullptr) ? (*vi_translate)[vi] : vi;
+        if (edited_vis.contains(hd_vi))
+            mark_ancestor_faces(vi, in_region);
+    }
+
+    build_sub_mesh(base_mesh);
+    std::cout << fmt::format("Edited region: {} base faces ({} with 1-ring) of {}.\n",
+                             region_faces_n, sub_mesh.faces.size(), base_faces_n);
+}
+
+
+SparseRegion::SparseRegion( const dhdm::Mesh & base_mesh, const uint32_t level,
+                            const std::vector<char> & in_region, const VertexMatching * vi_translate ) :
+    in_region(in_region), level(level), base_faces_n(base_mesh.faces.size())
+{
+    if (in_region.size() != base_faces_n)
+        throw std::runtime_error("SparseRegion: faces mask doesn't match base mesh");
+    init_counts(base_mesh, vi_translate);
+    build_sub_mesh(base_mesh);
+}
+
+
+void SparseRegion::init_counts( const dhdm::Mesh & base_mesh, const VertexMatching * vi_translate )
+{
+    base_refiner.reset( dhdm::createTopologyRefiner(0, base_mesh) );
+    const Far::TopologyLevel & base = base_refiner->GetLevel(0);
+
+    face_offsets.resize(base_faces_n + 1);
+    face_offsets[0] = 0;
+    for (size_t f = 0; f < base_faces_n; f++)
+        face_offsets[f+1] = face_offsets[f] + base.GetFaceVertices(f).size();
+
+    nverts.resize(level + 1);
+    nfaces.resize(level + 1);
+    nedges.resize(level + 1);
+    nverts[0] = base.GetNumVertices();
+    nfaces[0] = base.GetNumFaces();
+    nedges[0] = base.GetNumEdges();
+    for (uint32_t n = 0; n < level; n++)
+    {
+        nverts[n+1] = nverts[n] + nfaces[n] + nedges[n];
+        nfaces[n+1] = child_faces_count(n);
+        nedges[n+1] = 2 * nedges[n] + child_faces_count(n);
+    }
+
+    if (vi_translate != nullptr && vi_translate->size() < nverts[level])
+        throw std::runtime_error( fmt::format("matching file has {} vertices, subdivided mesh has {}",
+                                              vi_translate->size(), nverts[level]) );
+}
+
+
+void SparseRegion::build_sub_mesh( const dhdm::Mesh & base_mesh )
+{
+    const Far::TopologyLevel & base = base_refiner->GetLevel(0);
+
+    /* 1-ring */
+    std::vector<char> in_sub(in_region);
+    for (size_t f = 0; f < base_faces_n; f++)
+    {
+        if (!in_region[f])
+            continue;
+        region_faces_n++;
+        for (const int v : base.GetFaceVertices(f))
+        {
+            for (const int g : base.GetVertexFaces(v))
+                in_sub[g] = 1;
+        }
+    }
+
+    /* sub mesh (base order kept) */
+    std::vector<int64_t> base_to_sub_vert(base_mesh.vertices.size(), -1);
+    for (size_t f = 0; f < base_faces_n; f++)
+    {
+        if (!in_sub[f])
+            continue;
+        for (int i = 0; i < base_mesh.faces.count(f); i++)
+            base_to_sub_vert[base_mesh.faces.vertex(f, i)] = 0;
+    }
+    for (size_t v = 0; v < base_to_sub_vert.size(); v++)
+    {
+        if (base_to_sub_vert[v] < 0)
+            continue;
+        base_to_sub_vert[v] = sub_to_base_vert.size();
+        sub_to_base_vert.push_back(v);
+        sub_mesh.vertices.push_back(base_mesh.vertices[v]);
+    }
+
+    int subFaceOffset = 0;
+    for (size_t f = 0; f < base_faces_n; f++)
+    {
+        if (!in_sub[f])
+            continue;
+        const int count = base_mesh.faces.count(f);
+        dhdm::VertexId verts[4];
+        for (int i = 0; i < count; i++)
+            verts[i] = (dhdm::VertexId) base_to_sub_vert[base_mesh.faces.vertex(f, i)];
+
+        sub_first_level_offsets.push_back(subFaceOffset);
+        subFaceOffset += count;
+
+        sub_to_base_face.push_back(f);
+        sub_face_in_region.push_back(in_region[f]);
+        sub_mesh.faces.push_back(verts, nullptr, count, (short) sub_mesh.faces.size());
+    }
+}
+
+
+bool SparseRegion::is_worthwhile() const
+{
+    return sub_mesh.faces.size() < max_faces_ratio * base_faces_n;
+}
+
+
+// number of faces (and of edges from faces) created when refining level n
+uint32_t SparseRegion::child_faces_count(const uint32_t n) const
+{
+    return (n == 0) ? face_offsets.back() : 4 * nfaces[n];
+}
+
+
+// base face containing face f of level n
+uint32_t SparseRegion::base_face_of(uint64_t f, const uint32_t n) const
+{
+    if (n == 0)
+        return f;
+    f = f >> ( 2 * (n-1) );
+    return ( std::upper_bound(face_offsets.begin(), face_offsets.end(), f) - face_offsets.begin() ) - 1;
+}
+
+
+void SparseRegion::mark_ancestor_faces(uint64_t vi, std::vector<char> & in_region) const
+{
+    const Far::TopologyLevel & base = base_refiner->GetLevel(0);
+
+    uint32_t n = level;
+    while (n > 0)
+    {
+        /* child of a vertex: same index */
+        if (vi < nverts[n-1])
+        {
+            n--;
+            continue;
+        }
+        vi -= nverts[n-1];
+
+        /* child of a face */
+        if (vi < nfaces[n-1])
+        {
+            in_region[ base_face_of(vi, n-1) ] = 1;
+            return;
+        }
+        vi -= nfaces[n-1];
+
+        /* child of an edge: an edge inside a face or a half of a parent edge */
+        uint64_t e = vi;
+        uint32_t m = n - 1;
+        while (m > 0)
+        {
+            const uint64_t face_edges = child_faces_count(m-1);
+            if (e < face_edges)
+            {
+                const uint64_t f = (m-1 == 0) ?
+                        ( std::upper_bound(face_offsets.begin(), face_offsets.end(), e) - face_offsets.begin() ) - 1 :
+                        e / 4;
+                in_region[ base_face_of(f, m-1) ] = 1;
+                return;
+            }
+            e = (e - face_edges) / 2;
+            m--;
+        }
+        for (const int f : base.GetEdgeFaces(e))
+            in_region[f] = 1;
+        return;
+    }
+
+    for (const int f : base.GetVertexFaces(vi))
+        in_region[f] = 1;
+}
+
+
+void SparseRegion::build_vertex_maps( const Far::TopologyRefiner & sub_refiner )
+{
+    const Far::TopologyLevel & base = base_refiner->GetLevel(0);
+    const Far::TopologyLevel & sub_base = sub_refiner.GetLevel(0);
+
+    std::vector<uint32_t> vmap(sub_to_base_vert);
+    std::vector<uint64_t> fmap(sub_to_base_face.begin(), sub_to_base_face.end());
+    std::vector<uint64_t> emap(sub_base.GetNumEdges());
+    std::vector<char> eflip(sub_base.GetNumEdges(), 0);
+    for (int e = 0; e < sub_base.GetNumEdges(); e++)
+    {
+        const auto ev = sub_base.GetEdgeVertices(e);
+        const int be = base.FindEdge(vmap[ev[0]], vmap[ev[1]]);
+        if (be < 0)
+            throw std::runtime_error("SparseRegion: edge not found in base mesh");
+        emap[e] = be;
+        eflip[e] = ( (uint32_t) base.GetEdgeVertices(be)[0] != vmap[ev[0]] );
+    }
+
+    vert_maps.clear();
+    vert_maps.push_back(vmap);
+
+    for (uint32_t n = 0; n < level; n++)
+    {
+        const Far::TopologyLevel & parent = sub_refiner.GetLevel(n);
+        const Far::TopologyLevel & child = sub_refiner.GetLevel(n+1);
+
+        std::vector<uint32_t> vmap_c(child.GetNumVertices());
+        for (int v = 0; v < parent.GetNumVertices(); v++)
+            vmap_c[ parent.GetVertexChildVertex(v) ] = vmap[v];
+        for (int f = 0; f < parent.GetNumFaces(); f++)
+            vmap_c[ parent.GetFaceChildVertex(f) ] = nverts[n] + fmap[f];
+        for (int e = 0; e < parent.GetNumEdges(); e++)
+            vmap_c[ parent.GetEdgeChildVertex(e) ] = nverts[n] + nfaces[n] + emap[e];
+
+        /* faces and edges aren't needed for the last level */
+        if (n + 1 < level)
+        {
+            std::vector<uint64_t> fmap_c(child.GetNumFaces());
+            std::vector<uint64_t> emap_c(child.GetNumEdges());
+            for (int f = 0; f < parent.GetNumFaces(); f++)
+            {
+                const uint64_t offset = (n == 0) ? face_offsets[fmap[f]] : 4 * fmap[f];
+                const auto cfaces = parent.GetFaceChildFaces(f);
+                for (int k = 0; k < cfaces.size(); k++)
+                    fmap_c[cfaces[k]] = offset + k;
+                const auto cedges = parent.GetFaceChildEdges(f);
+                for (int k = 0; k < cedges.size(); k++)
+                    emap_c[cedges[k]] = offset + k;
+            }
+            const uint64_t face_edges = child_faces_count(n);
+            for (int e = 0; e < parent.GetNumEdges(); e++)
+            {
+                /* child edge j is the one next to the parent edge's vertex j */
+                const auto cedges = parent.GetEdgeChildEdges(e);
+                for (int j = 0; j < cedges.size(); j++)
+                    emap_c[cedges[j]] = face_edges + 2 * emap[e] + (eflip[e] ? 1 - j : j);
+            }
+            fmap = std::move(fmap_c);
+            emap = std::move(emap_c);
+            /* child edges are oriented from their parent component, the same way in both refinements */
+            eflip.assign(emap.size(), 0);
+        }
+
+        vmap = std::move(vmap_c);
+        vert_maps.push_back(vmap);
+    }
+}
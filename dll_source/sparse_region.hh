@@ -0,0 +1,74 @@
+#ifndef SPARSE_REGION_H_INCLUDED
+#define SPARSE_REGION_H_INCLUDED
+
+#include <memory>
+#include <vector>
+
+#include "mesh.hh"
+#include "vertex_mask.hh"
+
+class VertexMatching;
+
+
+/*
+    Edit-local refinement for DhdmWriter.
+
+    The base faces whose subdivided surface (closure) contains edited vertices form the region.
+    Vertices of a subdivided base face only depend on the face's 1-ring, so refining the
+    region plus its 1-ring gives the same values inside the region as refining the whole mesh.
+
+    sub_mesh keeps the base mesh's face and vertex order (and the faces' vertex order), so child
+    faces, subface indices and the order of displacements are the same as with the whole mesh.
+    vert_maps translate the sub refinement's vertex indices to the whole refinement's
+    (needed for the matching files and the hd mesh).
+
+    Assumes OpenSubdiv's uniform refinement with default component ordering
+    (child vertices from vertices, then faces, then edges; child edges from faces, then edges).
+*/
+class SparseRegion
+{
+public:
+    SparseRegion( const dhdm::Mesh & base_mesh, const uint32_t level,
+                  const VertexMask & edited_vis, const VertexMatching * vi_translate );
+
+    // region given as a base faces mask (e.g. a tile of the low memory mode)
+    SparseRegion( const dhdm::Mesh & base_mesh, const uint32_t level,
+                  const std::vector<char> & in_region, const VertexMatching * vi_translate );
+
+    // false when the region covers most of the mesh (refining everything is cheaper)
+    bool is_worthwhile() const;
+
+    void build_vertex_maps( const OpenSubdiv::Far::TopologyRefiner & sub_refiner );
+
+    dhdm::Mesh sub_mesh;                                // region + 1-ring, matId = sub face index
+    std::vector<uint32_t> sub_to_base_face;
+    std::vector<char> in_region;                        // per base face
+    std::vector<char> sub_face_in_region;               // false for 1-ring faces (refined, not written)
+    std::vector<int> sub_first_level_offsets;           // first level subfaces offset of each sub face
+    std::vector< std::vector<uint32_t> > vert_maps;     // per level: sub vertex -> whole refinement vertex
+
+    size_t region_faces_n = 0;
+
+private:
+    static constexpr double max_faces_ratio = 0.5;
+
+    uint32_t level;
+    size_t base_faces_n;
+    std::unique_ptr<OpenSubdiv::Far::TopologyRefiner> base_refiner;    // level 0 only
+    std::vector<uint32_t> sub_to_base_vert;
+
+    // whole refinement
+    std::vector<uint64_t> nverts;
+    std::vector<uint64_t> nfaces;
+    std::vector<uint64_t> nedges;
+    std::vector<uint64_t> face_offsets;     // prefix sums of base faces' vertex counts
+
+    void init_counts( const dhdm::Mesh & base_mesh, const VertexMatching * vi_translate );
+    void build_sub_mesh( const dhdm::Mesh & base_mesh );
+
+    uint32_t child_faces_count(const uint32_t n) const;
+    uint32_t base_face_of(uint64_t f, const uint32_t n) const;
+    void mark_ancestor_faces(uint64_t vi, std::vector<char> & in_region) const;
+};
+
+#endif // SPARSE_REGION_H_INCLUDED
@@ -18,8 +18,7 @@ void dhdm::Mesh::subdivide_nonvertex( const unsigned int level,
         matIdbuffer.resize( last_level_faces );
 
         std::vector<short> matIdbuffer_pv( refiner->GetNumFacesTotal() - last_level_faces );
-        for ( size_t i=0; i < faces.size(); i++ )
-            matIdbuffer_pv[i] = faces[i].matId;
+        std::copy( faces.matIds.begin(), faces.matIds.end(), matIdbuffer_pv.begin() );
 
         short * srcFUnifMat = matIdbuffer_pv.data();
         int face_offset = faces.size();
@@ -88,26 +87,22 @@ void dhdm::Mesh::subdivide_nonvertex( const unsigned int level,
     faces.clear();
     auto lastLevel = refiner->GetLevel(level);
     const size_t last_level_faces = lastLevel.GetNumFaces();
+    faces.reserve(last_level_faces, 4 * last_level_faces, uses_uvs);
 
     for (size_t i = 0; i < last_level_faces; i++)
     {
-        std::vector<FaceVertex> fvs;
         const auto fverts = lastLevel.GetFaceVertices(i);
+        const short matId = uses_materials ? matIdbuffer[i] : 0;
 
         if (uses_uvs)
         {
             const auto fvuvs = lastLevel.GetFaceFVarValues(i, 0);
-            for (int j = 0; j < fverts.size(); j++)
-                fvs.push_back({ .vertex = (VertexId) fverts[j], .uv = (UvId) fvuvs[j] });
+            faces.push_back( (const VertexId *) &fverts[0], (const UvId *) &fvuvs[0], fverts.size(), matId );
         }
         else
         {
-            for (int j = 0; j < fverts.size(); j++)
-                fvs.push_back({ .vertex = (VertexId) fverts[j], .uv = (UvId) 0 });
+            faces.push_back( (const VertexId *) &fverts[0], nullptr, fverts.size(), matId );
         }
-
-        const short matId = uses_materials ? matIdbuffer[i] : 0;
-        faces.push_back({ .vertices = std::move(fvs), .matId = matId });
     }
 }
 
@@ -7,23 +7,35 @@
 using namespace OpenSubdiv;
 
 
-Far::TopologyRefiner * dhdm::createTopologyRefiner( const unsigned int level, const Mesh & baseMesh )
+Far::TopologyDescriptor dhdm::topologyDescriptor( const Faces & faces, const size_t num_vertices,
+                                                   const size_t num_uvs,
+                                                   Far::TopologyDescriptor::FVarChannel & uvChannel )
 {
-    std::vector<int> vertsPerFace;
-    std::vector<int> vertIndices;
-    std::vector<int> uvIndices;
-
-    for (auto & face : baseMesh.faces) {
-        const int num_face_verts = face.vertices.size();
-
-        vertsPerFace.push_back(num_face_verts);
-        for (auto & vert : face.vertices) {
-            vertIndices.push_back(vert.vertex);
-            if (baseMesh.uses_uvs)
-                uvIndices.push_back(vert.uv);
-        }
+    static_assert( sizeof(VertexId) == sizeof(Far::Index) && sizeof(UvId) == sizeof(Far::Index) );
+
+    Far::TopologyDescriptor desc;
+    desc.numVertices = num_vertices;
+    desc.numFaces = faces.size();
+    desc.numVertsPerFace = faces.counts.data();
+    desc.vertIndicesPerFace = reinterpret_cast<const Far::Index *>( faces.corner_verts.data() );
+
+    if (num_uvs > 0) {
+        if (!faces.has_uvs())
+            throw std::runtime_error("Faces without uvs");
+        uvChannel.numValues = num_uvs;
+        uvChannel.valueIndices = reinterpret_cast<const Far::Index *>( faces.corner_uvs.data() );
+        desc.numFVarChannels = 1;
+        desc.fvarChannels = &uvChannel;
+    }
+    return desc;
+}
+
 
-        if (num_face_verts != 4 && num_face_verts != 3)
+static Far::TopologyRefiner * refineTopology( const unsigned int level, const dhdm::Faces & faces,
+                                              const size_t num_vertices, const size_t num_uvs )
+{
+    for (const int c : faces.counts) {
+        if (c != 4 && c != 3)
             throw std::runtime_error("Mesh must have triangles or quads only");
     }
 
@@ -32,23 +44,11 @@ Far::TopologyRefiner * dhdm::createTopologyRefiner( const unsigned int level, co
 
     Sdc::Options options;
     options.SetVtxBoundaryInterpolation(Sdc::Options::VTX_BOUNDARY_EDGE_ONLY);
-
-    Descriptor desc;
-    desc.numVertices = baseMesh.vertices.size();
-    desc.numFaces = baseMesh.faces.size();
-    desc.numVertsPerFace = vertsPerFace.data();
-    desc.vertIndicesPerFace = vertIndices.data();
+    if (num_uvs > 0)
+        options.SetFVarLinearInterpolation(Sdc::Options::FVAR_LINEAR_CORNERS_ONLY);
 
     Descriptor::FVarChannel uvChannel;
-    if (baseMesh.uses_uvs) {
-        if (baseMesh.uv_layers.size() == 0)
-            throw std::runtime_error("Empty uv_layers with uses_uvs");
-        options.SetFVarLinearInterpolation(Sdc::Options::FVAR_LINEAR_CORNERS_ONLY);
-        uvChannel.numValues = baseMesh.uv_layers[0].size();
-        uvChannel.valueIndices = uvIndices.data();
-        desc.numFVarChannels = 1;
-        desc.fvarChannels = &uvChannel;
-    }
+    const Descriptor desc = dhdm::topologyDescriptor(faces, num_vertices, num_uvs, uvChannel);
 
     Far::TopologyRefiner * refiner =
             Far::TopologyRefinerFactory<Descriptor>::Create(
@@ -56,13 +56,34 @@ Far::TopologyRefiner * dhdm::createTopologyRefiner( const unsigned int level, co
                 Far::TopologyRefinerFactory<Descriptor>::Options(type, options)
             );
 
-    Far::TopologyRefiner::UniformOptions refineOptions(level);
-    refineOptions.fullTopologyInLastLevel = false; // true;
-    refiner->RefineUniform(refineOptions);
+    // level 0: base topology only
+    if (level > 0)
+    {
+        Far::TopologyRefiner::UniformOptions refineOptions(level);
+        refineOptions.fullTopologyInLastLevel = false; // true;
+        refiner->RefineUniform(refineOptions);
+    }
 
     return refiner;
 }
 
+Far::TopologyRefiner * dhdm::createTopologyRefiner( const unsigned int level, const Mesh & baseMesh )
+{
+    size_t num_uvs = 0;
+    if (baseMesh.uses_uvs) {
+        if (baseMesh.uv_layers.size() == 0)
+            throw std::runtime_error("Empty uv_layers with uses_uvs");
+        num_uvs = baseMesh.uv_layers[0].size();
+    }
+    return refineTopology(level, baseMesh.faces, baseMesh.vertices.size(), num_uvs);
+}
+
+Far::TopologyRefiner * dhdm::createTopologyRefiner( const unsigned int level, const Faces & faces,
+                                                    const size_t num_vertices )
+{
+    return refineTopology(level, faces, num_vertices, 0);
+}
+
 
 void dhdm::MeshSubdivider::subdivide_simple_init()
 {
@@ -138,8 +159,7 @@ dhdm::MeshSubdivider::MeshSubdivider( const dhdm::Mesh * baseMesh, const unsigne
             const int last_level_faces = refiner->GetLevel(level).GetNumFaces();
             matIdbuffer.resize( last_level_faces );
             std::vector<short> matIdbuffer_pv( refiner->GetNumFacesTotal() - last_level_faces );
-            for (size_t i=0; i < baseMesh->faces.size(); i++)
-                matIdbuffer_pv[i] = faces[i].matId;
+            std::copy( baseMesh->faces.matIds.begin(), baseMesh->faces.matIds.end(), matIdbuffer_pv.begin() );
             short * srcFUnifMat = matIdbuffer_pv.data();
             int face_offset = baseMesh->faces.size();
 
@@ -155,24 +175,20 @@ dhdm::MeshSubdivider::MeshSubdivider( const dhdm::Mesh * baseMesh, const unsigne
 
     auto lastLevel = refiner->GetLevel(level);
     const size_t nfaces = lastLevel.GetNumFaces();
+    faces.reserve(nfaces, 4 * nfaces, uses_uvs);
     for (size_t i = 0; i < nfaces; i++) {
-        std::vector<FaceVertex> fvs;
         const auto fverts = lastLevel.GetFaceVertices(i);
+        const short matId = uses_materials ? matIdbuffer[i] : 0;
 
         if (uses_uvs)
         {
             const auto fvuvs = lastLevel.GetFaceFVarValues(i, 0);
-            for (int j = 0; j < fverts.size(); j++)
-                fvs.push_back({ .vertex = (VertexId) fverts[j], .uv = (UvId) fvuvs[j] });
+            faces.push_back( (const VertexId *) &fverts[0], (const UvId *) &fvuvs[0], fverts.size(), matId );
         }
         else
         {
-            for (int j = 0; j < fverts.size(); j++)
-                fvs.push_back({ .vertex = (VertexId) fverts[j], .uv = (UvId) 0 });
+            faces.push_back( (const VertexId *) &fverts[0], nullptr, fverts.size(), matId );
         }
-
-        const short matId = uses_materials ? matIdbuffer[i] : 0;
-        faces.push_back({ .vertices = std::move(fvs), .matId = matId });
     }
     matIdbuffer.clear();
 
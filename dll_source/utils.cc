@@ -2,6 +2,13 @@
 #include <boost/iostreams/filtering_stream.hpp>
 #include <boost/iostreams/filter/gzip.hpp>
 #include <fmt/format.h>
+#ifdef _WIN32
+    #define NOMINMAX
+    #include <windows.h>
+    #include <psapi.h>
+#else
+    #include <sys/resource.h>
+#endif
 
 #include "utils.hh"
 
@@ -76,8 +83,8 @@ uint32_t relative_subd_level(const dhdm::Mesh & base_mesh, const dhdm::Mesh & hd
     return (uint32_t) n;
 }
 
-std::set<uint32_t> get_hd_disp_mask( const dhdm::Mesh & noeditedhdMesh,
-                                     const dhdm::Mesh & editedhdMesh )
+VertexMask get_hd_disp_mask( const dhdm::Mesh & noeditedhdMesh,
+                             const dhdm::Mesh & editedhdMesh )
 {
     if (noeditedhdMesh.vertices.size() != editedhdMesh.vertices.size())
     {
@@ -85,7 +92,7 @@ std::set<uint32_t> get_hd_disp_mask( const dhdm::Mesh & noeditedhdMesh,
                                               noeditedhdMesh.vertices.size(), editedhdMesh.vertices.size()) );
     }
 
-    std::set<uint32_t> edited_vis;
+    VertexMask edited_vis( editedhdMesh.vertices.size() );
     for (size_t i = 0; i < editedhdMesh.vertices.size(); i++)
     {
         if ( glm::length(editedhdMesh.vertices[i].pos - noeditedhdMesh.vertices[i].pos) > 1e-6 )
@@ -94,3 +101,22 @@ std::set<uint32_t> get_hd_disp_mask( const dhdm::Mesh & noeditedhdMesh,
 
     return edited_vis;
 }
+
+size_t get_peak_rss()
+{
+#ifdef _WIN32
+    PROCESS_MEMORY_COUNTERS counters;
+    if ( !GetProcessMemoryInfo(GetCurrentProcess(), &counters, sizeof(counters)) )
+        return 0;
+    return counters.PeakWorkingSetSize;
+#else
+    struct rusage usage;
+    if ( getrusage(RUSAGE_SELF, &usage) != 0 )
+        return 0;
+  #ifdef __APPLE__
+    return usage.ru_maxrss;             // bytes
+  #else
+    return usage.ru_maxrss * 1024;      // KB
+  #endif
+#endif
+}
@@ -6,10 +6,12 @@
 #include <tuple>
 #include <unordered_map>
 #include <set>
+#include <chrono>
 #include <nlohmann/json.hpp>
 
 #include "shared.hh"
 #include "mesh.hh"
+#include "vertex_mask.hh"
 
 
 nlohmann::json readJSON(const std::string & fp);
@@ -96,6 +98,26 @@ bool endswith( const std::string & p, const std::string & suf );
 
 uint32_t relative_subd_level(const dhdm::Mesh & base_mesh, const dhdm::Mesh & hd_mesh);
 
-std::set<uint32_t> get_hd_disp_mask(const dhdm::Mesh & noeditedhdMesh, const dhdm::Mesh & editedhdMesh);
+// vertices of editedhdMesh moved from noeditedhdMesh (the addon computes it itself, see MeshInfo::edited_mask)
+VertexMask get_hd_disp_mask(const dhdm::Mesh & noeditedhdMesh, const dhdm::Mesh & editedhdMesh);
+
+// peak resident memory of the process in bytes (0 if unknown)
+size_t get_peak_rss();
+
+// seconds since the construction or the previous lap()
+class Stopwatch
+{
+public:
+    double lap()
+    {
+        const auto now = std::chrono::steady_clock::now();
+        const double s = std::chrono::duration<double>(now - start).count();
+        start = now;
+        return s;
+    }
+
+private:
+    std::chrono::steady_clock::time_point start = std::chrono::steady_clock::now();
+};
 
 #endif // UTILS_H_INCLUDED
@@ -0,0 +1,61 @@
+#ifndef VERTEX_MASK_H_INCLUDED
+#define VERTEX_MASK_H_INCLUDED
+
+#include <bit>
+#include <cstdint>
+#include <vector>
+
+
+/*
+    Set of hd mesh vertices (the edited ones) as a bitmap: bit i set <=> vertex i in the set.
+
+    Packed masks from the addon are bytes with bit i in byte i/8, bit i%8
+    (numpy.packbits(..., bitorder="little")).
+*/
+class VertexMask
+{
+public:
+    VertexMask() = default;
+
+    explicit VertexMask( const size_t nr_vertices ) :
+        words((nr_vertices + 63) / 64, 0), nr_vertices(nr_vertices)
+    {
+    }
+
+    VertexMask( const unsigned char * packed, const size_t nr_vertices ) :
+        VertexMask(nr_vertices)
+    {
+        for (size_t i = 0; i < (nr_vertices + 7) / 8; i++)
+            words[i / 8] |= uint64_t(packed[i]) << (8 * (i % 8));
+        // bits past the last vertex are ignored
+        if (nr_vertices % 64 != 0)
+            words.back() &= (uint64_t(1) << (nr_vertices % 64)) - 1;
+    }
+
+    void insert( const uint32_t vi )
+    {
+        words[vi >> 6] |= uint64_t(1) << (vi & 63);
+    }
+
+    bool contains( const uint32_t vi ) const
+    {
+        return vi < nr_vertices && ((words[vi >> 6] >> (vi & 63)) & 1) != 0;
+    }
+
+    // number of vertices in the set
+    size_t count() const
+    {
+        size_t n = 0;
+        for (const uint64_t w : words)
+            n += std::popcount(w);
+        return n;
+    }
+
+    size_t size() const { return nr_vertices; }
+
+private:
+    std::vector<uint64_t> words;
+    size_t nr_vertices = 0;
+};
+
+#endif // VERTEX_MASK_H_INCLUDED
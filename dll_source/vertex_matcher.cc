@@ -0,0 +1,372 @@
+#include <algorithm>
+#include <cmath>
+#include <future>
+#include <limits>
+#include <stdexcept>
+#include <thread>
+#include <unordered_map>
+
+#include "vertex_matcher.hh"
+
+
+KdTree3::KdTree3( const float * positions, const size_t count ) :
+    positions(positions), order(count), axes(count, 0)
+{
+    if (count > std::numeric_limits<uint32_t>::max())
+        throw std::runtime_error("KdTree3: too many points");
+    for (size_t i = 0; i < count; i++)
+        order[i] = i;
+    build(0, count, 0);
+}
+
+
+void KdTree3::build( const size_t lo, const size_t hi, const unsigned int depth )
+{
+    if (hi - lo <= leaf_size)
+        return;
+
+    /* split on the axis of largest extent */
+    float bmin[3] = {  std::numeric_limits<float>::max(),  std::numeric_limits<float>::max(),  std::numeric_limits<float>::max() };
+    float bmax[3] = { -std::numeric_limits<float>::max(), -std::numeric_limits<float>::max(), -std::numeric_limits<float>::max() };
+    for (size_t k = lo; k < hi; k++)
+    {
+        const float * co = positions + 3 * (size_t) order[k];
+        for (int a = 0; a < 3; a++)
+        {
+            bmin[a] = std::min(bmin[a], co[a]);
+            bmax[a] = std::max(bmax[a], co[a]);
+        }
+    }
+    uint8_t axis = 0;
+    for (uint8_t a = 1; a < 3; a++)
+    {
+        if (bmax[a] - bmin[a] > bmax[axis] - bmin[axis])
+            axis = a;
+    }
+
+    const size_t mid = lo + (hi - lo) / 2;
+    std::nth_element( order.begin() + lo, order.begin() + mid, order.begin() + hi,
+                      [this, axis](const uint32_t i, const uint32_t j) {
+                          return positions[3 * (size_t) i + axis] < positions[3 * (size_t) j + axis];
+                      } );
+    axes[mid] = axis;
+
+    // the two halves don't overlap, the first levels are built in parallel
+    if (depth < 3 && hi - lo > 100000)
+    {
+        auto lower = std::async( std::launch::async, [this, lo, mid, depth]() { build(lo, mid, depth + 1); } );
+        build(mid + 1, hi, depth + 1);
+        lower.get();
+    }
+    else
+    {
+        build(lo, mid, depth + 1);
+        build(mid + 1, hi, depth + 1);
+    }
+}
+
+
+double KdTree3::distance2( const uint32_t i, const float * p ) const
+{
+    const float * co = positions + 3 * (size_t) i;
+    const double dx = double(co[0]) - p[0];
+    const double dy = double(co[1]) - p[1];
+    const double dz = double(co[2]) - p[2];
+    return dx*dx + dy*dy + dz*dz;
+}
+
+
+std::pair<uint32_t, double> KdTree3::nearest( const float * p ) const
+{
+    uint32_t best = 0;
+    double best_d2 = std::numeric_limits<double>::infinity();
+    nearest(0, order.size(), p, best, best_d2);
+    return { best, best_d2 };
+}
+
+
+void KdTree3::nearest( const size_t lo, const size_t hi, const float * p, uint32_t & best, double & best_d2 ) const
+{
+    if (hi - lo <= leaf_size)
+    {
+        for (size_t k = lo; k < hi; k++)
+        {
+            const double d2 = distance2(order[k], p);
+            if (d2 < best_d2)
+            {
+                best_d2 = d2;
+                best = order[k];
+            }
+        }
+        return;
+    }
+
+    const size_t mid = lo + (hi - lo) / 2;
+    const uint32_t i = order[mid];
+    const double d2 = distance2(i, p);
+    if (d2 < best_d2)
+    {
+        best_d2 = d2;
+        best = i;
+    }
+
+    const uint8_t axis = axes[mid];
+    const double diff = double(p[axis]) - positions[3 * (size_t) i + axis];
+    if (diff < 0)
+    {
+        nearest(lo, mid, p, best, best_d2);
+        if (diff * diff < best_d2)
+            nearest(mid + 1, hi, p, best, best_d2);
+    }
+    else
+    {
+        nearest(mid + 1, hi, p, best, best_d2);
+        if (diff * diff < best_d2)
+            nearest(lo, mid, p, best, best_d2);
+    }
+}
+
+
+void match_nearest( const float * ref_positions, const size_t ref_count,
+                    const float * query_positions, const size_t query_count,
+                    const unsigned int num_threads,
+                    uint32_t * indices, float * distances )
+{
+    if (ref_count == 0)
+        throw std::runtime_error("match_nearest(): no reference points");
+
+    const KdTree3 tree(ref_positions, ref_count);
+
+    unsigned int nr_threads = num_threads;
+    if (nr_threads == 0)
+        nr_threads = std::max(1u, std::thread::hardware_concurrency());
+    nr_threads = (unsigned int) std::min<size_t>(nr_threads, std::max<size_t>(1, query_count / 4096));
+
+    auto match_range = [&](const size_t begin, const size_t end) {
+        for (size_t j = begin; j < end; j++)
+        {
+            const auto [i, d2] = tree.nearest(query_positions + 3 * j);
+            indices[j] = i;
+            distances[j] = (float) std::sqrt(d2);
+        }
+    };
+
+    const size_t chunk = (query_count + nr_threads - 1) / nr_threads;
+    std::vector<std::thread> threads;
+    for (unsigned int t = 1; t < nr_threads; t++)
+    {
+        const size_t begin = std::min(query_count, t * chunk);
+        const size_t end = std::min(query_count, begin + chunk);
+        threads.emplace_back(match_range, begin, end);
+    }
+    match_range(0, std::min(query_count, chunk));
+    for (auto & th : threads)
+        th.join();
+}
+
+
+namespace {
+
+    // faces and directed edges (face corners) of a MeshBuffers
+    struct CornerTable
+    {
+        const MeshBuffers & mesh;
+        std::vector<uint32_t> face_start;                   // first corner of each face, + total
+        std::vector<uint32_t> corner_face;
+        std::unordered_map<uint64_t, uint32_t> edge_corner; // (v0, v1) -> corner starting at v0
+
+        explicit CornerTable( const MeshBuffers & mesh ) : mesh(mesh)
+        {
+            face_start.resize( size_t(mesh.face_count) + 1 );
+            uint32_t n = 0;
+            for (uint32_t f = 0; f < mesh.face_count; f++)
+            {
+                face_start[f] = n;
+                n += mesh.face_vert_counts[f];
+            }
+            face_start[mesh.face_count] = n;
+
+            corner_face.resize(n);
+            edge_corner.reserve(n);
+            for (uint32_t f = 0; f < mesh.face_count; f++)
+            {
+                for (uint32_t c = face_start[f]; c < face_start[f+1]; c++)
+                {
+                    corner_face[c] = f;
+                    if (!edge_corner.emplace( edge_key(c), c ).second)
+                        throw std::runtime_error("match_topology(): non-manifold or inconsistently oriented mesh");
+                }
+            }
+        }
+
+        uint32_t face_size( const uint32_t f ) const { return face_start[f+1] - face_start[f]; }
+
+        uint32_t vertex( const uint32_t f, const uint32_t i ) const
+        {
+            return mesh.face_vert_indices[ face_start[f] + i ];
+        }
+
+        uint32_t next( const uint32_t c ) const
+        {
+            const uint32_t f = corner_face[c];
+            return c + 1 < face_start[f+1] ? c + 1 : face_start[f];
+        }
+
+        uint64_t edge_key( const uint32_t c ) const
+        {
+            return (uint64_t(uint32_t(mesh.face_vert_indices[c])) << 32) | uint32_t(mesh.face_vert_indices[next(c)]);
+        }
+
+        // corner of the neighbouring face on the other side of corner c's edge, -1 on boundaries
+        int64_t twin( const uint32_t c ) const
+        {
+            const uint64_t key = edge_key(c);
+            const auto it = edge_corner.find( (key << 32) | (key >> 32) );
+            return it == edge_corner.end() ? -1 : int64_t(it->second);
+        }
+
+        void centroid( const uint32_t f, double * out ) const
+        {
+            out[0] = out[1] = out[2] = 0;
+            for (uint32_t i = 0; i < face_size(f); i++)
+            {
+                const float * co = mesh.positions + 3 * (size_t) vertex(f, i);
+                for (int a = 0; a < 3; a++)
+                    out[a] += co[a];
+            }
+            for (int a = 0; a < 3; a++)
+                out[a] /= face_size(f);
+        }
+    };
+
+    double distance2( const float * p, const float * q )
+    {
+        const double dx = double(p[0]) - q[0];
+        const double dy = double(p[1]) - q[1];
+        const double dz = double(p[2]) - q[2];
+        return dx*dx + dy*dy + dz*dz;
+    }
+
+}
+
+
+void match_topology( const MeshBuffers & ref, const MeshBuffers & query, uint32_t * indices )
+{
+    if (ref.vert_count != query.vert_count || ref.face_count != query.face_count)
+        throw std::runtime_error("match_topology(): meshes with different vertex/face counts");
+
+    const CornerTable qt(query), rt(ref);
+    if (qt.face_start.back() != rt.face_start.back())
+        throw std::runtime_error("match_topology(): meshes with different face corner counts");
+
+    constexpr uint32_t none = std::numeric_limits<uint32_t>::max();
+    std::vector<uint32_t> face_map( query.face_count, none );     // query face -> ref face
+    std::vector<uint32_t> face_rot( query.face_count, 0 );        // query corner i -> ref corner (i + rot) % n
+    std::vector<bool> ref_face_used( ref.face_count, false );
+    std::vector<uint32_t> vertex_map( query.vert_count, none );
+    std::vector<bool> ref_vertex_used( ref.vert_count, false );
+
+    auto map_vertex = [&]( const uint32_t qv, const uint32_t rv ) {
+        if (vertex_map[qv] == rv)
+            return;
+        if (vertex_map[qv] != none || ref_vertex_used[rv])
+            throw std::runtime_error("match_topology(): topologies don't match");
+        vertex_map[qv] = rv;
+        ref_vertex_used[rv] = true;
+    };
+
+    auto map_face = [&]( const uint32_t qf, const uint32_t rf, const uint32_t rot ) {
+        if (ref_face_used[rf] || qt.face_size(qf) != rt.face_size(rf))
+            throw std::runtime_error("match_topology(): topologies don't match");
+        face_map[qf] = rf;
+        face_rot[qf] = rot;
+        ref_face_used[rf] = true;
+    };
+
+    std::vector<uint32_t> queue;
+    for (uint32_t seed = 0; seed < query.face_count; seed++)
+    {
+        if (face_map[seed] != none)
+            continue;
+
+        /* first face pair of a connected component: nearest unused ref face, best corner rotation */
+        const uint32_t n = qt.face_size(seed);
+        double qc[3], rc[3];
+        qt.centroid(seed, qc);
+        uint32_t best_rf = none;
+        double best_d2 = std::numeric_limits<double>::infinity();
+        for (uint32_t rf = 0; rf < ref.face_count; rf++)
+        {
+            if (ref_face_used[rf] || rt.face_size(rf) != n)
+                continue;
+            rt.centroid(rf, rc);
+            const double d2 = (qc[0]-rc[0])*(qc[0]-rc[0]) + (qc[1]-rc[1])*(qc[1]-rc[1]) + (qc[2]-rc[2])*(qc[2]-rc[2]);
+            if (d2 < best_d2)
+            {
+                best_d2 = d2;
+                best_rf = rf;
+            }
+        }
+        if (best_rf == none)
+            throw std::runtime_error("match_topology(): topologies don't match");
+
+        uint32_t best_rot = 0;
+        best_d2 = std::numeric_limits<double>::infinity();
+        for (uint32_t rot = 0; rot < n; rot++)
+        {
+            double d2 = 0;
+            for (uint32_t i = 0; i < n; i++)
+                d2 += distance2( query.positions + 3 * (size_t) qt.vertex(seed, i),
+                                 ref.positions + 3 * (size_t) rt.vertex(best_rf, (i + rot) % n) );
+            if (d2 < best_d2)
+            {
+                best_d2 = d2;
+                best_rot = rot;
+            }
+        }
+        map_face(seed, best_rf, best_rot);
+
+        /* propagation across the edges of matched faces */
+        queue.assign(1, seed);
+        while (!queue.empty())
+        {
+            const uint32_t qf = queue.back();
+            queue.pop_back();
+            const uint32_t rf = face_map[qf];
+            const uint32_t fn = qt.face_size(qf);
+            for (uint32_t i = 0; i < fn; i++)
+            {
+                const uint32_t ri = (i + face_rot[qf]) % fn;
+                map_vertex( qt.vertex(qf, i), rt.vertex(rf, ri) );
+
+                const int64_t qtwin = qt.twin( qt.face_start[qf] + i );
+                const int64_t rtwin = rt.twin( rt.face_start[rf] + ri );
+                if ((qtwin < 0) != (rtwin < 0))
+                    throw std::runtime_error("match_topology(): topologies don't match");
+                if (qtwin < 0)
+                    continue;
+
+                const uint32_t qg = qt.corner_face[qtwin];
+                const uint32_t rg = rt.corner_face[rtwin];
+                const uint32_t gn = qt.face_size(qg);
+                const uint32_t qi = uint32_t(qtwin) - qt.face_start[qg];
+                const uint32_t rgi = uint32_t(rtwin) - rt.face_start[rg];
+                const uint32_t rot = (rgi + gn - qi % gn) % gn;
+                if (face_map[qg] == none)
+                {
+                    map_face(qg, rg, rot);
+                    queue.push_back(qg);
+                }
+                else if (face_map[qg] != rg || face_rot[qg] != rot)
+                    throw std::runtime_error("match_topology(): topologies don't match");
+            }
+        }
+    }
+
+    for (uint32_t qv = 0; qv < query.vert_count; qv++)
+    {
+        if (vertex_map[qv] == none)
+            throw std::runtime_error("match_topology(): vertex not used by any face");
+        indices[qv] = vertex_map[qv];
+    }
+}
@@ -0,0 +1,62 @@
+#ifndef VERTEX_MATCHER_H_INCLUDED
+#define VERTEX_MATCHER_H_INCLUDED
+
+#include <cstddef>
+#include <cstdint>
+#include <utility>
+#include <vector>
+
+#include "shared.hh"
+
+
+/*
+    Static 3d kd-tree over a positions array (x, y, z floats per point), for nearest point queries.
+
+    Implicit layout: each range [lo, hi) of order has its node's point at the middle, points
+    before it are on the lower side of the node's split plane, points after it on the upper side.
+    The positions array must outlive the tree.
+*/
+class KdTree3
+{
+public:
+    KdTree3( const float * positions, const size_t count );
+
+    // index of the nearest point and its squared distance
+    std::pair<uint32_t, double> nearest( const float * p ) const;
+
+private:
+    static constexpr size_t leaf_size = 8;
+
+    const float * positions;
+    std::vector<uint32_t> order;
+    std::vector<uint8_t> axes;      // split axis of the node at each middle position
+
+    void build( const size_t lo, const size_t hi, const unsigned int depth );
+    void nearest( const size_t lo, const size_t hi, const float * p, uint32_t & best, double & best_d2 ) const;
+    double distance2( const uint32_t i, const float * p ) const;
+};
+
+
+/*
+    Nearest reference point of every query point (bulk, multithreaded).
+    indices and distances must have room for query_count values.
+*/
+void match_nearest( const float * ref_positions, const size_t ref_count,
+                    const float * query_positions, const size_t query_count,
+                    const unsigned int num_threads,
+                    uint32_t * indices, float * distances );
+
+
+/*
+    Exact vertex correspondence between two meshes with the same topology (e.g. the same base mesh
+    subdivided by OpenSubdiv and by Blender's multires), found by walking their faces: matched faces
+    are propagated to their neighbours across matched edges, corner by corner.
+    Positions are only used to pick the first face pair of every connected component (the nearest
+    face centroid, then the corner rotation with the smallest distances), so a symmetric mesh isn't
+    matched to its mirror image.
+    indices: query vertex -> ref vertex, room for query.vert_count values.
+    Throws std::runtime_error if the topologies don't match.
+*/
+void match_topology( const MeshBuffers & ref, const MeshBuffers & query, uint32_t * indices );
+
+#endif // VERTEX_MATCHER_H_INCLUDED